@@ -16,11 +16,38 @@ import threading
 import queue
 import base64
 import hashlib
+import math
+import argparse
+import collections
+import bisect
+import ipaddress
+import errno
+import re
+import mmap
+import ctypes
+import struct
+import select
+import selectors
+import secrets
+import shutil
+import socketserver
+import http.client
 from datetime import datetime
+import urllib.request
+import urllib.error
 from urllib.parse import urlparse, parse_qs, unquote
 import socket
 import random
 import string
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import yaml  # Optional, for YAML beyond what the built-in parser handles
+except ImportError:
+    yaml = None
 
 # ========== CONFIGURATION ==========
 APP = "⚡ RAGEVPN PRO"
@@ -30,8 +57,63 @@ PROFILES = os.path.join(BASE, "profiles")
 CONFIG = os.path.join(BASE, "config.json")
 LOG_FILE = os.path.join(BASE, "ragevpn.log")
 CACHE = os.path.join(BASE, "cache")
+SETTINGS_FILE = os.path.join(BASE, "settings.json")
+TRACE_FILE = os.path.join(BASE, "trace.jsonl")
+EVENTS_FILE = os.path.join(BASE, "events.jsonl")
+PROFILE_DIR = os.path.join(BASE, "profile")
+RULES_DIR = os.path.join(BASE, "rules")
+SESSION_FILE = os.path.join(BASE, "session.json")
+SINGBOX_LOG = os.path.join(BASE, "sing-box.log")
+SINGBOX_LOG_MAX = 5 * 1024 * 1024  # Rotate sing-box.log past this size
+SINGBOX_LOG_BACKUPS = 3
 TG = "https://t.me/RAGEVPN_N1"
 GITHUB = "https://github.com/ODINIZHAC2024/RAGEVPN-LI/"
+TUN_INTERFACE = "ragevpn0"
+TUN_STACKS = ("mixed", "system", "gvisor")
+DEFAULT_MTU = 1500
+
+DEFAULT_SETTINGS = {
+    "probe_host": "1.1.1.1",  # First-byte probe target (plain HTTP)
+    "probe_port": 80,
+    "tun_timeout": 10,
+    "ready_signal": "tun",          # "tun": wait for the interface, "log": for sing-box's started line
+    "test_url": "https://1.1.1.1/cdn-cgi/trace",  # Pre-connect reachability check
+    "health_min_interval": 2,       # Seconds between probes while suspicious
+    "health_max_interval": 60,      # Back-off ceiling for idle connections
+    "health_max_failure_rate": 0.5,
+    "health_max_latency_ms": 3000,
+    "auto_failover": True,
+    "bench_host": "",               # Bulk source for --bench-tunnel; empty runs one locally
+    "bench_port": 5201,
+    "bench_bytes": 20 * 1024 * 1024,
+    "validate_bytes": 2 * 1024 * 1024,  # Per-profile download in --validate-netns (needs bench_host)
+    "verify_url": "http://cp.cloudflare.com/generate_204",  # Fetched through each profile by --verify
+    "geo_update_hours": 168,        # Refresh cached geoip/geosite rule-sets weekly
+    "geo_urls": {},                 # Per rule-set download URL overrides, e.g. a mirror
+    "cache_file": True,             # Persistent sing-box cache per profile / cache_group
+    "cache_file_max_mb": 16,        # Larger cache files are deleted before a connect
+    "cache_files_keep": 20,         # Most recently used cache files kept
+    "cache_probe_url": "http://www.gstatic.com/generate_204",  # First request for --bench-cache
+    "tun_ipv6": True,               # Dual-stack tun; off keeps IPv6 out of the tunnel
+    "dns_strategy": "auto",         # prefer_ipv4 / prefer_ipv6 / ipv4_only / ipv6_only, auto: faster family
+    "family_race_hours": 24,        # Re-race a profile's IPv4 / IPv6 connects on connect after this long
+    "pin_server_address": False,    # Connect to the pre-resolved server address, hostname kept as SNI
+    "resolver_servers": ["1.1.1.1", "8.8.8.8"],  # Queried at once for pre-resolving, host or host:port
+    "idle_after": 30,               # Seconds without keys or traffic change before the dashboard slows down
+    "idle_refresh": 5.0,            # Seconds between dashboard updates while idle
+    "idle_traffic_delta": 32 * 1024,  # Bytes/s change that counts as traffic activity
+    "resource_interval": 10,        # Seconds between sing-box CPU / memory / open file samples
+    "leak_window_minutes": 60,      # Growth must hold this long before it counts as a leak
+    "leak_rss_mb_per_hour": 20,
+    "leak_fds_per_hour": 50,
+    "resource_max_rss_mb": 0,       # Hard limits for sing-box, 0 = none
+    "resource_max_fds": 0,
+    "leak_restart": False,          # Restart sing-box on a leak alert or crossed limit
+    "leak_restarts_per_hour": 3     # Then alerts only, e.g. when a fresh sing-box is already over a limit
+}
+
+# Filled in by main() once sing-box has been checked
+SINGBOX_VERSION = None
 
 # Colors
 COLOR_RED = 1
@@ -45,6 +127,7 @@ COLOR_WHITE = 7
 # Create directories
 os.makedirs(PROFILES, exist_ok=True)
 os.makedirs(CACHE, exist_ok=True)
+os.makedirs(RULES_DIR, exist_ok=True)
 
 # ========== UTILITIES ==========
 def log_message(level, message):
@@ -58,14 +141,17 @@ def log_message(level, message):
     if level == "ERROR":
         print(f"[-] {message}")
 
-def sh(cmd, background=False):
+def sh(cmd, background=False, output=None):
     """Execute shell command with options"""
     try:
         if background:
+            # With output, stdout and stderr both go to that file and the
+            # child gets its own session so it can outlive the UI
             return subprocess.Popen(
                 cmd,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
+                stdout=output or subprocess.DEVNULL,
+                stderr=subprocess.STDOUT if output else subprocess.DEVNULL,
+                start_new_session=output is not None,
                 shell=False
             )
         else:
@@ -92,11 +178,16 @@ def check_singbox():
     return False, None
 
 def stop_singbox():
-    """Stop all sing-box processes"""
+    """Stop the sing-box processes running our config
+    
+    Other instances (validation namespaces, benchmarks, unrelated tunnels)
+    are left alone.
+    """
+    clear_session()
     killed = 0
     for p in psutil.process_iter(["pid", "name", "cmdline"]):
         try:
-            if p.info["name"] and "sing-box" in p.info["name"].lower():
+            if p.info["name"] and "sing-box" in p.info["name"].lower() and CONFIG in (p.info["cmdline"] or ()):
                 p.kill()
                 killed += 1
         except (psutil.NoSuchProcess, psutil.AccessDenied):
@@ -105,12 +196,133 @@ def stop_singbox():
         log_message("INFO", f"Stopped {killed} sing-box processes")
     return killed
 
+# ========== SING-BOX OUTPUT ==========
+class OutputCapture:
+    """sing-box output in a rotating file plus recent lines in memory
+    
+    The child writes straight to the log file (never to a pipe, so it
+    survives the UI exiting); a reader thread follows the file into a
+    ring buffer. Rotation copies and truncates, since the child keeps its
+    O_APPEND descriptor.
+    """
+    
+    def __init__(self, path=SINGBOX_LOG, max_bytes=SINGBOX_LOG_MAX, backups=SINGBOX_LOG_BACKUPS, lines=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lines = collections.deque(maxlen=lines)
+        self.lock = threading.Lock()
+    
+    def open(self, label="sing-box started"):
+        """Append a marker and return (file for the child, offset to follow from)"""
+        f = open(self.path, "ab")
+        f.write(f"----- {label} -----\n".encode())
+        f.flush()
+        return f, f.tell()
+    
+    def attach(self, process, offset=None):
+        """Follow the log from offset (default: its end) while process runs"""
+        if offset is None:
+            try:
+                offset = os.path.getsize(self.path)
+            except OSError:
+                offset = 0
+        alive = process.is_running if isinstance(process, psutil.Process) else lambda: process.poll() is None
+        thread = threading.Thread(target=self._follow, args=(alive, offset), daemon=True)
+        thread.start()
+        return thread
+    
+    def tail(self, count=20):
+        """Last count captured lines"""
+        with self.lock:
+            return list(self.lines)[-count:]
+    
+    def _follow(self, alive, offset):
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return
+        f.seek(offset)
+        pending = b""
+        
+        while True:
+            chunk = f.read(65536)
+            if chunk:
+                pending += chunk
+                *complete, pending = pending.split(b"\n")
+                with self.lock:
+                    for line in complete:
+                        self.lines.append(line.rstrip(b"\r").decode("utf-8", "replace"))
+                continue
+            if not alive():
+                # One last read for whatever it wrote on the way out
+                time.sleep(0.05)
+                if not f.read(1):
+                    break
+                f.seek(-1, os.SEEK_CUR)
+                continue
+            if f.tell() >= self.max_bytes:
+                self._rotate()
+                f.seek(0)
+            elif os.path.getsize(self.path) < f.tell():
+                f.seek(0)  # Truncated by someone else
+            time.sleep(0.2)
+        
+        if pending:
+            with self.lock:
+                self.lines.append(pending.decode("utf-8", "replace"))
+        f.close()
+    
+    def _rotate(self):
+        """sing-box.log -> .1 -> .2 ... dropping the oldest"""
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        try:
+            shutil.copyfile(self.path, f"{self.path}.1")
+            os.truncate(self.path, 0)
+        except OSError as e:
+            log_message("WARN", f"Failed to rotate {self.path}: {e}")
+
+singbox_output = OutputCapture()
+
+def stop_process(process, timeout=3):
+    """Stop one process (Popen or psutil), killing it if it ignores SIGTERM"""
+    try:
+        process.terminate()
+        process.wait(timeout)
+    except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+        process.kill()
+        process.wait()
+    except (ProcessLookupError, psutil.NoSuchProcess):
+        pass
+
 def generate_random_name():
     """Generate random profile name"""
     adjectives = ["Rage", "Stealth", "Ghost", "Phantom", "Shadow", "Cyber", "Dark", "Black"]
     nouns = ["Tunnel", "Bridge", "Gate", "Portal", "Path", "Link", "Node", "Proxy"]
     return f"{random.choice(adjectives)}_{random.choice(nouns)}_{random.randint(100, 999)}"
 
+def load_settings():
+    """Load client settings merged over defaults"""
+    settings = dict(DEFAULT_SETTINGS)
+    if os.path.exists(SETTINGS_FILE):
+        try:
+            with open(SETTINGS_FILE, "r") as f:
+                settings.update(json.load(f))
+        except:
+            log_message("WARN", "Invalid settings file, using defaults")
+    return settings
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
 def encrypt_profile(data, key):
     """Simple XOR encryption for profiles"""
     if not key:
@@ -135,27 +347,88 @@ def decrypt_profile(encrypted_data, key):
         return None
 
 # ========== PROTOCOL PARSERS ==========
+def query_params(query):
+    """First value of each query parameter"""
+    return {key: values[0] for key, values in parse_qs(query).items()}
+
+def link_tls(params, server, security="none"):
+    """sing-box tls object from link parameters, or None without TLS"""
+    security = params.get("security", security)
+    if security not in ("tls", "reality", "xtls"):
+        return None
+    
+    tls = {"enabled": True, "server_name": params.get("sni") or params.get("peer") or params.get("host") or server}
+    if params.get("alpn"):
+        tls["alpn"] = [a.strip() for a in params["alpn"].split(",") if a.strip()]
+    if params.get("allowInsecure") in ("1", "true"):
+        tls["insecure"] = True
+    if params.get("fp"):
+        tls["utls"] = {"enabled": True, "fingerprint": params["fp"]}
+    if security == "reality":
+        tls["reality"] = {"enabled": True, "public_key": params.get("pbk", ""), "short_id": params.get("sid", "")}
+        # REALITY only works with a uTLS ClientHello
+        tls.setdefault("utls", {"enabled": True, "fingerprint": "chrome"})
+    return tls
+
+def link_transport(params):
+    """sing-box transport object from link parameters, or None for raw TCP"""
+    kind = params.get("type") or params.get("net") or "tcp"
+    host = params.get("host")
+    path = params.get("path")
+    
+    if kind == "ws":
+        transport = {"type": "ws", "path": path or "/"}
+        if host:
+            transport["headers"] = {"Host": host}
+        # Xray-style early data: /path?ed=2048
+        if "?ed=" in transport["path"]:
+            transport["path"], early = transport["path"].split("?ed=", 1)
+            if early.isdigit():
+                transport["max_early_data"] = int(early)
+                transport["early_data_header_name"] = "Sec-WebSocket-Protocol"
+        return transport
+    elif kind == "grpc":
+        return {"type": "grpc", "service_name": params.get("serviceName") or path or ""}
+    elif kind in ("http", "h2"):
+        transport = {"type": "http"}
+        if host:
+            transport["host"] = [h.strip() for h in host.split(",")]
+        if path:
+            transport["path"] = path
+        return transport
+    elif kind == "httpupgrade":
+        transport = {"type": "httpupgrade", "path": path or "/"}
+        if host:
+            transport["host"] = host
+        return transport
+    return None
+
+def add_tls_transport(config, params, security="none"):
+    """Attach tls and transport objects when the link asks for them"""
+    tls = link_tls(params, config["server"], security)
+    if tls:
+        config["tls"] = tls
+    transport = link_transport(params)
+    if transport:
+        config["transport"] = transport
+    return config
+
 def parse_vless(link):
     """Parse VLESS link"""
     try:
         parsed = urlparse(link)
-        params = parse_qs(parsed.query)
+        params = query_params(parsed.query)
         
         config = {
             "type": "vless",
             "server": parsed.hostname,
-            "port": parsed.port or 443,
-            "uuid": parsed.username,
-            "security": "tls",
-            "sni": params.get("sni", [parsed.hostname])[0],
-            "type": params.get("type", ["tcp"])[0],
-            "host": params.get("host", [parsed.hostname])[0]
+            "server_port": parsed.port or 443,
+            "uuid": unquote(parsed.username)
         }
+        if params.get("flow"):
+            config["flow"] = params["flow"]
         
-        if "path" in params:
-            config["path"] = unquote(params["path"][0])
-        
-        return config
+        return add_tls_transport(config, params)
     except Exception as e:
         log_message("ERROR", f"Failed to parse VLESS: {e}")
         return None
@@ -174,14 +447,22 @@ def parse_vmess(link):
             decoded = base64.b64decode(encoded).decode()
             config = json.loads(decoded)
             
-            return {
+            outbound = {
                 "type": "vmess",
                 "server": config.get("add"),
-                "port": int(config.get("port", 443)),
+                "server_port": int(config.get("port", 443)),
                 "uuid": config.get("id"),
-                "security": config.get("scy", "auto"),
-                "alterId": int(config.get("aid", 0))
+                "security": config.get("scy") or "auto",
+                "alter_id": int(config.get("aid") or 0)
             }
+            
+            # Same meaning as the URL parameters of the other links
+            params = {key: str(config[field]) for key, field in (
+                ("security", "tls"), ("sni", "sni"), ("alpn", "alpn"), ("fp", "fp"),
+                ("net", "net"), ("host", "host"), ("path", "path")) if config.get(field)}
+            if params.get("net") == "grpc":
+                params["serviceName"] = params.pop("path", "")
+            return add_tls_transport(outbound, params)
     except Exception as e:
         log_message("ERROR", f"Failed to parse VMess: {e}")
     return None
@@ -190,16 +471,17 @@ def parse_trojan(link):
     """Parse Trojan link"""
     try:
         parsed = urlparse(link)
+        params = query_params(parsed.query)
         
         config = {
             "type": "trojan",
             "server": parsed.hostname,
-            "port": parsed.port or 443,
-            "password": parsed.username,
-            "sni": parsed.hostname
+            "server_port": parsed.port or 443,
+            "password": unquote(parsed.username)
         }
         
-        return config
+        # Trojan is TLS unless the link says otherwise
+        return add_tls_transport(config, params, security="tls")
     except Exception as e:
         log_message("ERROR", f"Failed to parse Trojan: {e}")
         return None
@@ -208,290 +490,3323 @@ def parse_shadowsocks(link):
     """Parse ShadowSocks link"""
     try:
         if link.startswith("ss://"):
-            # Handle both plain and encoded formats
-            if "#" in link:
-                encoded_part = link[5:].split("#")[0]
-            else:
-                encoded_part = link[5:]
-            
-            # Decode base64
-            missing_padding = len(encoded_part) % 4
-            if missing_padding:
-                encoded_part += '=' * (4 - missing_padding)
+            body = link[5:].split("#")[0]
             
-            decoded = base64.b64decode(encoded_part).decode()
+            if "@" in body:
+                # SIP002: ss://base64(method:password)@server:port/?plugin=...
+                parsed = urlparse(link.split("#")[0])
+                userinfo = unquote(parsed.username or "")
+                if ":" not in userinfo:
+                    missing_padding = len(userinfo) % 4
+                    userinfo = base64.urlsafe_b64decode(userinfo + "=" * (4 - missing_padding if missing_padding else 0)).decode()
+                method, password = userinfo.split(":", 1)
+                server, port = parsed.hostname, parsed.port
+                plugin = query_params(parsed.query).get("plugin")
+            else:
+                # Legacy: ss://base64(method:password@server:port)
+                missing_padding = len(body) % 4
+                if missing_padding:
+                    body += '=' * (4 - missing_padding)
+                decoded = base64.b64decode(body).decode()
+                method_password, server_port = decoded.rsplit("@", 1)
+                method, password = method_password.split(":", 1)
+                server, port = server_port.rsplit(":", 1)
+                plugin = None
             
-            # Parse method:password@server:port
-            if "@" in decoded:
-                method_password, server_port = decoded.split("@")
-                method, password = method_password.split(":")
-                server, port = server_port.split(":")
-                
-                return {
-                    "type": "shadowsocks",
-                    "server": server,
-                    "port": int(port),
-                    "method": method,
-                    "password": password
-                }
+            config = {
+                "type": "shadowsocks",
+                "server": server,
+                "server_port": int(port),
+                "method": method,
+                "password": password
+            }
+            if plugin:
+                # plugin=obfs-local;obfs=http;obfs-host=example.com
+                name, _, opts = plugin.partition(";")
+                config["plugin"] = name
+                if opts:
+                    config["plugin_opts"] = opts
+            return config
     except Exception as e:
         log_message("ERROR", f"Failed to parse ShadowSocks: {e}")
     return None
 
 # ========== CONFIG BUILDER ==========
-def build_singbox_config(profile_data):
-    """Build advanced sing-box configuration"""
-    
-    proto_config = None
-    
-    # Parse based on protocol
-    if profile_data["protocol"] == "vless":
-        proto_config = parse_vless(profile_data["link"])
-    elif profile_data["protocol"] == "vmess":
-        proto_config = parse_vmess(profile_data["link"])
-    elif profile_data["protocol"] == "trojan":
-        proto_config = parse_trojan(profile_data["link"])
-    elif profile_data["protocol"] == "shadowsocks":
-        proto_config = parse_shadowsocks(profile_data["link"])
-    
-    if not proto_config:
-        # Fallback to URL method
-        cfg = {
-            "log": {"level": "warn", "timestamp": True},
-            "dns": {
-                "servers": [
-                    "1.1.1.1",
-                    "8.8.8.8",
-                    "local"
-                ],
-                "strategy": "ipv4_only"
+def singbox_template(proxy):
+    """The fixed part of every config around the given proxy outbound, no local settings applied"""
+    return {
+        "log": {"level": "warn", "timestamp": True, "disable_color": True},
+        "dns": {
+            "servers": [
+                "1.1.1.1",
+                "8.8.8.8",
+                "local"
+            ],
+            "strategy": "prefer_ipv4",
+            "fakeip": {
+                "enabled": True,
+                "inet4_range": FAKEIP_INET4
+            }
+        },
+        "inbounds": [
+            {
+                "type": "tun",
+                "interface_name": "ragevpn0",
+                "inet4_address": TUN_INET4,
+                "mtu": 1500,
+                "auto_route": True,
+                "strict_route": True,
+                "stack": "mixed"
+            }
+        ],
+        "outbounds": [
+            proxy,
+            {
+                "type": "direct",
+                "tag": "direct"
             },
-            "inbounds": [
+            {
+                "type": "block",
+                "tag": "block"
+            }
+        ],
+        "route": {
+            "auto_detect_interface": True,
+            "rules": [
                 {
-                    "type": "tun",
-                    "interface_name": "ragevpn0",
-                    "inet4_address": "172.19.0.1/30",
-                    "mtu": 1500,
-                    "auto_route": True,
-                    "strict_route": True,
-                    "stack": "mixed"
-                }
-            ],
-            "outbounds": [
+                    "protocol": "dns",
+                    "outbound": "direct"
+                },
                 {
-                    "type": profile_data["protocol"],
-                    "tag": "proxy",
-                    "url": profile_data["link"]
+                    "domain_suffix": [".local", ".lan"],
+                    "outbound": "direct"
                 },
                 {
-                    "type": "direct",
-                    "tag": "direct"
+                    "geoip": ["private", "cn"],
+                    "outbound": "direct"
                 },
                 {
-                    "type": "block",
-                    "tag": "block"
+                    "outbound": "proxy",
+                    "network": "tcp,udp"
                 }
-            ],
-            "route": {
-                "auto_detect_interface": True,
-                "rules": [
-                    {
-                        "protocol": "dns",
-                        "outbound": "direct"
-                    },
-                    {
-                        "domain_suffix": [".local", ".lan"],
-                        "outbound": "direct"
-                    },
-                    {
-                        "geoip": ["private", "cn"],
-                        "outbound": "direct"
-                    },
-                    {
-                        "outbound": "proxy",
-                        "network": "tcp,udp"
-                    }
-                ]
-            }
+            ]
         }
+    }
+
+def build_singbox_config(profile_data):
+    """Build advanced sing-box configuration"""
+    
+    # Parse based on protocol
+    if isinstance(profile_data, Profile):
+        proto_config = profile_data.outbound
+    else:
+        proto_config = profile_data.get("outbound") or parse_link(profile_data["protocol"], profile_data["link"])
+    
+    if not proto_config:
+        # Fallback to URL method
+        cfg = singbox_template({"type": profile_data["protocol"], "tag": "proxy", "url": profile_data["link"]})
     else:
         # Build config from parsed data
-        cfg = {
-            "log": {"level": "warn", "timestamp": True},
-            "dns": {
-                "servers": [
-                    "1.1.1.1",
-                    "8.8.8.8",
-                    "local"
-                ],
-                "strategy": "ipv4_only"
-            },
-            "inbounds": [
-                {
-                    "type": "tun",
-                    "interface_name": "ragevpn0",
-                    "inet4_address": "172.19.0.1/30",
-                    "mtu": 1500,
-                    "auto_route": True,
-                    "strict_route": True,
-                    "stack": "mixed"
-                }
-            ],
-            "outbounds": [
-                {
-                    "type": proto_config["type"],
-                    "tag": "proxy",
-                    **proto_config
-                },
-                {
-                    "type": "direct",
-                    "tag": "direct"
-                },
-                {
-                    "type": "block",
-                    "tag": "block"
-                }
-            ],
-            "route": {
-                "auto_detect_interface": True,
-                "rules": [
-                    {
-                        "protocol": "dns",
-                        "outbound": "direct"
-                    },
-                    {
-                        "domain_suffix": [".local", ".lan"],
-                        "outbound": "direct"
-                    },
-                    {
-                        "geoip": ["private", "cn"],
-                        "outbound": "direct"
-                    },
-                    {
-                        "outbound": "proxy",
-                        "network": "tcp,udp"
-                    }
-                ]
+        cfg = singbox_template({"type": proto_config["type"], "tag": "proxy", **proto_config})
+    
+    # Per-profile tun parameters
+    apply_tun_params(cfg, profile_data.get("mtu"), profile_data.get("stack"))
+    apply_dial_options(cfg["outbounds"][0], profile_data.get("multiplex"), profile_data.get("tcp_fast_open"))
+    
+    # IPv6 on the tun, and the profile's faster address family first
+    apply_address_family(cfg, profile_data)
+    
+    # Server address resolved ahead of time, if pinning is on
+    apply_server_address(cfg, profile_data)
+    
+    # Local API for the connections view
+    enable_clash_api(cfg)
+    
+    # Warm restarts: fakeip mappings and DNS results survive a reconnect
+    apply_cache_file(cfg, profile_data)
+    
+    # Cached geo rule-sets instead of sing-box's own download
+    apply_geo_data(cfg)
+    
+    # User bypass / force-proxy lists
+    apply_rule_sets(cfg, compile_rule_sets())
+    
+    return cfg
+
+def apply_tun_params(cfg, mtu=None, stack=None):
+    """Set MTU and network stack on the tun inbound, falling back to defaults"""
+    try:
+        mtu = min(max(int(mtu), 576), 9000) if mtu else DEFAULT_MTU
+    except (TypeError, ValueError):
+        mtu = DEFAULT_MTU
+    if stack not in TUN_STACKS:
+        stack = "mixed"
+    
+    for inbound in cfg["inbounds"]:
+        if inbound["type"] == "tun":
+            inbound["mtu"] = mtu
+            inbound["stack"] = stack
+    return cfg
+
+MULTIPLEX_PROTOCOLS = ("smux", "yamux", "h2mux")
+
+def apply_dial_options(outbound, multiplex=None, tcp_fast_open=False):
+    """Add multiplex and TCP Fast Open to the proxy outbound
+    
+    multiplex is the profile's {"protocol", "max_connections", "padding"}
+    or None. sing-box cannot multiplex a VLESS flow, so that is skipped.
+    """
+    if tcp_fast_open:
+        outbound["tcp_fast_open"] = True
+    
+    if multiplex and multiplex.get("protocol") in MULTIPLEX_PROTOCOLS:
+        if outbound.get("flow"):
+            log_message("WARN", f"Multiplex ignored: not supported with flow {outbound['flow']}")
+        elif outbound["type"] in ("vless", "vmess", "trojan", "shadowsocks"):
+            outbound["multiplex"] = {
+                "enabled": True,
+                "protocol": multiplex["protocol"],
+                "max_connections": int(multiplex.get("max_connections", 4)),
+                "padding": bool(multiplex.get("padding", False))
+            }
+    return outbound
+
+# sing-box's persistent cache (fakeip mappings, rejected DNS responses,
+# selector choices) kept across restarts, one file per profile or per
+# profile "cache_group"
+CACHE_FILES = os.path.join(CACHE, "singbox")
+
+def singbox_version_info(version=None):
+    """(major, minor, patch) from a "sing-box version X.Y.Z" string, or None"""
+    match = re.search(r"(\d+)\.(\d+)\.(\d+)", version or SINGBOX_VERSION or "")
+    return tuple(int(n) for n in match.groups()) if match else None
+
+def cache_file_path(profile):
+    """Cache file shared by the profile's cache_group, or its own"""
+    scope = profile.get("cache_group") or profile["name"]
+    slug = re.sub(r"[^\w.-]+", "_", scope)[:40]
+    return os.path.join(CACHE_FILES, f"{slug}-{hashlib.sha1(scope.encode()).hexdigest()[:8]}.db")
+
+def prune_cache_files(settings, keep=None):
+    """Drop oversized cache files and all but the most recently used ones"""
+    try:
+        entries = sorted(os.scandir(CACHE_FILES), key=lambda e: e.stat().st_mtime, reverse=True)
+    except OSError:
+        return []
+    max_bytes = settings["cache_file_max_mb"] * 1024 * 1024
+    removed = []
+    kept = 0
+    for entry in entries:
+        if not entry.name.endswith(".db"):
+            continue
+        size = entry.stat().st_size
+        if size <= max_bytes and (entry.path == keep or kept < settings["cache_files_keep"]):
+            kept += entry.path != keep
+            continue
+        try:
+            os.remove(entry.path)
+            removed.append(entry.path)
+            log_message("INFO", f"Removed sing-box cache {entry.name} ({format_bytes(size)})")
+        except OSError:
+            pass
+    return removed
+
+def apply_cache_file(cfg, profile, settings=None, path=None):
+    """Enable sing-box's cache file for the profile, within the size limits
+    
+    An explicit path (benchmarks) is used as is and nothing is pruned.
+    """
+    settings = settings or load_settings()
+    if not settings["cache_file"]:
+        return cfg
+    if path is None:
+        path = cache_file_path(profile)
+        os.makedirs(CACHE_FILES, exist_ok=True)
+        prune_cache_files(settings, keep=path)
+    
+    cache = {"enabled": True, "path": path, "store_fakeip": True}
+    version = singbox_version_info()
+    if version and version >= (1, 9, 0):
+        cache["store_rdrc"] = True
+    cfg.setdefault("experimental", {})["cache_file"] = cache
+    return cfg
+
+# ========== ADDRESS FAMILY ==========
+# The tun carries both IPv4 and IPv6. Which family DNS answers and the
+# connection to the server prefer comes from the dns_strategy setting or,
+# by default, from racing IPv4 against IPv6 connects to each profile's
+# server and remembering the faster one on the profile.
+TUN_INET4 = "172.19.0.1/30"
+TUN_INET6 = "fdfe:dcba:9876::1/126"
+FAKEIP_INET4 = "198.18.0.0/15"
+FAKEIP_INET6 = "fc00::/18"
+DNS_STRATEGIES = ("prefer_ipv4", "prefer_ipv6", "ipv4_only", "ipv6_only")
+FAMILY_STRATEGIES = {"ipv4": "prefer_ipv4", "ipv6": "prefer_ipv6"}
+FAMILIES = {"ipv4": socket.AF_INET, "ipv6": socket.AF_INET6}
+
+def dns_strategy(profile, settings):
+    """The dns_strategy setting, or the strategy for the profile's faster family"""
+    if settings["dns_strategy"] in DNS_STRATEGIES:
+        return settings["dns_strategy"]
+    return FAMILY_STRATEGIES.get(profile.get("address_family"), "prefer_ipv4")
+
+def apply_address_family(cfg, profile, settings=None):
+    """Dual-stack tun and fakeip ranges, DNS strategy and the server's address family"""
+    settings = settings or load_settings()
+    strategy = dns_strategy(profile, settings)
+    ipv6 = settings["tun_ipv6"] and strategy != "ipv4_only"
+    
+    cfg["dns"]["strategy"] = strategy
+    if ipv6 and "fakeip" in cfg["dns"]:
+        cfg["dns"]["fakeip"]["inet6_range"] = FAKEIP_INET6
+    for inbound in cfg["inbounds"]:
+        if inbound["type"] == "tun" and ipv6:
+            inbound["inet6_address"] = TUN_INET6
+    # The server's own name is resolved outside the tunnel, with the same preference
+    proxy = cfg["outbounds"][0]
+    if "server" in proxy:
+        proxy.setdefault("domain_strategy", strategy)
+    return cfg
+
+def family_addresses(host, port):
+    """{"ipv4": sockaddr, "ipv6": sockaddr}, the first address of each family host has"""
+    try:
+        infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return {}
+    addresses = {}
+    for family, _, _, _, sockaddr in infos:
+        for name, number in FAMILIES.items():
+            if family == number:
+                addresses.setdefault(name, sockaddr)
+    return addresses
+
+def race_connect(addresses, timeout):
+    """Connect to every {key: sockaddr} at once; {key: connect ms, None if it failed}
+    
+    Like a Happy Eyeballs client, except the slower attempts are allowed to
+    finish so every address gets a time.
+    """
+    results = dict.fromkeys(addresses)
+    sel = selectors.DefaultSelector()
+    sockets = []
+    start = time.perf_counter()
+    try:
+        for name, sockaddr in addresses.items():
+            sock = socket.socket(socket.AF_INET6 if len(sockaddr) == 4 else socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setblocking(False)
+            # Fails right away without a route, e.g. no IPv6 uplink
+            if sock.connect_ex(sockaddr) in (0, errno.EINPROGRESS):
+                sel.register(sock, selectors.EVENT_WRITE, name)
+        
+        deadline = start + timeout
+        while sel.get_map():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            for key, _ in sel.select(remaining):
+                sel.unregister(key.fileobj)
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    results[key.data] = (time.perf_counter() - start) * 1000
+    finally:
+        sel.close()
+        for sock in sockets:
+            sock.close()
+    return results
+
+def race_address_family(host, port, rounds=3, timeout=1.0):
+    """Race IPv4 and IPv6 connects to a server
+    
+    Returns {"family", "ipv4_ms", "ipv6_ms", "error"}: median connect times
+    and the faster family, or the only one that connected.
+    """
+    result = {"family": None, "ipv4_ms": None, "ipv6_ms": None, "error": None}
+    if not host or not port:
+        result["error"] = "no server address"
+        return result
+    addresses = family_addresses(host, port)
+    if not addresses:
+        result["error"] = f"cannot resolve {host}"
+        return result
+    
+    samples = {name: [] for name in addresses}
+    for _ in range(rounds):
+        times = race_connect(addresses, timeout)
+        if not any(ms is not None for ms in times.values()) and not any(samples.values()):
+            break  # Unreachable, no point in waiting out more rounds
+        for name, ms in times.items():
+            if ms is not None:
+                samples[name].append(ms)
+    
+    for name, values in samples.items():
+        if values:
+            result[f"{name}_ms"] = percentile(values, 50)
+    timed = {name: result[f"{name}_ms"] for name in FAMILIES if result[f"{name}_ms"] is not None}
+    if timed:
+        result["family"] = min(timed, key=timed.get)
+    else:
+        result["error"] = f"no connect to {host}:{port} ({'/'.join(addresses)})"
+    return result
+
+def race_due(profile, settings):
+    """Whether the profile's family race is missing or older than family_race_hours"""
+    if settings["dns_strategy"] in DNS_STRATEGIES or not settings["family_race_hours"]:
+        return False
+    checked = (profile.get("family_race") or {}).get("checked", 0)
+    return time.time() - checked > settings["family_race_hours"] * 3600
+
+def race_profile_family(profile, rounds=3):
+    """Race the profile's server and record the faster family on it (not saved)"""
+    host, port = profile_endpoint(profile)
+    result = race_address_family(host, port, rounds)
+    if result["family"]:
+        profile["address_family"] = result["family"]
+    profile["family_race"] = {"ipv4_ms": result["ipv4_ms"], "ipv6_ms": result["ipv6_ms"],
+                              "checked": time.time()}
+    log_message("INFO", f"Address family race for {profile['name']}: {format_family_race(result)}")
+    return result
+
+def format_family_race(result):
+    """IPv4 / IPv6 connect times and the pick"""
+    if result["error"]:
+        return result["error"]
+    times = ", ".join(f"{name} {result[f'{name}_ms']:.1f} ms" if result[f"{name}_ms"] is not None else f"{name} n/a"
+                      for name in FAMILIES)
+    return f"{times} -> {result['family']}"
+
+# ========== SERVER RESOLVER ==========
+# Server hostnames resolved ahead of time in the background: A/AAAA from
+# our own DNS client (getaddrinfo hides TTLs), every address raced for
+# the fastest connect, kept in CACHE/resolved.json until the TTL runs
+# out. With pin_server_address a fresh entry replaces the outbound's
+# server and the hostname stays on as TLS SNI and transport Host.
+RESOLVED_CACHE = os.path.join(CACHE, "resolved.json")
+DNS_TYPES = {"A": 1, "AAAA": 28}
+DNS_CNAME = 5
+DNS_NEGATIVE_TTL = 60  # Seconds to remember a name without addresses
+
+resolve_lock = threading.Lock()
+resolving = set()  # Hostnames queued or being resolved
+
+def dns_server_address(server):
+    """(host, port) from "1.1.1.1", "127.0.0.1:5353" or "[::1]:53" """
+    parsed = urlparse(f"dns://{server}")
+    return parsed.hostname, parsed.port or 53
+
+def dns_packet(name, qtype, query_id):
+    """Recursive query for one name and type"""
+    labels = name.rstrip(".").encode("idna").split(b".")
+    return (struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+            + b"".join(bytes([len(label)]) + label for label in labels) + b"\0"
+            + struct.pack("!HH", DNS_TYPES[qtype], 1))
+
+def dns_skip_name(data, offset):
+    """Offset just past a (possibly compressed) name"""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+def parse_dns_response(data, qtype):
+    """([addresses], ttl) from a response; ttl is the smallest in the answer chain"""
+    try:
+        _, flags, questions, answers, _, _ = struct.unpack_from("!HHHHHH", data)
+        if flags & 0xF == 3:  # NXDOMAIN
+            return [], DNS_NEGATIVE_TTL
+        if flags & 0xF:
+            raise ValueError(f"DNS error code {flags & 0xF}")
+        offset = 12
+        for _ in range(questions):
+            offset = dns_skip_name(data, offset) + 4
+        addresses, ttls = [], []
+        for _ in range(answers):
+            offset = dns_skip_name(data, offset)
+            rtype, _, ttl, length = struct.unpack_from("!HHIH", data, offset)
+            offset += 10
+            rdata = data[offset:offset + length]
+            offset += length
+            if rtype == qtype and len(rdata) in (4, 16):
+                addresses.append(socket.inet_ntop(socket.AF_INET if len(rdata) == 4 else socket.AF_INET6, rdata))
+                ttls.append(ttl)
+            elif rtype == DNS_CNAME:
+                ttls.append(ttl)
+    except (struct.error, IndexError):
+        raise ValueError("malformed DNS response")
+    return addresses, min(ttls) if ttls else DNS_NEGATIVE_TTL
+
+def resolve_host(name, servers, qtypes=("A", "AAAA"), timeout=2.0):
+    """Ask every server for every type at once; the first answer per type wins
+    
+    Returns {"addresses", "ttl", "server"}, the server being the one that
+    answered first. Raises ValueError when nothing answered.
+    """
+    sel = selectors.DefaultSelector()
+    answers = {}  # qtype -> (addresses, ttl, server)
+    try:
+        for server in servers:
+            host, port = dns_server_address(server)
+            for qtype in qtypes:
+                sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                query_id = random.getrandbits(16)
+                try:
+                    sock.sendto(dns_packet(name, qtype, query_id), (host, port))
+                except OSError:
+                    sock.close()
+                    continue
+                sel.register(sock, selectors.EVENT_READ, (server, qtype, struct.pack("!H", query_id)))
+        
+        deadline = time.monotonic() + timeout
+        while sel.get_map() and len(answers) < len(qtypes):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in sel.select(remaining):
+                server, qtype, query_id = key.data
+                try:
+                    data = key.fileobj.recv(4096)
+                    if data[:2] != query_id:
+                        continue  # Not our query, keep listening
+                    result = parse_dns_response(data, DNS_TYPES[qtype])
+                except (OSError, ValueError):
+                    result = None
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+                if result and qtype not in answers:
+                    answers[qtype] = (*result, server)
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+    
+    if not answers:
+        raise ValueError(f"no DNS answer for {name}")
+    addresses = [a for qtype in qtypes if qtype in answers for a in answers[qtype][0]]
+    ttls = [ttl for found, ttl, _ in answers.values() if found] or [ttl for _, ttl, _ in answers.values()]
+    first = next(answers[qtype][2] for qtype in qtypes if qtype in answers)
+    return {"addresses": addresses, "ttl": min(ttls), "server": first}
+
+def load_resolved():
+    """{hostname: {addresses, times, fastest, port, ttl, server, resolved, expires}}"""
+    try:
+        with open(RESOLVED_CACHE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def resolve_server(host, port, servers, timeout=2.0):
+    """Cache entry for one server: its addresses and the one that connects fastest"""
+    now = time.time()
+    entry = {"port": port, "resolved": now, "fastest": None, "times": {}}
+    try:
+        entry.update(resolve_host(host, servers, timeout=timeout))
+    except ValueError as e:
+        entry.update(addresses=[], ttl=DNS_NEGATIVE_TTL, server=None, error=str(e))
+    if entry["addresses"]:
+        targets = {a: (a, port, 0, 0) if ":" in a else (a, port) for a in entry["addresses"]}
+        entry["times"] = race_connect(targets, timeout)
+        connected = {a: ms for a, ms in entry["times"].items() if ms is not None}
+        if connected:
+            entry["fastest"] = min(connected, key=connected.get)
+    entry["expires"] = now + entry["ttl"]
+    return entry
+
+def resolve_many(endpoints, servers, concurrency=16):
+    """{hostname: entry} for {hostname: port}, concurrency lookups at a time"""
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(endpoints)))) as pool:
+        return dict(zip(endpoints, pool.map(lambda item: resolve_server(*item, servers), endpoints.items())))
+
+def resolve_servers(endpoints, servers=None, concurrency=16):
+    """Resolve {hostname: port} concurrently and merge the entries into RESOLVED_CACHE"""
+    entries = resolve_many(endpoints, servers or load_settings()["resolver_servers"], concurrency)
+    
+    with resolve_lock:
+        cache = load_resolved()
+        now = time.time()
+        # Long expired names of deleted profiles go
+        cache = {host: entry for host, entry in cache.items() if entry["expires"] > now - 86400}
+        cache.update(entries)
+        tmp = RESOLVED_CACHE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, RESOLVED_CACHE)
+    for host, entry in entries.items():
+        if entry["fastest"]:
+            log_message("INFO", f"Resolved {host}: {entry['fastest']} of {len(entry['addresses'])}, ttl {entry['ttl']}s")
+        else:
+            log_message("WARN", f"Resolving {host}: {entry.get('error') or 'no address connected'}")
+    return entries
+
+def server_endpoints(profiles):
+    """{hostname: port} of the profiles' servers, IP addresses left out"""
+    endpoints = {}
+    for profile in profiles:
+        host, port = profile_endpoint(profile)
+        if not host or not port:
+            continue
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            endpoints.setdefault(host, port)
+    return endpoints
+
+def start_resolve(endpoints=None):
+    """Resolve missing or expired server names in a background thread"""
+    endpoints = server_endpoints(load_profiles()) if endpoints is None else dict(endpoints)
+    cache = load_resolved()
+    now = time.time()
+    with resolve_lock:
+        endpoints = {host: port for host, port in endpoints.items()
+                     if host not in resolving and cache.get(host, {}).get("expires", 0) <= now}
+        if not endpoints:
+            return None
+        resolving.update(endpoints)
+    
+    def run():
+        try:
+            resolve_servers(endpoints)
+        finally:
+            with resolve_lock:
+                resolving.difference_update(endpoints)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def pinned_address(entry, strategy):
+    """Fastest address of an entry the DNS strategy allows"""
+    times = {a: ms for a, ms in entry["times"].items() if ms is not None}
+    if strategy == "ipv4_only":
+        times = {a: ms for a, ms in times.items() if ":" not in a}
+    elif strategy == "ipv6_only":
+        times = {a: ms for a, ms in times.items() if ":" in a}
+    return min(times, key=times.get) if times else None
+
+def apply_server_address(cfg, profile, settings=None):
+    """Put the cached address of the server into the proxy outbound
+    
+    The hostname moves to TLS server_name and the transport Host where
+    those are not set. Without a fresh entry the name stays and a
+    background lookup is queued.
+    """
+    settings = settings or load_settings()
+    proxy = cfg["outbounds"][0]
+    host = proxy.get("server")
+    if not settings["pin_server_address"] or not host:
+        return cfg
+    try:
+        ipaddress.ip_address(host)
+        return cfg
+    except ValueError:
+        pass
+    
+    entry = load_resolved().get(host)
+    address = pinned_address(entry, dns_strategy(profile, settings)) if entry and entry["expires"] > time.time() else None
+    if not address:
+        start_resolve({host: proxy.get("server_port") or 443})
+        return cfg
+    
+    proxy["server"] = address
+    # Copies, the nested objects may be shared with the profile's parsed outbound
+    if (proxy.get("tls") or {}).get("enabled"):
+        proxy["tls"] = {"server_name": host, **proxy["tls"]}
+    transport = dict(proxy.get("transport") or {})
+    if transport.get("type") == "ws":
+        transport["headers"] = {"Host": host, **transport.get("headers", {})}
+    elif transport.get("type") in ("http", "httpupgrade") and not transport.get("host"):
+        transport["host"] = [host] if transport["type"] == "http" else host
+    if transport:
+        proxy["transport"] = transport
+    return cfg
+
+def serve_stub_dns(records, port=0, host="127.0.0.1", delay=0.0):
+    """Local DNS stand-in for testing the resolver
+    
+    records maps names to {"A": [...], "AAAA": [...], "ttl": seconds};
+    other names get NXDOMAIN. delay is added before each answer.
+    """
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            data, sock = self.request
+            try:
+                offset = 12
+                labels = []
+                while data[offset]:
+                    labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+                    offset += data[offset] + 1
+                qtype, = struct.unpack_from("!H", data, offset + 1)
+            except (IndexError, struct.error, UnicodeDecodeError):
+                return
+            question = data[12:offset + 5]
+            record = records.get(".".join(labels).lower())
+            kind = next((k for k, v in DNS_TYPES.items() if v == qtype), None)
+            found = record.get(kind, []) if record and kind else []
+            answer = b"".join(struct.pack("!HHHIH", 0xC00C, qtype, 1, record.get("ttl", 300), 16 if qtype == 28 else 4)
+                              + socket.inet_pton(socket.AF_INET6 if qtype == 28 else socket.AF_INET, address)
+                              for address in found)
+            flags = 0x8180 if record else 0x8183
+            time.sleep(delay)
+            sock.sendto(data[:2] + struct.pack("!HHHHH", flags, 1, len(found), 0, 0) + question + answer,
+                        self.client_address)
+    
+    server = socketserver.ThreadingUDPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchmark_resolve(count=200, delay=0.02, concurrency=16):
+    """Resolve count names against a local stub DNS answering after delay, one at a time and concurrently"""
+    target = serve_reply(0)
+    port = target.server_address[1]
+    names = [f"node{i}.ragevpn.test" for i in range(count)]
+    dns = serve_stub_dns({name: {"A": ["127.0.0.1"], "AAAA": ["::1"], "ttl": 300} for name in names}, delay=delay)
+    servers = [f"127.0.0.1:{dns.server_address[1]}"]
+    endpoints = dict.fromkeys(names, port)
+    results = {}
+    try:
+        for label, workers in (("serial", 1), ("concurrent", concurrency)):
+            start = time.perf_counter()
+            entries = resolve_many(endpoints, servers, workers)
+            seconds = time.perf_counter() - start
+            results[label] = {
+                "seconds": seconds,
+                "per_second": count / seconds,
+                "pinned": sum(e["fastest"] is not None for e in entries.values()),
+                "ttl": min(e["ttl"] for e in entries.values())
             }
+    finally:
+        dns.shutdown()
+        target.shutdown()
+    return results
+
+# ========== RULE SETS ==========
+# Plain-text lists live in ~/.ragevpn/rules/<list>/*.txt, one entry per line:
+#   example.com, .example.com, +.example.com, domain:example.com  -> domain suffix
+#   full:example.com                                              -> exact domain
+#   10.0.0.0/8, 2001:db8::/32, 192.0.2.1                          -> CIDR
+RULE_LISTS = {
+    "proxy": "proxy",    # Force through the tunnel, checked first
+    "bypass": "direct"
+}
+RULE_SET_CACHE = os.path.join(CACHE, "rules")
+
+def parse_rule_line(line):
+    """Classify one list entry as ("cidr"|"domain"|"suffix", value)"""
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    
+    # hosts-file style "0.0.0.0 example.com"
+    if " " in line or "\t" in line:
+        line = line.split()[-1]
+    
+    try:
+        return "cidr", str(ipaddress.ip_network(line, strict=False))
+    except ValueError:
+        pass
+    
+    line = line.lower()
+    if line.startswith("full:"):
+        return "domain", line[5:].strip(".")
+    for prefix in ("domain:", "+.", "."):
+        if line.startswith(prefix):
+            line = line[len(prefix):]
+            break
+    line = line.strip(".")
+    return ("suffix", line) if line else None
+
+def parse_rule_file(path):
+    """Parse a source list into deduplicated entries"""
+    entries = {"cidr": set(), "domain": set(), "suffix": set()}
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            entry = parse_rule_line(line)
+            if entry:
+                entries[entry[0]].add(entry[1])
+    return {kind: sorted(values) for kind, values in entries.items()}
+
+def collapse_domains(suffixes, domains):
+    """Drop suffixes and exact domains already covered by a shorter suffix"""
+    kept = set()
+    # Shortest first, so parents are in place before their children
+    for suffix in sorted(set(suffixes), key=lambda d: d.count(".")):
+        labels = suffix.split(".")
+        if not any(".".join(labels[i:]) in kept for i in range(1, len(labels))):
+            kept.add(suffix)
+    
+    exact = set()
+    for domain in set(domains):
+        labels = domain.split(".")
+        if not any(".".join(labels[i:]) in kept for i in range(len(labels))):
+            exact.add(domain)
+    
+    return sorted(kept), sorted(exact)
+
+def collapse_cidrs(cidrs):
+    """Merge overlapping and adjacent networks into a minimal set"""
+    v4, v6 = [], []
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr, strict=False)
+        (v4 if network.version == 4 else v6).append(network)
+    return [str(n) for n in ipaddress.collapse_addresses(v4)] + \
+           [str(n) for n in ipaddress.collapse_addresses(v6)]
+
+def compile_rule_sets(force=False):
+    """Compile changed source lists into sing-box rule-set files
+    
+    Returns {list_name: rule-set path} for every non-empty list.
+    """
+    os.makedirs(RULE_SET_CACHE, exist_ok=True)
+    state_file = os.path.join(RULE_SET_CACHE, "state.json")
+    try:
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    
+    compiled = {}
+    dirty = False
+    for list_name in RULE_LISTS:
+        source_dir = os.path.join(RULES_DIR, list_name)
+        output = os.path.join(RULE_SET_CACHE, f"ragevpn-{list_name}.json")
+        old_files = state.get(list_name, {})
+        files = {}
+        
+        if os.path.isdir(source_dir):
+            for entry in sorted(os.scandir(source_dir), key=lambda e: e.name):
+                if entry.is_file() and entry.name.endswith((".txt", ".list")):
+                    st = entry.stat()
+                    files[entry.path] = {"mtime": st.st_mtime, "size": st.st_size}
+        
+        if not files:
+            if os.path.exists(output):
+                os.remove(output)
+            if state.pop(list_name, None) is not None:
+                dirty = True
+            continue
+        
+        unchanged = all(
+            old_files.get(path, {}).get("mtime") == meta["mtime"] and
+            old_files.get(path, {}).get("size") == meta["size"]
+            for path, meta in files.items()
+        ) and set(old_files) == set(files)
+        
+        if unchanged and not force and os.path.exists(output):
+            compiled[list_name] = output
+            continue
+        
+        # Re-parse only the files that changed, reuse the rest
+        merged = {"cidr": [], "domain": [], "suffix": []}
+        for path, meta in files.items():
+            parsed_cache = os.path.join(RULE_SET_CACHE, hashlib.sha1(path.encode()).hexdigest() + ".json")
+            old = old_files.get(path, {})
+            parsed = None
+            if not force and old.get("mtime") == meta["mtime"] and old.get("size") == meta["size"]:
+                try:
+                    with open(parsed_cache, "r") as f:
+                        parsed = json.load(f)
+                except (OSError, ValueError):
+                    parsed = None
+            if parsed is None:
+                parsed = parse_rule_file(path)
+                with open(parsed_cache, "w") as f:
+                    json.dump(parsed, f)
+            for kind in merged:
+                merged[kind].extend(parsed[kind])
+        
+        # Drop parse caches of removed files
+        for path in set(old_files) - set(files):
+            stale = os.path.join(RULE_SET_CACHE, hashlib.sha1(path.encode()).hexdigest() + ".json")
+            if os.path.exists(stale):
+                os.remove(stale)
+        
+        suffixes, domains = collapse_domains(merged["suffix"], merged["domain"])
+        cidrs = collapse_cidrs(merged["cidr"])
+        
+        rules = []
+        if domains or suffixes:
+            rule = {}
+            if domains:
+                rule["domain"] = domains
+            if suffixes:
+                rule["domain_suffix"] = suffixes
+            rules.append(rule)
+        if cidrs:
+            rules.append({"ip_cidr": cidrs})
+        
+        tmp = output + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "rules": rules}, f, separators=(",", ":"))
+        os.replace(tmp, output)
+        
+        state[list_name] = files
+        compiled[list_name] = output
+        dirty = True
+        log_message("INFO", f"Compiled rule-set {list_name}: {len(suffixes)} suffixes, "
+                            f"{len(domains)} domains, {len(cidrs)} CIDRs")
+    
+    if dirty:
+        with open(state_file, "w") as f:
+            json.dump(state, f)
+    
+    return compiled
+
+def apply_rule_sets(cfg, compiled):
+    """Reference compiled rule-sets from the route section"""
+    if not compiled:
+        return cfg
+    
+    route = cfg["route"]
+    route.setdefault("rule_set", [])
+    rules = []
+    for list_name, outbound in RULE_LISTS.items():
+        if list_name not in compiled:
+            continue
+        tag = f"ragevpn-{list_name}"
+        route["rule_set"].append({
+            "type": "local",
+            "tag": tag,
+            "format": "source",
+            "path": compiled[list_name]
+        })
+        rules.append({"rule_set": [tag], "outbound": outbound})
+    
+    # Right after the DNS rule, ahead of the built-in routing
+    route["rules"][1:1] = rules
+    return cfg
+
+# ========== GEO DATA ==========
+# geoip/geosite rules are served from local rule-set files instead of
+# sing-box's own database download. Files live in CACHE/geo as
+# <name>-<sha256 prefix>.<ext>, are never modified once written and are
+# listed in manifest.json, which is swapped atomically. Fetching happens in
+# a background thread only; a missing file drops its rule for that connect.
+GEO_CACHE = os.path.join(CACHE, "geo")
+GEO_MANIFEST = os.path.join(GEO_CACHE, "manifest.json")
+GEO_URLS = {
+    "geoip": "https://raw.githubusercontent.com/SagerNet/sing-geoip/rule-set/geoip-{code}.srs",
+    "geosite": "https://raw.githubusercontent.com/SagerNet/sing-geosite/rule-set/geosite-{code}.srs"
+}
+GEO_DEFAULTS = ("geoip-cn",)  # Referenced by the generated route
+GEO_KEEP_VERSIONS = 2         # Current plus previous, a running sing-box may still use it
+GEO_RETRY_DELAY = 600         # Seconds before retrying a failed fetch
+
+geo_lock = threading.Lock()
+geo_verified = set()   # Paths whose checksum matched this run
+geo_updating = set()   # Names queued or being fetched
+geo_failed = {}        # name -> time of the last failed fetch
+
+def load_geo_manifest():
+    """{name: {path, format, sha256, version, etag, source, updated, checked, previous}}"""
+    try:
+        with open(GEO_MANIFEST, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_geo_manifest(manifest):
+    """Replace the manifest in one step"""
+    tmp = GEO_MANIFEST + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, GEO_MANIFEST)
+
+def file_sha256(path):
+    """Hex SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def geo_format(path):
+    """sing-box rule-set format of a file ("binary" or "source"), or None"""
+    with open(path, "rb") as f:
+        head = f.read(3)
+        if head == b"SRS":
+            return "binary"
+        f.seek(0)
+        try:
+            data = json.load(f)
+        except ValueError:
+            return None
+    return "source" if isinstance(data, dict) and isinstance(data.get("rules"), list) else None
+
+def geo_url(name):
+    """Download URL for geoip-<code> / geosite-<code>, settings geo_urls first"""
+    override = load_settings()["geo_urls"].get(name)
+    if override:
+        return override
+    kind, _, code = name.partition("-")
+    return GEO_URLS[kind].format(code=code) if kind in GEO_URLS and code else None
+
+def store_geo_file(name, tmp_path, source, etag=None):
+    """Verify a fetched or seeded file and make it the current one for name
+    
+    tmp_path must be inside GEO_CACHE; it is consumed either way.
+    """
+    try:
+        fmt = geo_format(tmp_path)
+        if not fmt:
+            raise ValueError(f"{name}: not a sing-box rule-set")
+        sha = file_sha256(tmp_path)
+        path = os.path.join(GEO_CACHE, f"{name}-{sha[:16]}.{'srs' if fmt == 'binary' else 'json'}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    with geo_lock:
+        manifest = load_geo_manifest()
+        old = manifest.get(name, {})
+        previous = [p for p in [old.get("path")] + old.get("previous", []) if p and p != path]
+        for stale in previous[GEO_KEEP_VERSIONS - 1:]:
+            if os.path.exists(stale):
+                os.remove(stale)
+        now = time.time()
+        manifest[name] = {
+            "path": path,
+            "format": fmt,
+            "sha256": sha,
+            "version": sha[:16],
+            "etag": etag,
+            "source": source,
+            "updated": now if path != old.get("path") else old.get("updated", now),
+            "checked": now,
+            "previous": previous[:GEO_KEEP_VERSIONS - 1]
         }
+        save_geo_manifest(manifest)
+        geo_verified.add(path)
+    return manifest[name]
+
+def geo_path(name):
+    """(path, format) of the verified current file for name, or None"""
+    entry = load_geo_manifest().get(name)
+    if not entry or not os.path.exists(entry["path"]):
+        return None
+    if entry["path"] not in geo_verified:
+        if file_sha256(entry["path"]) != entry["sha256"]:
+            log_message("WARN", f"Geo data {name}: checksum mismatch, ignoring {entry['path']}")
+            return None
+        geo_verified.add(entry["path"])
+    return entry["path"], entry["format"]
+
+def seed_geo_data(paths):
+    """Copy local rule-set files in, named after the file (geoip-cn.srs -> geoip-cn)
+    
+    Returns [(name, manifest entry or error text)].
+    """
+    os.makedirs(GEO_CACHE, exist_ok=True)
+    results = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        tmp = os.path.join(GEO_CACHE, f".{name}.seed")
+        try:
+            shutil.copyfile(path, tmp)
+            results.append((name, store_geo_file(name, tmp, f"seed:{os.path.abspath(path)}")))
+        except (OSError, ValueError) as e:
+            results.append((name, str(e)))
+    return results
+
+def fetch_geo_file(name, entry=None, timeout=30):
+    """Download one rule-set; returns "updated", "current" or raises"""
+    url = geo_url(name)
+    if not url:
+        raise ValueError(f"no download URL for {name}")
+    request = urllib.request.Request(url, headers={"User-Agent": f"RAGEVPN/{VERSION}"})
+    if entry and entry.get("source") == url and entry.get("etag"):
+        request.add_header("If-None-Match", entry["etag"])
+    
+    os.makedirs(GEO_CACHE, exist_ok=True)
+    tmp = os.path.join(GEO_CACHE, f".{name}.download")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response, open(tmp, "wb") as f:
+            shutil.copyfileobj(response, f)
+            etag = response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            with geo_lock:
+                manifest = load_geo_manifest()
+                manifest[name]["checked"] = time.time()
+                save_geo_manifest(manifest)
+            return "current"
+        raise
+    
+    old_sha = entry.get("sha256") if entry else None
+    stored = store_geo_file(name, tmp, url, etag)
+    return "current" if stored["sha256"] == old_sha else "updated"
+
+def update_geo_data(names=None, force=False):
+    """Fetch stale or missing rule-sets (default: all known); returns {name: status or error text}"""
+    manifest = load_geo_manifest()
+    max_age = load_settings()["geo_update_hours"] * 3600
+    names = set(names or ()) or set(manifest) | set(GEO_DEFAULTS)
+    results = {}
+    for name in sorted(names):
+        entry = manifest.get(name)
+        if entry and entry.get("source", "").startswith("seed:") and not force and geo_path(name):
+            continue  # Seeded files are only replaced by request
+        if entry and not force and time.time() - entry.get("checked", 0) < max_age and geo_path(name):
+            continue
+        try:
+            # Only revalidate a file that is intact, otherwise fetch it whole
+            results[name] = fetch_geo_file(name, entry if entry and geo_path(name) else None)
+            geo_failed.pop(name, None)
+            log_message("INFO", f"Geo data {name}: {results[name]}")
+        except (OSError, ValueError) as e:
+            results[name] = str(e)
+            geo_failed[name] = time.time()
+            log_message("WARN", f"Geo data {name}: update failed: {e}")
+    return results
+
+def start_geo_update(names=None):
+    """Run update_geo_data in a background thread unless one is already on it"""
+    now = time.time()
+    with geo_lock:
+        names = {n for n in (names or set(load_geo_manifest()) | set(GEO_DEFAULTS))
+                 if n not in geo_updating and now - geo_failed.get(n, 0) > GEO_RETRY_DELAY}
+        if not names:
+            return None
+        geo_updating.update(names)
+    
+    def run():
+        try:
+            update_geo_data(names)
+        finally:
+            with geo_lock:
+                geo_updating.difference_update(names)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def apply_geo_data(cfg):
+    """Rewrite geoip/geosite route rules to cached local rule-sets
+    
+    geoip private needs no data and becomes ip_is_private. Codes without a
+    cached file are left out (a rule with nothing left is dropped) and
+    queued for a background fetch.
+    """
+    route = cfg["route"]
+    rules = []
+    missing = set()
+    for rule in route["rules"]:
+        if "geoip" not in rule and "geosite" not in rule:
+            rules.append(rule)
+            continue
+        rule = dict(rule)
+        tags = []
+        for kind in ("geoip", "geosite"):
+            for code in rule.pop(kind, None) or []:
+                if kind == "geoip" and code == "private":
+                    rules.append({**{k: v for k, v in rule.items() if k not in ("geoip", "geosite")},
+                                  "ip_is_private": True})
+                    continue
+                name = f"{kind}-{code}"
+                local = geo_path(name)
+                if not local:
+                    missing.add(name)
+                    continue
+                tags.append(name)
+                if not any(r["tag"] == name for r in route.get("rule_set", [])):
+                    route.setdefault("rule_set", []).append(
+                        {"type": "local", "tag": name, "format": local[1], "path": local[0]})
+        if tags:
+            rules.append({**rule, "rule_set": tags})
+    route["rules"] = rules
+    
+    if missing:
+        log_message("INFO", f"Geo data not cached yet, rules skipped: {', '.join(sorted(missing))}")
+        start_geo_update(missing)
+    return cfg
+
+# ========== PROFILE MANAGEMENT ==========
+def parse_link(protocol, link):
+    """Parse a profile link into a sing-box outbound"""
+    if protocol == "vless":
+        return parse_vless(link)
+    elif protocol == "vmess":
+        return parse_vmess(link)
+    elif protocol == "trojan":
+        return parse_trojan(link)
+    elif protocol == "shadowsocks":
+        return parse_shadowsocks(link)
+    return None
+
+def link_endpoint(link):
+    """Server host and port of a link without a full parse"""
+    try:
+        # vmess:// and legacy ss:// keep the server inside base64
+        if link.startswith("vmess://") or (link.startswith("ss://") and "@" not in link.split("#")[0]):
+            outbound = parse_link("vmess" if link.startswith("vmess://") else "shadowsocks", link) or {}
+            return outbound.get("server"), outbound.get("server_port")
+        parsed = urlparse(link)
+        if parsed.hostname:
+            return parsed.hostname, parsed.port
+    except ValueError:
+        pass
+    return None, None
+
+def outbound_endpoint(outbound):
+    """Server host and port of a sing-box outbound"""
+    if not outbound:
+        return None, None
+    return outbound.get("server"), outbound.get("server_port")
+
+def parse_timestamp(value):
+    """Epoch seconds from a float or a legacy time.ctime() string"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return time.mktime(time.strptime(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+class Profile:
+    """Compact profile record
+    
+    Slots hold only what list views, search and ranking need. A profile
+    loaded from disk drops the link and any other keys and reads them back
+    from its file on first access; the link is parsed on first use.
+    Supports the dict-style access the screens use (profile["name"],
+    profile.get(...)).
+    """
+    
+    __slots__ = ("name", "protocol", "created", "modified", "last_used", "usage_count", "health",
+                 "tags", "filename", "_link", "_extra", "_endpoint", "_outbound")
+    
+    SUMMARY = ("name", "protocol", "created", "modified", "last_used", "usage_count", "health", "tags")
+    
+    def __init__(self, name, protocol, link=None, created=0.0, modified=None, last_used=0,
+                 usage_count=0, health=None, tags=(), filename=None, extra=None):
+        self.name = name
+        self.protocol = sys.intern(protocol)
+        self.created = parse_timestamp(created)
+        self.modified = modified
+        self.last_used = last_used
+        self.usage_count = usage_count
+        self.health = health
+        self.tags = tuple(tags)
+        self.filename = filename
+        self._link = link
+        self._extra = extra
+        self._endpoint = None
+        self._outbound = None
+    
+    @classmethod
+    def from_dict(cls, data, filename=None, lazy=False):
+        """Build from saved JSON; lazy keeps only the summary fields"""
+        data = dict(data)
+        data.pop("filename", None)
+        fields = {key: data.pop(key) for key in cls.SUMMARY if key in data}
+        link = data.pop("link", "")
+        profile = cls(filename=filename, **fields)
+        if lazy and filename:
+            # Endpoint is part of the summary, the rest can be re-read
+            profile._endpoint = link_endpoint(link) if link else outbound_endpoint(data.get("outbound"))
+        else:
+            profile._link = link
+            profile._extra = data
+        return profile
+    
+    def _load(self):
+        """Read back the fields a lazy profile dropped"""
+        if self._extra is not None:
+            return
+        data = {}
+        try:
+            with open(os.path.join(PROFILES, self.filename), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError, TypeError) as e:
+            log_message("WARN", f"Failed to load profile {self.name}: {e}")
+        for key in self.SUMMARY + ("filename",):
+            data.pop(key, None)
+        self._link = data.pop("link", "")
+        self._extra = data
+    
+    @property
+    def link(self):
+        self._load()
+        return self._link
+    
+    @link.setter
+    def link(self, value):
+        self._load()
+        self._link = value
+        self._endpoint = self._outbound = None
+    
+    @property
+    def endpoint(self):
+        """(server, port) of the profile's server"""
+        if self._endpoint is None:
+            link = self.link
+            self._endpoint = link_endpoint(link) if link else outbound_endpoint(self._extra.get("outbound"))
+        return self._endpoint
+    
+    @property
+    def outbound(self):
+        """Parsed link, cached after the first access"""
+        if self._outbound is None:
+            link = self.link
+            # Imported Clash / sing-box entries carry a ready outbound
+            self._outbound = self._extra.get("outbound") or parse_link(self.protocol, link)
+        return self._outbound
+    
+    def to_dict(self):
+        data = {key: getattr(self, key) for key in self.SUMMARY}
+        data["tags"] = list(self.tags)
+        data["link"] = self.link
+        data.update(self._extra)
+        if data["health"] is None:
+            del data["health"]
+        if not data["tags"]:
+            del data["tags"]
+        return data
+    
+    # Dict-style access for the screens
+    def __getitem__(self, key):
+        if key in self.SUMMARY or key in ("link", "filename"):
+            return getattr(self, key)
+        self._load()
+        return self._extra[key]
+    
+    def __setitem__(self, key, value):
+        if key in self.SUMMARY or key in ("link", "filename"):
+            setattr(self, key, tuple(value) if key == "tags" else value)
+        else:
+            self._load()
+            self._extra[key] = value
+    
+    def __contains__(self, key):
+        if key in self.SUMMARY or key == "link":
+            return getattr(self, key) is not None
+        self._load()
+        return key in self._extra
+    
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+    
+    def __repr__(self):
+        return f"Profile({self.name!r}, {self.protocol!r})"
+
+def benchmark_profile_memory(count=100000):
+    """Bytes held by count profiles as plain dicts versus Profile objects"""
+    import tracemalloc
+    
+    def make(i):
+        # What json.load() hands back for a typical saved profile
+        return json.loads(json.dumps({
+            "name": f"Rage_Node_{i}",
+            "protocol": "vless",
+            "link": f"vless://{uuid.UUID(int=i)}@node{i}.example.net:443"
+                    f"?security=tls&sni=node{i}.example.net&type=ws&path=%2Fws#Node{i}",
+            "created": time.ctime(1700000000 + i),
+            "last_used": 1700000000.0 + i,
+            "usage_count": i % 17,
+            "modified": 1700000000.0 + i,
+            "dns": ["1.1.1.1", "8.8.8.8"]
+        }))
+    
+    results = {}
+    # Lazy profiles re-read the rest from their file, as load_profiles() does
+    lazy = lambda i: Profile.from_dict(make(i), f"Rage_Node_{i}.json", lazy=True)
+    for label, build in (("dict", make), ("Profile", lazy)):
+        tracemalloc.start()
+        profiles = [build(i) for i in range(count)]
+        # Touch what a list view touches
+        for profile in profiles:
+            profile["name"], profile.get("usage_count", 0)
+        results[label] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del profiles
+    return results
+
+def load_profiles():
+    """Load all profiles from disk, or from profile_store while the watcher keeps it current"""
+    if profiles_watched():
+        return profile_store.list()
+    profiles = []
+    for f in os.listdir(PROFILES):
+        if f.endswith(".json"):
+            try:
+                with open(os.path.join(PROFILES, f), "r") as file:
+                    profiles.append(Profile.from_dict(json.load(file), f, lazy=True))
+            except:
+                continue
+    return sorted(profiles, key=lambda x: x.last_used, reverse=True)
+
+def save_profile(profile):
+    """Save profile to disk"""
+    profile["modified"] = time.time()
+    filename = f"{profile['name']}.json"
+    filepath = os.path.join(PROFILES, filename)
+    data = profile.to_dict() if isinstance(profile, Profile) else profile
+    
+    with open(filepath, "w") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    profile_written(filename)
+    
+    log_message("INFO", f"Saved profile: {profile['name']}")
+    return True
+
+def delete_profile(profile_name):
+    """Delete profile"""
+    filepath = os.path.join(PROFILES, f"{profile_name}.json")
+    if os.path.exists(filepath):
+        os.remove(filepath)
+        profile_written(f"{profile_name}.json")
+        log_message("INFO", f"Deleted profile: {profile_name}")
+        return True
+    return False
+
+def test_connection(profile):
+    """Test connection speed and latency"""
+    try:
+        start_time = time.time()
+        
+        # Quick test using curl
+        test_url = load_settings()["test_url"]
+        result = sh(["curl", "-s", "--max-time", "5", test_url])
+        
+        if result and result.returncode == 0:
+            latency = int((time.time() - start_time) * 1000)
+            return True, latency
+    except:
+        pass
+    
+    return False, 0
+
+def profile_endpoint(profile):
+    """Server host and port of a profile"""
+    if isinstance(profile, Profile):
+        return profile.endpoint
+    return link_endpoint(profile.get("link", ""))
+
+# ========== PROFILE IMPORT ==========
+LINK_SCHEMES = {"vless": "vless", "vmess": "vmess", "trojan": "trojan", "ss": "shadowsocks"}
+SINGBOX_PROXY_TYPES = ("vless", "vmess", "trojan", "shadowsocks", "hysteria", "hysteria2", "tuic",
+                       "shadowtls", "wireguard", "ssh", "socks", "http")
+IMPORT_EXTENSIONS = (".yaml", ".yml", ".json", ".txt", ".list", ".conf")
+
+# Flow-style YAML tokens: punctuation, quoted strings, a mapping colon, plain scalars
+YAML_TOKEN = re.compile(r"""\s*(?:([{}\[\],])|"((?:[^"\\]|\\.)*)"|'((?:[^']|'')*)'|(:)(?=\s|$|[{\[])"""
+                        r"""|((?:[^\s,{}\[\]:#]|:(?![\s{\[]|$))(?:[^,{}\[\]:]|:(?![\s{\[]|$))*))""")
+
+def yaml_scalar(text):
+    """Plain YAML scalar to bool / int / None / str"""
+    text = text.strip()
+    lowered = text.lower()
+    if lowered in ("true", "yes", "on"):
+        return True
+    if lowered in ("false", "no", "off"):
+        return False
+    if lowered in ("", "null", "~"):
+        return None
+    if re.fullmatch(r"-?\d+", text):
+        return int(text)
+    return text
+
+def yaml_flow(text):
+    """Parse one flow value ({...}, [...] or a scalar)"""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = YAML_TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            if text[pos:].strip().startswith("#") or not text[pos:].strip():
+                break
+            raise ValueError(f"bad YAML near {text[pos:pos + 20]!r}")
+        punct, double, single, colon, plain = match.groups()
+        if punct or colon:
+            tokens.append(punct or colon)
+        elif double is not None:
+            tokens.append(("str", json.loads(f'"{double}"')))
+        elif single is not None:
+            tokens.append(("str", single.replace("''", "'")))
+        elif plain is not None:
+            tokens.append(("plain", plain))
+        pos = match.end()
+    
+    def value(i):
+        token = tokens[i]
+        if token == "{":
+            result = {}
+            i += 1
+            while tokens[i] != "}":
+                key, i = value(i)
+                if tokens[i] == ":":
+                    item, i = value(i + 1) if tokens[i + 1] not in (",", "}") else (None, i + 1)
+                else:
+                    item = None
+                result[str(key)] = item
+                if tokens[i] == ",":
+                    i += 1
+            return result, i + 1
+        if token == "[":
+            result = []
+            i += 1
+            while tokens[i] != "]":
+                item, i = value(i)
+                result.append(item)
+                if tokens[i] == ",":
+                    i += 1
+            return result, i + 1
+        if isinstance(token, tuple):
+            if token[0] == "str":
+                return token[1], i + 1
+            return yaml_scalar(re.split(r"\s#", token[1], 1)[0]), i + 1
+        raise ValueError(f"unexpected {token!r}")
+    
+    if not tokens:
+        return None
+    result, _ = value(0)
+    return result
+
+def yaml_block(lines, start, indent):
+    """Parse a block mapping or sequence at indent or deeper
+    
+    lines must be free of blank and comment lines; it is modified in place
+    when a "- key: value" item is unfolded. Returns (value, next line).
+    """
+    result = None
+    i = start
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        current = len(line) - len(line.lstrip())
+        if current < indent:
+            break
+        
+        if stripped == "-" or stripped.startswith("- "):
+            if result is None:
+                result = []
+            rest = stripped[1:].strip()
+            if not rest:
+                item, i = yaml_block(lines, i + 1, current + 1)
+            elif re.match(r"""[^{\["'][^:]*:(\s|$)""", rest):
+                # "- key: value" starts a mapping aligned with key
+                lines[i] = " " * (current + 2) + rest
+                item, i = yaml_block(lines, i, current + 2)
+            else:
+                item, i = yaml_flow(rest), i + 1
+            result.append(item)
+            continue
+        
+        if result is None:
+            result = {}
+        key, _, rest = stripped.partition(":")
+        key = key.strip().strip("\"'")
+        rest = rest.strip()
+        if rest and not rest.startswith("#"):
+            result[key] = yaml_flow(rest)
+            i += 1
+        else:
+            result[key], i = yaml_block(lines, i + 1, current + 1)
+    return result, i
+
+def parse_yaml_item(text):
+    """One entry of a YAML sequence, given with its leading dash
+    
+    The built-in subset parser covers what Clash configs use and is as fast
+    as PyYAML's C loader here; PyYAML, when installed, handles the rest
+    (anchors, multi-line strings).
+    """
+    try:
+        lines = [line for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+        rest = lines[0].lstrip()[1:].strip()
+        if rest.startswith("{"):
+            return yaml_flow(" ".join(line.strip() for line in [rest] + lines[1:]))
+        value, _ = yaml_block(lines, 0, 0)
+        return value[0]
+    except (ValueError, IndexError, TypeError):
+        if not yaml:
+            raise
+    loaded = yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    return loaded[0] if isinstance(loaded, list) and loaded else None
+
+def iter_clash_proxies(f):
+    """Yield the raw text of each entry under the top-level proxies: key"""
+    in_section = False
+    item = []
+    item_indent = None
+    for line in f:
+        stripped = line.strip()
+        if not in_section:
+            in_section = line.startswith("proxies:")
+            continue
+        if not stripped or stripped.startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0 and not stripped.startswith("-"):
+            break  # Next top-level key
+        if (stripped == "-" or stripped.startswith("- ")) and (item_indent is None or indent == item_indent):
+            item_indent = indent
+            if item:
+                yield "".join(item)
+            item = [line]
+        elif item:
+            item.append(line)
+    if item:
+        yield "".join(item)
+
+def clash_to_outbound(proxy):
+    """sing-box outbound for one Clash / Mihomo proxy entry"""
+    kind = proxy.get("type")
+    outbound = {"server": proxy["server"], "server_port": int(proxy["port"])}
+    
+    if kind == "ss":
+        outbound.update(type="shadowsocks", method=proxy["cipher"], password=str(proxy["password"]))
+        opts = proxy.get("plugin-opts") or {}
+        if proxy.get("plugin") == "obfs":
+            outbound["plugin"] = "obfs-local"
+            outbound["plugin_opts"] = f"obfs={opts.get('mode', 'http')};obfs-host={opts.get('host', '')}"
+        elif proxy.get("plugin") == "v2ray-plugin":
+            outbound["plugin"] = "v2ray-plugin"
+            outbound["plugin_opts"] = ";".join(
+                ["mode=websocket", f"host={opts.get('host', '')}", f"path={opts.get('path', '/')}"]
+                + (["tls"] if opts.get("tls") else []))
+    elif kind == "vmess":
+        outbound.update(type="vmess", uuid=proxy["uuid"], alter_id=int(proxy.get("alterId") or 0),
+                        security=proxy.get("cipher") or "auto")
+    elif kind == "vless":
+        outbound.update(type="vless", uuid=proxy["uuid"])
+        if proxy.get("flow"):
+            outbound["flow"] = proxy["flow"]
+    elif kind == "trojan":
+        outbound.update(type="trojan", password=str(proxy["password"]))
+    elif kind == "hysteria2":
+        outbound.update(type="hysteria2", password=str(proxy.get("password", "")))
+        for field, key in (("up", "up_mbps"), ("down", "down_mbps")):
+            if proxy.get(field):
+                outbound[key] = int(re.match(r"\d+", str(proxy[field])).group())
+        if proxy.get("obfs"):
+            outbound["obfs"] = {"type": proxy["obfs"], "password": str(proxy.get("obfs-password", ""))}
+    elif kind == "tuic":
+        outbound.update(type="tuic", uuid=proxy["uuid"], password=str(proxy.get("password", "")))
+        if proxy.get("congestion-controller"):
+            outbound["congestion_control"] = proxy["congestion-controller"]
+    else:
+        raise ValueError(f"unsupported type {kind}")
+    
+    # Same meaning as the link parameters, so the link mapping can be reused
+    reality = proxy.get("reality-opts") or {}
+    tls_always = kind in ("trojan", "hysteria2", "tuic")
+    network = proxy.get("network")
+    params = {
+        "security": "reality" if reality else "tls" if proxy.get("tls") or tls_always else "none",
+        "sni": proxy.get("sni") or proxy.get("servername"),
+        "alpn": ",".join(proxy.get("alpn") or []),
+        "allowInsecure": "1" if proxy.get("skip-cert-verify") else None,
+        "fp": proxy.get("client-fingerprint"),
+        "pbk": reality.get("public-key"),
+        "sid": reality.get("short-id"),
+        "type": network
+    }
+    opts = proxy.get(f"{network}-opts") or {}
+    if network == "ws":
+        params["path"] = opts.get("path")
+        params["host"] = (opts.get("headers") or {}).get("Host")
+    elif network in ("h2", "http"):
+        hosts = opts.get("host")
+        params["host"] = ",".join(hosts) if isinstance(hosts, list) else hosts
+        path = opts.get("path")
+        params["path"] = path[0] if isinstance(path, list) else path
+    elif network == "grpc":
+        params["serviceName"] = opts.get("grpc-service-name")
+    add_tls_transport(outbound, {key: str(value) for key, value in params.items() if value})
+    
+    if network == "ws" and opts.get("max-early-data"):
+        outbound["transport"]["max_early_data"] = int(opts["max-early-data"])
+        outbound["transport"]["early_data_header_name"] = opts.get("early-data-header-name", "Sec-WebSocket-Protocol")
+    return outbound
+
+def link_profile(link):
+    """Profile fields for one share link"""
+    scheme = link.split("://", 1)[0].lower()
+    protocol = LINK_SCHEMES.get(scheme)
+    if not protocol:
+        raise ValueError(f"unknown scheme {scheme}")
+    outbound = parse_link(protocol, link)
+    if not outbound or not outbound.get("server"):
+        raise ValueError("unparseable link")
+    if protocol == "vmess":
+        name = json.loads(base64.b64decode(link[8:] + "=" * (-len(link[8:]) % 4))).get("ps")
+    else:
+        name = unquote(link.split("#", 1)[1]) if "#" in link else None
+    return {"name": name or f"{outbound['server']}:{outbound['server_port']}", "protocol": protocol, "link": link}
+
+def detect_import_format(path, head):
+    """'clash', 'singbox' or 'links' from the extension or the first bytes"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".yaml", ".yml"):
+        return "clash"
+    if ext == ".json" or head.lstrip()[:1] in ("{", "["):
+        return "singbox"
+    if re.search(r"^proxies:", head, re.M):
+        return "clash"
+    return "links"
+
+def import_file(path):
+    """Parse one file into profile dicts; runs in a worker process
+    
+    Returns {path, format, profiles, failures, bytes, seconds} where
+    failures holds (entry, reason) pairs.
+    """
+    start = time.perf_counter()
+    profiles = []
+    failures = []
+    fmt = "?"
+    size = 0
+    source = os.path.splitext(os.path.basename(path))[0]
+    try:
+        size = os.path.getsize(path)
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            fmt = detect_import_format(path, f.read(4096))
+            f.seek(0)
+            
+            if fmt == "clash":
+                for text in iter_clash_proxies(f):
+                    try:
+                        proxy = parse_yaml_item(text)
+                        outbound = clash_to_outbound(proxy)
+                        profiles.append({"name": str(proxy.get("name") or outbound["server"]),
+                                         "protocol": outbound["type"], "link": "", "outbound": outbound})
+                    except Exception as e:
+                        failures.append((text.strip()[:80], str(e) or type(e).__name__))
+            
+            elif fmt == "singbox":
+                data = json.load(f)
+                outbounds = data if isinstance(data, list) else data.get("outbounds", [])
+                for outbound in outbounds:
+                    if not isinstance(outbound, dict) or outbound.get("type") not in SINGBOX_PROXY_TYPES:
+                        continue  # selector, urltest, direct, dns...
+                    outbound = dict(outbound)
+                    name = outbound.pop("tag", None) or f"{outbound.get('server')}:{outbound.get('server_port')}"
+                    if not outbound.get("server"):
+                        failures.append((name, "no server"))
+                        continue
+                    profiles.append({"name": name, "protocol": outbound["type"], "link": "", "outbound": outbound})
+            
+            else:
+                content = f.read()
+                if "://" not in content:
+                    # Subscription: the whole list base64 encoded
+                    try:
+                        content = base64.b64decode(content.strip() + "=" * (-len(content.strip()) % 4)).decode()
+                    except ValueError:
+                        pass
+                for line in content.splitlines():
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    try:
+                        profiles.append(link_profile(line))
+                    except Exception as e:
+                        failures.append((line[:80], str(e) or type(e).__name__))
+    except (OSError, ValueError) as e:
+        failures.append((path, str(e)))
+    
+    for profile in profiles:
+        profile["tags"] = ["imported", source]
+    return {"path": path, "format": fmt, "profiles": profiles, "failures": failures,
+            "bytes": size, "seconds": time.perf_counter() - start}
+
+def collect_import_files(paths):
+    """The given files, plus importable files inside given directories"""
+    files = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith(IMPORT_EXTENSIONS))
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+def import_profiles(paths, workers=None):
+    """Import files and directories, parsing files in parallel
+    
+    Profiles get unique, filename-safe names and are written in one pass.
+    Returns the per-file results with profiles replaced by the saved count.
+    """
+    files = collect_import_files(paths)
+    if len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(import_file, files))
+    else:
+        results = [import_file(f) for f in files]
+    
+    taken = {os.path.splitext(f)[0] for f in os.listdir(PROFILES)}
+    now = time.time()
+    for result in results:
+        saved = 0
+        for profile in result["profiles"]:
+            name = re.sub(r"[\\/\x00]", "_", profile["name"]).strip(". ") or "imported"
+            base, n = name, 1
+            while name in taken:
+                n += 1
+                name = f"{base} ({n})"
+            taken.add(name)
+            profile.update(name=name, created=now, modified=now, last_used=0, usage_count=0)
+            try:
+                with open(os.path.join(PROFILES, f"{name}.json"), "w") as f:
+                    json.dump(profile, f, indent=2, ensure_ascii=False)
+                profile_written(f"{name}.json")
+                saved += 1
+            except OSError as e:
+                result["failures"].append((name, str(e)))
+        result["profiles"] = saved
+        
+        log_message("INFO", f"Imported {saved} profiles from {result['path']} ({len(result['failures'])} failed)")
+        for entry, reason in result["failures"][:20]:
+            log_message("WARN", f"Import {os.path.basename(result['path'])}: {reason}: {entry}")
+    return results
+
+# ========== PROFILE SEARCH ==========
+class ProfileIndex:
+    """N-gram index over profile name, protocol, server host and tags
+    
+    Words of one or two characters match word prefixes, longer words match
+    anywhere via trigrams. Results are ordered by match quality (name
+    starts with the first word) and then by usage. A query that extends the
+    previous one only re-checks the previous matches.
+    """
+    
+    def __init__(self, profiles=()):
+        self.ids = {}          # profile name -> doc id
+        # Per doc id; removed docs leave None behind
+        self.names = []
+        self.texts = []
+        self.words = []        # " word word ..." for word-prefix checks
+        self.keys = []         # (-usage, doc id), the result order
+        self.modified = []
+        self.grams = collections.defaultdict(set)      # trigram -> doc ids
+        self.prefixes = collections.defaultdict(list)  # 1-2 char word prefix -> sorted keys
+        self.name_prefixes = collections.defaultdict(list)
+        self.order = []        # all sorted keys
+        self._last_query = None
+        self._last_matches = None
+        for profile in profiles:
+            self.add(profile)
+    
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+    
+    @staticmethod
+    def _words(text):
+        return " " + " ".join("".join(c if c.isalnum() else " " for c in text).split())
+    
+    @staticmethod
+    def _word_prefixes(words):
+        return {w[:n] for w in words.split() for n in (1, 2)}
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def add(self, profile):
+        """Index a profile, replacing any previous version"""
+        if profile["name"] in self.ids:
+            self.remove(profile["name"])
+        
+        host, _ = profile_endpoint(profile)
+        fields = [profile["name"], profile.get("protocol", ""), host or ""] + list(profile.get("tags", []))
+        text = "\x00".join(fields).lower()
+        
+        doc_id = len(self.names)
+        key = (-profile.get("usage_count", 0), doc_id)
+        self.ids[profile["name"]] = doc_id
+        self.names.append(profile["name"])
+        self.texts.append(text)
+        self.words.append(self._words(text))
+        self.keys.append(key)
+        self.modified.append(profile.get("modified"))
+        
+        for gram in self._trigrams(text):
+            self.grams[gram].add(doc_id)
+        for prefix in self._word_prefixes(self.words[doc_id]):
+            bisect.insort(self.prefixes[prefix], key)
+        for prefix in {text[:1], text[:2]}:
+            bisect.insort(self.name_prefixes[prefix], key)
+        bisect.insort(self.order, key)
+        self._last_query = None
+    
+    def remove(self, profile_name):
+        """Drop a profile from the index"""
+        doc_id = self.ids.pop(profile_name, None)
+        if doc_id is None:
+            return
+        text, key = self.texts[doc_id], self.keys[doc_id]
+        
+        for gram in self._trigrams(text):
+            postings = self.grams[gram]
+            postings.discard(doc_id)
+            if not postings:
+                del self.grams[gram]
+        for index, prefixes in ((self.prefixes, self._word_prefixes(self.words[doc_id])),
+                                (self.name_prefixes, {text[:1], text[:2]}), (None, [None])):
+            for prefix in prefixes:
+                postings = index[prefix] if index is not None else self.order
+                del postings[bisect.bisect_left(postings, key)]
+                if index is not None and not postings:
+                    del index[prefix]
+        
+        self.names[doc_id] = self.texts[doc_id] = self.words[doc_id] = None
+        self.keys[doc_id] = self.modified[doc_id] = None
+        self._last_query = None
+    
+    def sync(self, profiles):
+        """Apply additions, removals and modifications since the last sync"""
+        current = {p["name"]: p for p in profiles}
+        for name in [n for n in self.ids if n not in current]:
+            self.remove(name)
+        for name, profile in current.items():
+            doc_id = self.ids.get(name)
+            if doc_id is None or self.modified[doc_id] != profile.get("modified") \
+                    or self.keys[doc_id][0] != -profile.get("usage_count", 0):
+                self.add(profile)
+    
+    def _candidates(self, token):
+        if len(token) < 3:
+            return {key[1] for key in self.prefixes.get(token, ())}
+        postings = sorted((self.grams.get(g, set()) for g in self._trigrams(token)), key=len)
+        return set.intersection(*postings)
+    
+    def search(self, query):
+        """Doc ids matching every word of the query, best first"""
+        query = query.lower()
+        tokens = query.split()
+        if not tokens:
+            return [key[1] for key in self.order]
+        
+        texts, words = self.texts, self.words
+        last = self._last_query
+        last_tokens = last.split() if last is not None else []
+        if len(tokens) == 1 and len(tokens[0]) < 3:
+            # Prefix postings are already in result order
+            matches = [key[1] for key in self.prefixes.get(tokens[0], ())]
+            changed = []
+        elif last is not None and query.startswith(last) and last_tokens and \
+                not (len(last_tokens[-1]) < 3 <= len(tokens[len(last_tokens) - 1])):
+            # Narrowing: the new query only extends or adds words, so every
+            # new match was a previous match
+            matches = self._last_matches
+            changed = tokens[len(last_tokens) - 1:]
+        else:
+            candidates = set.intersection(*sorted((self._candidates(t) for t in tokens), key=len))
+            if len(candidates) > len(self.order) // 4:
+                matches = [key[1] for key in self.order if key[1] in candidates]
+            else:
+                matches = [key[1] for key in sorted(map(self.keys.__getitem__, candidates))]
+            # A single trigram is exact, longer words need confirming
+            changed = [t for t in tokens if len(t) > 3]
+        
+        for token in changed:
+            if len(token) < 3:
+                token = " " + token
+                matches = [i for i in matches if token in words[i]]
+            else:
+                matches = [i for i in matches if token in texts[i]]
+        
+        self._last_query = query
+        self._last_matches = matches
+        
+        # Names starting with the first word come first
+        first = tokens[0]
+        name_first = {key[1] for key in self.name_prefixes.get(first[:2], ())}
+        if len(first) > 2:
+            name_first = {i for i in name_first if texts[i].startswith(first)}
+        if not name_first:
+            return matches
+        head = [i for i in matches if i in name_first]
+        if len(head) == len(matches):
+            return matches
+        return head + [i for i in matches if i not in name_first]
+
+def benchmark_search(count=50000, queries=("berlin", "tok fast", "us vle", "node-4", "amster 12")):
+    """Keystroke-to-results latency over synthetic profiles"""
+    words = ["alpha", "bravo", "delta", "tokyo", "berlin", "paris", "amster", "node", "fast", "prime"]
+    protocols = ["vless", "vmess", "trojan", "shadowsocks"]
+    rng = random.Random(42)
+    profiles = [{
+        "name": f"{rng.choice(words)}-{rng.choice(words)}-{i}",
+        "protocol": rng.choice(protocols),
+        "link": f"trojan://pw@{rng.choice(words)}{i % 500}.example.net:443",
+        "tags": [rng.choice(["de", "us", "nl", "jp"])],
+        "usage_count": rng.randint(0, 50),
+        "modified": i
+    } for i in range(count)]
+    
+    start = time.perf_counter()
+    index = ProfileIndex(profiles)
+    build_s = time.perf_counter() - start
+    
+    # Type each query one character at a time
+    latencies = []
+    for query in queries:
+        index._last_query = None
+        for i in range(1, len(query) + 1):
+            start = time.perf_counter()
+            index.search(query[:i])
+            latencies.append((time.perf_counter() - start) * 1000)
+    
+    start = time.perf_counter()
+    for profile in profiles[:100]:
+        index.remove(profile["name"])
+        index.add(profile)
+    update_ms = (time.perf_counter() - start) * 1000 / 100
+    
+    return {
+        "profiles": count,
+        "build_s": build_s,
+        "keystrokes": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "max_ms": max(latencies),
+        "update_ms": update_ms
+    }
+
+_profile_index = None
+
+def get_profile_index(profiles):
+    """Shared search index, brought up to date with the given profiles"""
+    global _profile_index
+    with profile_store.lock:
+        if _profile_index is None:
+            _profile_index = ProfileIndex(profiles)
+        elif not profiles_watched():
+            # Otherwise profile_store updates it file by file
+            _profile_index.sync(profiles)
+    return _profile_index
+
+def profile_search(profiles):
+    """Search callback for menu() over a profile list"""
+    index = get_profile_index(profiles)
+    with profile_store.lock:
+        position = {index.ids.get(p["name"]): i for i, p in enumerate(profiles)}
+    
+    def search(query):
+        # Profiles changed since the list was taken drop out until it is refreshed
+        with profile_store.lock:
+            return [position[doc_id] for doc_id in index.search(query) if doc_id in position]
+    return search
+
+# ========== PROFILE WATCHER ==========
+# Config management writes profiles and config.json behind our back. A
+# watcher thread follows PROFILES and CONFIG with inotify (polling where
+# that is unavailable), re-reads only the files that changed into
+# profile_store and hands the changes to open screens through their queues.
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length; the name follows
+WATCH_POLL_INTERVAL = 1.0
+WATCH_SETTLE = 0.05  # Quiet time that ends a burst of events
+
+def file_signature(path):
+    """(mtime_ns, size) of a file, or None if it is gone"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+class ProfileStore:
+    """Profiles in memory by file name, brought up to date one file at a time
+    
+    Also keeps the shared search index in step, so searching needs no
+    re-sync. Hold lock while reading the index from another thread.
+    """
+    
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.profiles = {}    # file name -> Profile, None if unreadable
+        self.signatures = {}  # file name -> file_signature() when read
+        self.loaded = False
+    
+    def refresh(self, filename):
+        """Re-read one file if it changed; returns (kind, profile name) or None"""
+        signature = file_signature(os.path.join(PROFILES, filename))
+        with self.lock:
+            if signature == self.signatures.get(filename):
+                return None
+            old = self.profiles.pop(filename, None)
+            self.signatures.pop(filename, None)
+            new = None
+            if signature:
+                self.signatures[filename] = signature
+                try:
+                    with open(os.path.join(PROFILES, filename), "r") as f:
+                        new = Profile.from_dict(json.load(f), filename, lazy=True)
+                except (OSError, ValueError, TypeError) as e:
+                    # Left out like load_profiles() does, until the file changes again
+                    log_message("WARN", f"Failed to load profile {filename}: {e}")
+                self.profiles[filename] = new
+            
+            if _profile_index is not None:
+                if old and (not new or old["name"] != new["name"]):
+                    _profile_index.remove(old["name"])
+                if new:
+                    _profile_index.add(new)
+        
+        if new:
+            return ("modified" if old else "added"), new["name"]
+        return ("deleted", old["name"]) if old else None
+    
+    def rescan(self):
+        """Refresh every file, new and known; returns the changes"""
+        try:
+            names = {f for f in os.listdir(PROFILES) if f.endswith(".json")}
+        except OSError:
+            names = set()
+        with self.lock:
+            names |= set(self.signatures)
+        changes = [self.refresh(f) for f in sorted(names)]
+        self.loaded = True
+        return [c for c in changes if c]
+    
+    def list(self):
+        """Current profiles, most recently used first"""
+        with self.lock:
+            profiles = [p for p in self.profiles.values() if p]
+        return sorted(profiles, key=lambda x: x.last_used, reverse=True)
+
+class ProfileWatcher(threading.Thread):
+    """Follows PROFILES and CONFIG and keeps a ProfileStore current
+    
+    Subscribers get ("added" | "modified" | "deleted", profile name) and
+    ("config", CONFIG) on their queues.
+    """
+    
+    def __init__(self, store, poll_interval=WATCH_POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.store = store
+        self.poll_interval = poll_interval
+        self.mode = None  # "inotify" or "poll" once running
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._config = file_signature(CONFIG)
+    
+    def subscribe(self):
+        """A queue that receives every change from now on"""
+        updates = queue.Queue()
+        with self._lock:
+            self._subscribers.append(updates)
+        return updates
+    
+    def unsubscribe(self, updates):
+        with self._lock:
+            if updates in self._subscribers:
+                self._subscribers.remove(updates)
+    
+    def stop(self):
+        self._stop_event.set()
+    
+    def publish(self, changes, external=True):
+        """Hand changes to every subscriber"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for change in changes:
+            if external and change[0] != "config":
+                log_message("INFO", f"Profile {change[1]} {change[0]} on disk")
+            for updates in subscribers:
+                updates.put(change)
+    
+    def _config_changes(self):
+        signature = file_signature(CONFIG)
+        if signature == self._config:
+            return []
+        self._config = signature
+        return [("config", CONFIG)] if signature else []
+    
+    def run(self):
+        try:
+            self._run_inotify()
+        except OSError as e:
+            log_message("WARN", f"Watching profiles by polling every {self.poll_interval:g}s: {e}")
+            self._run_polling()
+    
+    def _run_polling(self):
+        self.mode = "poll"
+        while not self._stop_event.wait(self.poll_interval):
+            self.publish(self.store.rescan() + self._config_changes())
+    
+    def _run_inotify(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            watches = {}
+            for path, mask in ((PROFILES, IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF),
+                               (BASE, IN_CLOSE_WRITE | IN_MOVED_TO)):
+                wd = libc.inotify_add_watch(fd, path.encode(), mask)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, f"{path}: {os.strerror(err)}")
+                watches[path] = wd
+            self.mode = "inotify"
+            # Whatever changed before the watches were in place
+            self.publish(self.store.rescan() + self._config_changes())
+            
+            config_name = os.path.basename(CONFIG)
+            while not self._stop_event.is_set():
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                changed, config, overflow = set(), False, False
+                # One pass per burst, e.g. a config management run rewriting everything
+                deadline = time.monotonic() + 1
+                while time.monotonic() < deadline and select.select([fd], [], [], WATCH_SETTLE)[0]:
+                    try:
+                        data = os.read(fd, 65536)
+                    except BlockingIOError:
+                        break
+                    offset = 0
+                    while offset < len(data):
+                        wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                        name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length]
+                        name = name.rstrip(b"\0").decode("utf-8", "replace")
+                        offset += INOTIFY_EVENT.size + length
+                        if mask & IN_Q_OVERFLOW:
+                            overflow = True
+                        elif mask & IN_DELETE_SELF:
+                            raise OSError("profiles directory was removed")
+                        elif wd == watches[PROFILES] and name.endswith(".json"):
+                            changed.add(name)
+                        elif wd == watches[BASE] and name == config_name:
+                            config = True
+                
+                if overflow:
+                    changes = self.store.rescan()
+                else:
+                    changes = [c for c in map(self.store.refresh, sorted(changed)) if c]
+                self.publish(changes + (self._config_changes() if config or overflow else []))
+        finally:
+            os.close(fd)
+
+profile_store = ProfileStore()
+profile_watcher = None
+
+def start_profile_watcher():
+    """Load profile_store and start the shared watcher, once"""
+    global profile_watcher
+    if profile_watcher is None or not profile_watcher.is_alive():
+        profile_store.rescan()
+        profile_watcher = ProfileWatcher(profile_store)
+        profile_watcher.start()
+    return profile_watcher
+
+def profiles_watched():
+    """Whether profile_store is being kept current"""
+    return bool(profile_watcher and profile_watcher.is_alive())
+
+def profile_written(filename):
+    """Apply our own write to profile_store now rather than when the watcher sees it"""
+    if profiles_watched():
+        change = profile_store.refresh(filename)
+        if change:
+            profile_watcher.publish([change], external=False)
+
+def live_profile_menu(stdscr, title, extra):
+    """menu() over all profiles plus extra items, following changes on disk
+    
+    Returns (profiles as listed when the choice was made, selected index).
+    """
+    state = {"profiles": load_profiles()}
+    updates = profile_watcher.subscribe() if profile_watcher else None
+    
+    def items(profiles):
+        return [f"{p['name']} ({p['protocol']})" for p in profiles] + list(extra)
+    
+    def live():
+        changed = False
+        while True:
+            try:
+                changed = updates.get_nowait()[0] != "config" or changed
+            except queue.Empty:
+                break
+        if not changed:
+            return None
+        state["profiles"] = load_profiles()
+        return items(state["profiles"]), profile_search(state["profiles"])
+    
+    try:
+        selected = menu(stdscr, title, items(state["profiles"]), search=profile_search(state["profiles"]),
+                        live=live if updates else None)
+    finally:
+        if updates:
+            profile_watcher.unsubscribe(updates)
+    return state["profiles"], selected
+
+# ========== TRAFFIC MONITOR ==========
+class TrafficMonitor:
+    """Advanced traffic monitoring"""
+    
+    def __init__(self, session=None):
+        self.start_time = time.time()
+        self.start_bytes = psutil.net_io_counters()
+        if session:
+            # Carry on counting from a reattached session
+            self.start_time = session["started"]
+            self.start_bytes = self.start_bytes._replace(bytes_recv=session["baseline"]["rx"],
+                                                         bytes_sent=session["baseline"]["tx"])
+        self.history = []
+        self.max_history = 60  # 1 minute at 1-second intervals
+        
+    def get_stats(self):
+        """Get current traffic statistics"""
+        current = psutil.net_io_counters()
+        elapsed = time.time() - self.start_time
+        
+        rx_total = current.bytes_recv - self.start_bytes.bytes_recv
+        tx_total = current.bytes_sent - self.start_bytes.bytes_sent
+        
+        # Calculate speed (bytes per second)
+        if len(self.history) > 1:
+            last = self.history[-1]
+            time_diff = elapsed - last["time"]
+            if time_diff > 0:
+                rx_speed = (rx_total - last["rx_total"]) / time_diff
+                tx_speed = (tx_total - last["tx_total"]) / time_diff
+            else:
+                rx_speed = tx_speed = 0
+        else:
+            rx_speed = tx_speed = 0
+        
+        # Add to history
+        self.history.append({
+            "time": elapsed,
+            "rx_total": rx_total,
+            "tx_total": tx_total,
+            "rx_speed": rx_speed,
+            "tx_speed": tx_speed
+        })
+        
+        # Trim history
+        if len(self.history) > self.max_history:
+            self.history.pop(0)
+        
+        return {
+            "rx_total_kb": rx_total // 1024,
+            "tx_total_kb": tx_total // 1024,
+            "rx_speed_kbps": int(rx_speed * 8 / 1024),  # Convert to kbps
+            "tx_speed_kbps": int(tx_speed * 8 / 1024),
+            "elapsed": int(elapsed)
+        }
+    
+    def reset(self):
+        """Reset counters"""
+        self.start_time = time.time()
+        self.start_bytes = psutil.net_io_counters()
+        self.history = []
+
+# ========== CONNECTIONS ==========
+def free_port(host="127.0.0.1"):
+    """A TCP port that is free right now"""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def enable_clash_api(cfg):
+    """Expose sing-box's clash-compatible API on localhost with a random secret"""
+    cfg.setdefault("experimental", {})["clash_api"] = {
+        "external_controller": f"127.0.0.1:{free_port()}",
+        "secret": secrets.token_hex(16)
+    }
+    return cfg
+
+def clash_api_endpoint(path=CONFIG):
+    """(host, port, secret) of the API in a written config, or None"""
+    try:
+        with open(path, "r") as f:
+            api = json.load(f)["experimental"]["clash_api"]
+        host, port = api["external_controller"].rsplit(":", 1)
+        return host, int(port), api.get("secret", "")
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def fetch_connections(endpoint, timeout=2):
+    """The API's open connections as a list of dicts"""
+    host, port, secret = endpoint
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("GET", "/connections", headers={"Authorization": f"Bearer {secret}"} if secret else {})
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ValueError(f"API returned HTTP {response.status}")
+    return json.loads(body).get("connections") or []
+
+def format_bytes(value):
+    """1536 -> '1.5 KB'"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+class ConnectionTracker(threading.Thread):
+    """Polls the API's /connections and aggregates traffic per domain and rule
+    
+    Each poll is diffed against the previous one by connection id, so
+    rates come from byte deltas and totals keep growing after a
+    connection closes. All the work happens on this thread; the UI only
+    copies a sorted snapshot.
+    """
+    
+    GROUP_IDLE_TTL = 300  # Forget closed groups after 5 minutes
+    
+    def __init__(self, endpoint, interval=1.0):
+        super().__init__(daemon=True)
+        self.host, self.port, self.secret = endpoint
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.poll_ms = collections.deque(maxlen=30)
+        self.error = None
+        self.active = 0
+        self.snapshot = {"domain": [], "rule": []}
+        self._conn = None
+        self._seen = {}  # connection id -> (upload, download)
+        self._groups = {"domain": {}, "rule": {}}
+        self._last_poll = None
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                self.poll()
+                self.error = None
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                self.error = str(e) or type(e).__name__
+                self._close()
+            self.poll_ms.append((time.perf_counter() - start) * 1000)
+            self.stop_event.wait(self.interval)
+        self._close()
+    
+    def stop(self):
+        self.stop_event.set()
+    
+    def _close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+    
+    def fetch(self):
+        """GET /connections over a kept-alive HTTP connection"""
+        if not self._conn:
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=2)
+        headers = {"Authorization": f"Bearer {self.secret}"} if self.secret else {}
+        self._conn.request("GET", "/connections", headers=headers)
+        response = self._conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise ValueError(f"API returned HTTP {response.status}")
+        return json.loads(body)
+    
+    def poll(self):
+        """Fold one /connections response into the per-group counters"""
+        data = self.fetch()
+        now = time.monotonic()
+        elapsed = now - self._last_poll if self._last_poll else None
+        self._last_poll = now
+        
+        seen = {}
+        current = {"domain": {}, "rule": {}}  # key -> [conns, up delta, down delta]
+        for conn in data.get("connections") or ():
+            upload = conn.get("upload", 0)
+            download = conn.get("download", 0)
+            previous = self._seen.get(conn.get("id"))
+            seen[conn.get("id")] = (upload, download)
+            if previous:
+                upload, download = upload - previous[0], download - previous[1]
+            
+            meta = conn.get("metadata") or {}
+            domain = meta.get("host") or meta.get("destinationIP") or "?"
+            rule = conn.get("rule") or "?"
+            if conn.get("rulePayload"):
+                rule = f"{rule}({conn['rulePayload']})"
+            chains = conn.get("chains") or ["?"]
+            
+            for kind, key in (("domain", domain), ("rule", f"{rule} → {chains[0]}")):
+                entry = current[kind].get(key)
+                if entry is None:
+                    entry = current[kind][key] = [0, 0, 0]
+                entry[0] += 1
+                entry[1] += upload
+                entry[2] += download
+        self._seen = seen
+        
+        snapshot = {}
+        for kind, groups in self._groups.items():
+            for key, (conns, upload, download) in current[kind].items():
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = {"key": key, "up": 0, "down": 0}
+                group["up"] += upload
+                group["down"] += download
+                group["conns"] = conns
+                # No rate on the first poll, there is nothing to diff against
+                group["up_rate"] = upload / elapsed if elapsed else 0
+                group["down_rate"] = download / elapsed if elapsed else 0
+                group["seen"] = now
+            
+            for key, group in list(groups.items()):
+                if key not in current[kind]:
+                    group["conns"] = group["up_rate"] = group["down_rate"] = 0
+                    if now - group["seen"] > self.GROUP_IDLE_TTL:
+                        del groups[key]
+            
+            snapshot[kind] = sorted((dict(group) for group in groups.values()),
+                                    key=lambda g: (g["up_rate"] + g["down_rate"], g["up"] + g["down"]),
+                                    reverse=True)
+        
+        with self.lock:
+            self.snapshot = snapshot
+            self.active = len(seen)
+    
+    def view(self, kind):
+        """Sorted groups and the open connection count"""
+        with self.lock:
+            return self.snapshot[kind], self.active
+
+def mock_clash_api(count, secret="", churn=0.05):
+    """Local stand-in for sing-box's /connections with count live connections
+    
+    Counters grow on every request and a fraction of connections is
+    replaced each time. Returns the running server; shutdown() stops it.
+    """
+    rng = random.Random(1)
+    domains = [f"host{i}.example.com" for i in range(max(1, count // 10))]
+    rules = [("domain_suffix", "example.com"), ("geoip", "private"), ("final", "")]
+    state = {"next_id": 0, "connections": []}
+    lock = threading.Lock()
+    
+    def new_connection():
+        state["next_id"] += 1
+        rule, payload = rng.choice(rules)
+        return {
+            "id": str(uuid.UUID(int=state["next_id"])),
+            "metadata": {"network": "tcp", "type": "tun", "host": rng.choice(domains),
+                         "destinationIP": "198.18.0.1", "destinationPort": "443"},
+            "upload": 0,
+            "download": 0,
+            "start": datetime.now().isoformat(),
+            "chains": ["proxy" if rule != "geoip" else "direct"],
+            "rule": rule,
+            "rulePayload": payload
+        }
+    
+    state["connections"] = [new_connection() for _ in range(count)]
+    
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def do_GET(self):
+            if secret and self.headers.get("Authorization") != f"Bearer {secret}":
+                self.send_response(401)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with lock:
+                connections = state["connections"]
+                for i in range(int(len(connections) * churn)):
+                    connections[rng.randrange(len(connections))] = new_connection()
+                for conn in connections:
+                    conn["upload"] += rng.randrange(0, 2048)
+                    conn["download"] += rng.randrange(0, 65536)
+                body = json.dumps({"downloadTotal": 0, "uploadTotal": 0, "connections": connections}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def benchmark_connections(count=5000, polls=20):
+    """Poll a mock API with count connections and time each poll"""
+    secret = secrets.token_hex(16)
+    server = mock_clash_api(count, secret)
+    tracker = ConnectionTracker(("127.0.0.1", server.server_address[1], secret))
+    
+    timings = []
+    try:
+        for _ in range(polls):
+            start = time.perf_counter()
+            tracker.poll()
+            timings.append((time.perf_counter() - start) * 1000)
+        view_start = time.perf_counter()
+        groups, active = tracker.view("domain")
+        view_ms = (time.perf_counter() - view_start) * 1000
+    finally:
+        tracker._close()
+        server.shutdown()
+    
+    return {
+        "connections": active,
+        "domains": len(groups),
+        "p50_ms": percentile(timings, 50),
+        "p95_ms": percentile(timings, 95),
+        "view_ms": view_ms
+    }
+
+# ========== CONNECT TRACING ==========
+class ConnectTrace:
+    """Phase timings for one connect or reconnect attempt"""
+    
+    def __init__(self, kind, profile):
+        self.record = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "profile": profile["name"],
+            "protocol": profile["protocol"],
+            "version": VERSION,
+            "singbox": SINGBOX_VERSION,
+            "time": time.time(),
+            "phases": {}
+        }
+    
+    @contextmanager
+    def span(self, phase):
+        """Time a block and record it under the phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record["phases"][phase] = round((time.perf_counter() - start) * 1000, 2)
+    
+    def finish(self, ok):
+        """Append the attempt to the trace file"""
+        self.record["ok"] = ok
+        # Sum of phases, so time spent in dialogs is not counted
+        self.record["total_ms"] = round(sum(self.record["phases"].values()), 2)
+        try:
+            with open(TRACE_FILE, "a") as f:
+                f.write(json.dumps(self.record) + "\n")
+        except OSError as e:
+            log_message("WARN", f"Failed to write trace: {e}")
+        return self.record
+
+def load_traces(limit=500):
+    """Load the most recent trace records"""
+    if not os.path.exists(TRACE_FILE):
+        return []
+    
+    # Only read the tail, the trace file grows forever
+    with open(TRACE_FILE, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - limit * 1024))
+        lines = f.read().splitlines()[-limit:]
+    
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+TRACE_KINDS = ("connect", "reconnect", "failover", "bench")
+
+def summarize_traces(records, profile=None, kind=None):
+    """p50/p95 per phase in milliseconds, optionally for one profile and attempt kind"""
+    samples = {}
+    for record in records:
+        if profile and record.get("profile") != profile:
+            continue
+        if kind and record.get("kind") != kind:
+            continue
+        for phase, ms in record.get("phases", {}).items():
+            samples.setdefault(phase, []).append(ms)
+    
+    return {
+        phase: {"p50": percentile(values, 50), "p95": percentile(values, 95), "count": len(values)}
+        for phase, values in samples.items()
+    }
+
+def wait_for_tun(process, timeout):
+    """Wait until the tun interface is up or sing-box exits"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        stats = psutil.net_if_stats().get(TUN_INTERFACE)
+        if stats and stats.isup:
+            return True
+        time.sleep(0.05)
+    return False
+
+def wait_for_log(process, timeout, offset, marker=b"sing-box started"):
+    """Wait until sing-box logs that it started (past offset) or exits"""
+    deadline = time.time() + timeout
+    with open(SINGBOX_LOG, "rb") as f:
+        f.seek(offset)
+        seen = b""
+        while time.time() < deadline:
+            seen = seen[-len(marker):] + f.read()
+            if marker in seen:
+                return True
+            if process.poll() is not None:
+                return False
+            time.sleep(0.02)
+    return False
+
+def probe_first_byte(host, port, timeout=5):
+    """Time from connect to the first response byte, in ms"""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(f"HEAD / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            if sock.recv(1):
+                return int((time.perf_counter() - start) * 1000)
+    except OSError:
+        pass
+    return None
+
+def start_tunnel(profile, trace):
+    """Write config and bring sing-box up, recording each phase"""
+    settings = load_settings()
+    
+    with trace.span("build_config"):
+        config = build_singbox_config(profile)
+    
+    with trace.span("write_config"):
+        with open(CONFIG, "w") as f:
+            json.dump(config, f, indent=2)
+    
+    # Stop existing sing-box
+    with trace.span("stop_singbox"):
+        stop_singbox()
+    
+    return launch_singbox(trace, settings)
+
+def config_is_current(profile):
+    """Whether the config on disk was written after the profile last changed"""
+    try:
+        written = os.path.getmtime(CONFIG)
+    except OSError:
+        return False
+    return written >= (profile.get("modified") or 0)
+
+def restart_tunnel(process, profile, trace):
+    """Restart only our sing-box child, reusing the config on disk
+    
+    Returns the new process, or None if the config is stale or sing-box
+    did not come back; the caller then falls back to a full reconnect.
+    trace is only finished when a restart was attempted, for a stale
+    config the caller drops it and the full reconnect records its own.
+    """
+    if not config_is_current(profile):
+        return None
+    
+    with trace.span("stop_child"):
+        stop_process(process)
+    
+    return launch_singbox(trace, load_settings())
+
+def launch_singbox(trace, settings, config_path=CONFIG):
+    """Spawn sing-box on the written config and wait for the tunnel"""
+    with trace.span("spawn"):
+        log_file, offset = singbox_output.open()
+        with log_file:
+            process = sh(["sing-box", "run", "-c", config_path], background=True, output=log_file)
+    
+    if not process:
+        trace.finish(False)
+        return None
+    output = singbox_output.attach(process, offset)
+    
+    with trace.span("tun_up"):
+        if settings["ready_signal"] == "log":
+            tun_ok = wait_for_log(process, settings["tun_timeout"], offset)
+        else:
+            tun_ok = wait_for_tun(process, settings["tun_timeout"])
+    
+    if not tun_ok and process.poll() is not None:
+        output.join(1)
+        last = singbox_output.tail(1)
+        log_message("ERROR", f"sing-box exited with code {process.returncode}" + (f": {last[0]}" if last else ""))
+        trace.finish(False)
+        return None
+    
+    with trace.span("first_byte"):
+        first_byte = probe_first_byte(settings["probe_host"], settings["probe_port"])
+    
+    trace.finish(first_byte is not None)
+    return process
+
+# ========== SESSION ==========
+# The running tunnel is recorded in session.json so a restarted UI can
+# pick it up instead of tearing it down.
+def config_hash(path=CONFIG):
+    """SHA-256 of the written sing-box config"""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def save_session(pid, profile, monitor):
+    """Record the running tunnel and the traffic counter baselines"""
+    try:
+        create_time = psutil.Process(pid).create_time()
+    except psutil.Error:
+        return
+    session = {
+        "pid": pid,
+        "create_time": create_time,
+        "profile": profile["name"],
+        "protocol": profile["protocol"],
+        "config_hash": config_hash(),
+        "started": monitor.start_time,
+        "baseline": {"rx": monitor.start_bytes.bytes_recv, "tx": monitor.start_bytes.bytes_sent}
+    }
+    tmp = SESSION_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(session, f)
+        os.replace(tmp, SESSION_FILE)
+    except OSError as e:
+        log_message("WARN", f"Failed to save session: {e}")
+
+def load_session():
+    """The saved session if its sing-box is still running our config, else None"""
+    try:
+        with open(SESSION_FILE, "r") as f:
+            session = json.load(f)
+        process = psutil.Process(session["pid"])
+        # A recycled PID has a different start time
+        valid = (abs(process.create_time() - session["create_time"]) < 0.01
+                 and CONFIG in process.cmdline()
+                 and session["config_hash"] == config_hash())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, psutil.Error):
+        valid = False
+    
+    if not valid:
+        log_message("INFO", "Discarding stale session")
+        clear_session()
+        return None
+    session["process"] = process
+    return session
+
+def clear_session():
+    try:
+        os.remove(SESSION_FILE)
+    except OSError:
+        pass
+
+# ========== HEALTH MONITOR ==========
+class HealthMonitor(threading.Thread):
+    """Background in-tunnel probing with adaptive interval"""
+    
+    def __init__(self, settings=None, window=10):
+        super().__init__(daemon=True)
+        self.settings = settings or load_settings()
+        self.samples = collections.deque(maxlen=window)  # latency ms or None
+        self.interval = self.settings["health_min_interval"]
+        self.reason = None
+        self.breached_at = None
+        self.breached = threading.Event()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._api = clash_api_endpoint()
+        self._last_downloads = None
+    
+    def stop(self):
+        """Stop probing"""
+        self._stop_event.set()
+    
+    def reset(self):
+        """Forget samples taken before a reconnect"""
+        with self._lock:
+            self.samples.clear()
+            self.interval = self.settings["health_min_interval"]
+            self.reason = None
+            self.breached_at = None
+            self._api = clash_api_endpoint()
+            self._last_downloads = None
+        self.breached.clear()
+    
+    def _proxied_replies(self):
+        """Whether proxied connections received bytes since the last call
+        
+        Tun rx alone proves nothing: sing-box answers fakeip DNS and
+        completes TCP handshakes locally. Without the API this is always
+        False, so probing carries on.
+        """
+        if not self._api:
+            return False
+        try:
+            connections = fetch_connections(self._api)
+        except (OSError, ValueError, http.client.HTTPException):
+            return False
+        downloads = {c.get("id"): c.get("download", 0) for c in connections
+                     if "proxy" in (c.get("chains") or ())}
+        last, self._last_downloads = self._last_downloads, downloads
+        if last is None:
+            return False
+        return any(download > last.get(conn_id, 0) for conn_id, download in downloads.items())
+    
+    def probe(self):
+        """Run one probe through the tunnel"""
+        latency = probe_first_byte(self.settings["probe_host"], self.settings["probe_port"], timeout=3)
+        with self._lock:
+            self.samples.append(latency)
+        return latency
+    
+    def metrics(self):
+        """Rolling latency, jitter and failure rate"""
+        with self._lock:
+            samples = list(self.samples)
+        ok = [s for s in samples if s is not None]
+        return {
+            "latency_ms": sum(ok) / len(ok) if ok else None,
+            "jitter_ms": sum(abs(a - b) for a, b in zip(ok, ok[1:])) / (len(ok) - 1) if len(ok) > 1 else 0,
+            "failure_rate": (len(samples) - len(ok)) / len(samples) if samples else 0,
+            "samples": len(samples),
+            "interval": self.interval
+        }
+    
+    def check_thresholds(self):
+        """Return a breach reason or None"""
+        m = self.metrics()
+        # Need a few samples before judging
+        if m["samples"] < 3:
+            return None
+        if m["failure_rate"] >= self.settings["health_max_failure_rate"]:
+            return f"failure rate {m['failure_rate']:.0%}"
+        if m["latency_ms"] and m["latency_ms"] > self.settings["health_max_latency_ms"]:
+            return f"latency {m['latency_ms']:.0f} ms"
+        return None
+    
+    def run(self):
+        min_interval = self.settings["health_min_interval"]
+        max_interval = self.settings["health_max_interval"]
+        
+        # Never exits before stop(): reset() after an in-place reconnect relies on it
+        while not self._stop_event.wait(self.interval):
+            try:
+                self._check(min_interval, max_interval)
+            except Exception as e:
+                log_message("ERROR", f"Health check error: {e}")
+                self.interval = min_interval
+    
+    def _check(self, min_interval, max_interval):
+        """One round: skip or probe, then judge the thresholds"""
+        # Replies through the proxy: the tunnel works, no need to add probes
+        with self._lock:
+            last_failed = bool(self.samples) and self.samples[-1] is None
+        if self._proxied_replies() and not last_failed:
+            self.interval = max_interval
+            return
+        
+        latency = self.probe()
+        if latency is None:
+            self.interval = min_interval
+        else:
+            self.interval = min(self.interval * 2, max_interval)
+        
+        # Keeps probing after a breach, the screen decides what to do
+        reason = self.check_thresholds()
+        if reason and not self.breached.is_set():
+            self.reason = reason
+            self.breached_at = time.monotonic()
+            log_message("WARN", f"Health check failed: {reason}")
+            self.breached.set()
+        elif not reason and self.breached.is_set():
+            log_message("INFO", f"Health recovered after {self.reason}")
+            self.reason = None
+            self.breached_at = None
+            self.breached.clear()
+
+def rank_profiles(profiles, exclude=None):
+    """Best failover candidates first: reliable, fast, then most used"""
+    def score(profile):
+        health = profile.get("health") or {}
+        latency = health.get("latency_ms")
+        return (
+            health.get("failure_rate", 0),
+            latency if latency is not None else float("inf"),
+            -profile.get("usage_count", 0)
+        )
+    return sorted((p for p in profiles if p["name"] != exclude), key=score)
+
+def record_event(event, **fields):
+    """Append a connection event to the events file"""
+    entry = {"time": time.time(), "event": event, **fields}
+    try:
+        with open(EVENTS_FILE, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        log_message("WARN", f"Failed to record event: {e}")
+
+# ========== PROCESS MONITOR ==========
+# sing-box's own footprint: CPU, RSS, open files, threads and sockets,
+# sampled every resource_interval seconds. Samples are appended to
+# resources.jsonl so growth shows across reconnects and multi-day sessions;
+# a steady climb over leak_window_minutes raises an alert.
+RESOURCES_FILE = os.path.join(BASE, "resources.jsonl")
+RESOURCES_MAX = 4 * 1024 * 1024  # Cut to the newer half past this size
+SPARK = "▁▂▃▄▅▆▇█"
+
+def count_fds(pid):
+    """(open fds, of which sockets) from /proc, or (None, None) elsewhere"""
+    fd_dir = f"/proc/{pid}/fd"
+    try:
+        names = os.listdir(fd_dir)
+    except OSError:
+        return None, None
+    sockets = 0
+    for name in names:
+        try:
+            if os.readlink(os.path.join(fd_dir, name)).startswith("socket:"):
+                sockets += 1
+        except OSError:
+            continue  # Closed meanwhile
+    return len(names), sockets
+
+def sample_process(process):
+    """One resource sample of a psutil.Process, or None once it is gone
+    
+    cpu is percent of one core since the previous call on the same object.
+    """
+    try:
+        with process.oneshot():
+            cpu = process.cpu_percent(interval=None)
+            rss = process.memory_info().rss
+            threads = process.num_threads()
+        fds, sockets = count_fds(process.pid)
+        if fds is None:
+            fds = process.num_fds() if hasattr(process, "num_fds") else None
+    except psutil.Error:
+        return None
+    return {"time": time.time(), "pid": process.pid, "cpu": round(cpu, 1), "rss": rss,
+            "fds": fds, "threads": threads, "sockets": sockets}
+
+def trend_per_hour(samples, key):
+    """Least-squares slope of samples[key] per hour, None with too few points"""
+    points = [(s["time"], s[key]) for s in samples if s.get(key) is not None]
+    if len(points) < 3:
+        return None
+    mean_t = sum(t for t, _ in points) / len(points)
+    mean_v = sum(v for _, v in points) / len(points)
+    spread = sum((t - mean_t) ** 2 for t, _ in points)
+    if not spread:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / spread * 3600
+
+def save_resource_sample(sample):
+    """Append a sample to RESOURCES_FILE, keeping the file bounded"""
+    try:
+        if os.path.exists(RESOURCES_FILE) and os.path.getsize(RESOURCES_FILE) > RESOURCES_MAX:
+            with open(RESOURCES_FILE, "rb") as f:
+                f.seek(-RESOURCES_MAX // 2, os.SEEK_END)
+                keep = f.read().split(b"\n", 1)[-1]
+            tmp = RESOURCES_FILE + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(keep)
+            os.replace(tmp, RESOURCES_FILE)
+        with open(RESOURCES_FILE, "a") as f:
+            f.write(json.dumps(sample) + "\n")
+    except OSError as e:
+        log_message("WARN", f"Failed to save resource sample: {e}")
+
+def sparkline(values, width):
+    """The last width values as block characters scaled to their range"""
+    values = [v for v in values if v is not None][-width:]
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    scale = (len(SPARK) - 1) / (high - low) if high > low else 0
+    return "".join(SPARK[int((v - low) * scale)] for v in values)
+
+class ResourceMonitor(threading.Thread):
+    """Low-rate sampling of the sing-box child with leak alerts
     
-    # Add fake IP DNS if enabled
-    cfg["dns"]["fakeip"] = {
-        "enabled": True,
-        "inet4_range": "198.18.0.0/15"
-    }
+    restarts is a list of restart times, shared by the monitors of one
+    session so the leak_restarts_per_hour cap holds across reconnects.
+    """
     
-    return cfg
-
-# ========== PROFILE MANAGEMENT ==========
-def load_profiles():
-    """Load all profiles from disk"""
-    profiles = []
-    for f in os.listdir(PROFILES):
-        if f.endswith(".json"):
+    def __init__(self, pid, profile, settings=None, restarts=None):
+        super().__init__(daemon=True)
+        self.settings = settings or load_settings()
+        self.profile = profile["name"]
+        self.restarts = restarts if restarts is not None else []
+        self.capped = False  # Limit reached and logged
+        window = self.settings["leak_window_minutes"] * 60
+        self.samples = collections.deque(maxlen=max(60, int(window / self.settings["resource_interval"]) + 1))
+        self.alert = None
+        self.restart_due = threading.Event()
+        self.restart_reason = None  # The alert that set restart_due
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self.attach(pid)
+    
+    def attach(self, pid):
+        """Follow a new sing-box process; trends start over"""
+        with self._lock:
             try:
-                with open(os.path.join(PROFILES, f), "r") as file:
-                    profile = json.load(file)
-                    profile["filename"] = f
-                    profiles.append(profile)
-            except:
-                continue
-    return sorted(profiles, key=lambda x: x.get("last_used", 0), reverse=True)
-
-def save_profile(profile):
-    """Save profile to disk"""
-    profile["modified"] = time.time()
-    filename = f"{profile['name']}.json"
-    filepath = os.path.join(PROFILES, filename)
+                self._process = psutil.Process(pid)
+                self._process.cpu_percent(interval=None)  # Baseline for the first sample
+                self.started = self._process.create_time()
+            except psutil.Error:
+                self._process = None
+                self.started = time.time()
+            self.samples.clear()
+            self.alert = None
+            self.restart_reason = None
+        self.restart_due.clear()
     
-    with open(filepath, "w") as f:
-        json.dump(profile, f, indent=2, ensure_ascii=False)
+    def stop(self):
+        """Stop sampling"""
+        self._stop_event.set()
     
-    log_message("INFO", f"Saved profile: {profile['name']}")
-    return True
-
-def delete_profile(profile_name):
-    """Delete profile"""
-    filepath = os.path.join(PROFILES, f"{profile_name}.json")
-    if os.path.exists(filepath):
-        os.remove(filepath)
-        log_message("INFO", f"Deleted profile: {profile_name}")
-        return True
-    return False
+    def latest(self):
+        """Newest sample or None"""
+        with self._lock:
+            return self.samples[-1] if self.samples else None
+    
+    def history(self):
+        """Samples of the current process, oldest first"""
+        with self._lock:
+            return list(self.samples)
+    
+    def trends(self):
+        """{"rss": bytes/h, "fds": fds/h} over the leak window; None until it is covered"""
+        window = self.settings["leak_window_minutes"] * 60
+        now = time.time()
+        with self._lock:
+            covered = bool(self.samples) and self.samples[0]["time"] <= now - window * 0.9
+            recent = [s for s in self.samples if s["time"] >= now - window]
+        # A young process is still filling caches and pools
+        if not covered or len(recent) < 6:
+            return {"rss": None, "fds": None}
+        return {"rss": trend_per_hour(recent, "rss"), "fds": trend_per_hour(recent, "fds")}
+    
+    def check(self, sample):
+        """Alert text for a limit crossed or a leak-like trend, else None"""
+        settings = self.settings
+        max_rss = settings["resource_max_rss_mb"] * 1024 * 1024
+        if max_rss and sample["rss"] > max_rss:
+            return f"RSS {format_bytes(sample['rss'])} over the {settings['resource_max_rss_mb']} MB limit"
+        if settings["resource_max_fds"] and sample["fds"] and sample["fds"] > settings["resource_max_fds"]:
+            return f"{sample['fds']} open files over the limit of {settings['resource_max_fds']}"
+        trends = self.trends()
+        window = settings["leak_window_minutes"]
+        if trends["rss"] is not None and trends["rss"] > settings["leak_rss_mb_per_hour"] * 1024 * 1024:
+            return f"RSS growing {format_bytes(trends['rss'])}/h over {window} min"
+        if trends["fds"] is not None and trends["fds"] > settings["leak_fds_per_hour"]:
+            return f"open files growing {trends['fds']:.0f}/h over {window} min"
+        return None
+    
+    def run(self):
+        while not self._stop_event.wait(self.settings["resource_interval"]):
+            with self._lock:
+                process = self._process
+            sample = sample_process(process) if process else None
+            if not sample:
+                continue  # Exited; health checks and reconnects deal with that
+            sample["profile"] = self.profile
+            with self._lock:
+                if process is not self._process:
+                    continue  # Restarted while sampling
+                self.samples.append(sample)
+            save_resource_sample(sample)
+            
+            alert = self.check(sample)
+            if alert and not self.alert:
+                log_message("WARN", f"sing-box {alert}")
+                record_event("resource_alert", profile=self.profile, alert=alert,
+                             rss=sample["rss"], fds=sample["fds"])
+            self.alert = alert
+            if alert and self.settings["leak_restart"] and not self.restart_due.is_set():
+                if self.restart_allowed():
+                    self.restarts.append(time.time())
+                    self.restart_reason = alert
+                    self.restart_due.set()
+                elif not self.capped:
+                    self.capped = True
+                    log_message("WARN", f"sing-box restart limit reached "
+                                        f"({self.settings['leak_restarts_per_hour']} per hour), alerting only")
+    
+    def restart_allowed(self):
+        """Whether another leak restart fits in the hourly cap"""
+        self.restarts[:] = [t for t in self.restarts if t > time.time() - 3600]
+        return len(self.restarts) < self.settings["leak_restarts_per_hour"]
 
-def test_connection(profile):
-    """Test connection speed and latency"""
-    try:
-        start_time = time.time()
-        
-        # Quick test using curl
-        test_url = "https://1.1.1.1/cdn-cgi/trace"
-        result = sh(["curl", "-s", "--max-time", "5", test_url])
-        
-        if result and result.returncode == 0:
-            latency = int((time.time() - start_time) * 1000)
-            return True, latency
-    except:
-        pass
+# ========== FRAME STATS ==========
+class FrameStats:
+    """Render cost and wake-up rate of a screen loop"""
     
-    return False, 0
+    def __init__(self, window=60):
+        self.render_ms = collections.deque(maxlen=window)
+        self.sample_ms = collections.deque(maxlen=window)
+        self.wakeups = collections.deque(maxlen=window)
+    
+    def wake(self):
+        """Record one loop wake-up"""
+        self.wakeups.append(time.monotonic())
+    
+    @contextmanager
+    def measure(self, bucket):
+        """Time a block into the render or sample bucket"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            getattr(self, bucket).append((time.perf_counter() - start) * 1000)
+    
+    def wakeups_per_sec(self):
+        """Wake-ups per second over the recorded window"""
+        if len(self.wakeups) < 2:
+            return 0.0
+        span = self.wakeups[-1] - self.wakeups[0]
+        return (len(self.wakeups) - 1) / span if span > 0 else 0.0
+    
+    def summary(self):
+        """Overlay text lines"""
+        last_render = self.render_ms[-1] if self.render_ms else 0
+        last_sample = self.sample_ms[-1] if self.sample_ms else 0
+        return [
+            f"frame {last_render:6.2f} ms  p95 {percentile(list(self.render_ms), 95):6.2f}",
+            f"stats {last_sample:6.2f} ms  p95 {percentile(list(self.sample_ms), 95):6.2f}",
+            f"wake  {self.wakeups_per_sec():6.2f} /s"
+        ]
 
-# ========== TRAFFIC MONITOR ==========
-class TrafficMonitor:
-    """Advanced traffic monitoring"""
+class RefreshPolicy:
+    """How often the connection screen wakes up
     
-    def __init__(self):
-        self.start_time = time.time()
-        self.start_bytes = psutil.net_io_counters()
-        self.history = []
-        self.max_history = 60  # 1 minute at 1-second intervals
-        
-    def get_stats(self):
-        """Get current traffic statistics"""
-        current = psutil.net_io_counters()
-        elapsed = time.time() - self.start_time
-        
-        rx_total = current.bytes_recv - self.start_bytes.bytes_recv
-        tx_total = current.bytes_sent - self.start_bytes.bytes_sent
-        
-        # Calculate speed (bytes per second)
-        if len(self.history) > 1:
-            last = self.history[-1]
-            time_diff = elapsed - last["time"]
-            if time_diff > 0:
-                rx_speed = (rx_total - last["rx_total"]) / time_diff
-                tx_speed = (tx_total - last["tx_total"]) / time_diff
-            else:
-                rx_speed = tx_speed = 0
-        else:
-            rx_speed = tx_speed = 0
-        
-        # Add to history
-        self.history.append({
-            "time": elapsed,
-            "rx_total": rx_total,
-            "tx_total": tx_total,
-            "rx_speed": rx_speed,
-            "tx_speed": tx_speed
-        })
-        
-        # Trim history
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
-        
-        return {
-            "rx_total_kb": rx_total // 1024,
-            "tx_total_kb": tx_total // 1024,
-            "rx_speed_kbps": int(rx_speed * 8 / 1024),  # Convert to kbps
-            "tx_speed_kbps": int(tx_speed * 8 / 1024),
-            "elapsed": int(elapsed)
-        }
+    active: every ACTIVE_REFRESH seconds. idle: every idle_refresh seconds
+    once no key was pressed and the traffic rate stayed within
+    idle_traffic_delta for idle_after seconds. paused: nothing is drawn
+    while the process is in the background, and after a hang-up the screen
+    detaches. A key or a traffic change goes straight back to active.
+    """
     
-    def reset(self):
-        """Reset counters"""
-        self.start_time = time.time()
-        self.start_bytes = psutil.net_io_counters()
-        self.history = []
+    ACTIVE_REFRESH = 0.5
+    PAUSED_CHECK = 2.0
+    
+    def __init__(self, settings):
+        self.settings = settings
+        self.mode = "active"
+        self.hung_up = False
+        now = time.monotonic()
+        self.last_input = now
+        self.quiet_since = now
+        self.rate = 0
+        self.wakeups = collections.Counter()  # per mode
+        self.seconds = collections.Counter()
+        self._since = now
+        self._previous_handler = None
+    
+    def start(self):
+        """Survive a terminal hang-up instead of dying with it (main thread only)"""
+        self._previous_handler = signal.signal(signal.SIGHUP, self._hang_up)
+    
+    def stop(self):
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGHUP, self._previous_handler)
+            self._previous_handler = None
+        rates = ", ".join(f"{mode} {rate:.2f}/s over {self.seconds[mode]:.0f}s" for mode, rate in self.rates().items())
+        if rates:
+            log_message("INFO", f"Connection screen wake-ups: {rates}")
+    
+    def _hang_up(self, signum, frame):
+        self.hung_up = True
+    
+    def wake(self):
+        """Count one loop wake-up towards the mode it was in"""
+        now = time.monotonic()
+        self.seconds[self.mode] += now - self._since
+        self.wakeups[self.mode] += 1
+        self._since = now
+    
+    def key(self):
+        self.last_input = time.monotonic()
+    
+    def traffic(self, rate):
+        """Feed the current bytes/s; a jump counts as activity"""
+        if abs(rate - self.rate) > self.settings["idle_traffic_delta"]:
+            self.quiet_since = time.monotonic()
+        self.rate = rate
+    
+    def paused(self):
+        """Whether there is no terminal to draw on"""
+        if self.hung_up:
+            self.mode = "paused"
+            return True
+        try:
+            foreground = os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp()
+        except OSError:
+            foreground = False  # The terminal is gone
+        if not foreground:
+            self.mode = "paused"
+        elif self.mode == "paused":
+            self.mode = "active"
+            self.quiet_since = time.monotonic()
+        return not foreground
+    
+    def interval(self):
+        """Seconds until the next wake-up unless a key comes first"""
+        if self.mode == "paused":
+            return self.PAUSED_CHECK
+        now = time.monotonic()
+        idle_after = self.settings["idle_after"]
+        if idle_after and now - max(self.last_input, self.quiet_since) >= idle_after:
+            self.mode = "idle"
+            return self.settings["idle_refresh"]
+        self.mode = "active"
+        return self.ACTIVE_REFRESH
+    
+    def rates(self):
+        """Average wake-ups per second in each mode seen so far"""
+        return {mode: self.wakeups[mode] / self.seconds[mode] for mode in ("active", "idle", "paused")
+                if self.seconds[mode] > 0}
+    
+    def summary(self):
+        """Overlay text lines"""
+        return [f"{mode:<6}{rate:6.2f} /s  {self.seconds[mode]:5.0f}s" for mode, rate in self.rates().items()]
+
+def draw_overlay(stdscr, frame_stats, refresh=None):
+    """Draw frame stats (and wake-ups per refresh mode) in the top right corner"""
+    height, width = stdscr.getmaxyx()
+    lines = frame_stats.summary() + (refresh.summary() if refresh else [])
+    box_width = max(len(l) for l in lines) + 2
+    x = width - box_width - 1
+    if x < 0:
+        return
+    for i, line in enumerate(lines):
+        if i + 1 < height:
+            stdscr.addstr(i + 1, x, f" {line} ", curses.color_pair(COLOR_YELLOW) | curses.A_REVERSE)
 
 # ========== UI COMPONENTS ==========
 def init_colors():
@@ -533,55 +3848,146 @@ def draw_box(stdscr, y, x, height, width, title=""):
         if title_x > x:
             stdscr.addstr(y, title_x, title_text, curses.A_BOLD)
 
-def menu(stdscr, title, items, selected=0, show_help=True):
-    """Enhanced menu with colors and navigation"""
-    height, width = stdscr.getmaxyx()
+def menu(stdscr, title, items, selected=0, show_help=True, search=None, live=None):
+    """Enhanced menu with colors and navigation
+    
+    Only the visible window of items is drawn and a keypress repaints just
+    the rows that changed, so cost per key does not grow with len(items).
+    With search, '/' starts type-to-filter: search(query) returns the
+    matching item indices, best first. live is called while no key is
+    pressed and returns None or new (items, search) to show instead.
+    """
+    if not items:
+        return -1
+    
+    view = range(len(items))  # item indices currently listed
+    query = None              # None while not filtering
+    search_ms = 0
+    selected = max(0, min(selected, len(items) - 1))
+    top = 0
+    drawn = {}  # screen row -> (item index, is selected) currently shown
+    screen_size = None
+    title_y = 1
+    start_y = title_y + 4
     
     while True:
-        stdscr.clear()
+        height, width = stdscr.getmaxyx()
+        visible = max(1, height - start_y - 5)
+        count = len(view)
         
-        # Draw title
-        title_y = 1
-        stdscr.addstr(title_y, 2, f"╔{'═' * (len(title) + 2)}╗", curses.color_pair(COLOR_CYAN))
-        stdscr.addstr(title_y + 1, 2, f"║ {title} ║", curses.color_pair(COLOR_CYAN) | curses.A_BOLD)
-        stdscr.addstr(title_y + 2, 2, f"╚{'═' * (len(title) + 2)}╝", curses.color_pair(COLOR_CYAN))
+        # Keep the selection inside the window
+        if selected < top:
+            top = selected
+        elif selected >= top + visible:
+            top = selected - visible + 1
+        top = max(0, min(top, count - visible)) if count > visible else 0
         
-        # Draw items
-        start_y = title_y + 4
-        max_items = height - start_y - 5
+        if screen_size != (height, width):
+            screen_size = (height, width)
+            drawn = {}
+            stdscr.erase()
+            
+            # Draw title
+            stdscr.addstr(title_y, 2, f"╔{'═' * (len(title) + 2)}╗", curses.color_pair(COLOR_CYAN))
+            stdscr.addstr(title_y + 1, 2, f"║ {title} ║", curses.color_pair(COLOR_CYAN) | curses.A_BOLD)
+            stdscr.addstr(title_y + 2, 2, f"╚{'═' * (len(title) + 2)}╝", curses.color_pair(COLOR_CYAN))
+            
+            # Help text
+            if show_help:
+                help_y = height - 3
+                help_text = "↑↓ PgUp PgDn Home End: Navigate | Enter: Select | q: Exit"
+                if len(items) <= visible:
+                    help_text = "↑↓: Navigate | Enter: Select | q: Exit"
+                if search:
+                    help_text += " | /: Search"
+                stdscr.addstr(help_y, max(0, (width - len(help_text)) // 2), help_text[:width - 1],
+                              curses.color_pair(COLOR_YELLOW))
         
-        for i, item in enumerate(items):
-            if i >= max_items:
-                break
+        # Draw items, only rows whose content changed
+        for row in range(visible):
+            index = top + row
+            state = (view[index], index == selected) if index < count else None
+            if drawn.get(row) == state:
+                continue
+            drawn[row] = state
             
-            y_pos = start_y + i
-            if i == selected:
+            y_pos = start_y + row
+            stdscr.move(y_pos, 0)
+            stdscr.clrtoeol()
+            if state is None:
+                continue
+            
+            item = items[view[index]][:max(0, width - 8)]
+            if index == selected:
                 stdscr.addstr(y_pos, 4, "▶", curses.color_pair(COLOR_GREEN) | curses.A_BOLD)
                 stdscr.addstr(y_pos, 6, item, curses.color_pair(COLOR_GREEN) | curses.A_BOLD | curses.A_REVERSE)
             else:
                 stdscr.addstr(y_pos, 6, item, curses.color_pair(COLOR_WHITE))
         
-        # Help text
-        if show_help:
-            help_y = height - 3
-            help_text = "↑↓: Navigate | Enter: Select | q: Exit"
-            stdscr.addstr(help_y, (width - len(help_text)) // 2, help_text, curses.color_pair(COLOR_YELLOW))
+        # Search line and position indicator
+        stdscr.move(start_y - 1, 0)
+        stdscr.clrtoeol()
+        if query is not None:
+            search_line = f"/{query}_  {count} matches ({search_ms:.1f} ms)"
+            stdscr.addstr(start_y - 1, 4, search_line[:max(0, width - 6)], curses.color_pair(COLOR_YELLOW))
+        if count > visible:
+            position = f" {selected + 1}/{count} {'▲' if top > 0 else ' '}{'▼' if top + visible < count else ' '}"
+            stdscr.addstr(start_y - 1, max(0, width - len(position) - 2), position, curses.color_pair(COLOR_CYAN))
         
         stdscr.refresh()
         
         # Handle input
+        if live:
+            stdscr.timeout(250)
         key = stdscr.getch()
+        if live:
+            stdscr.timeout(-1)
         
-        if key == curses.KEY_UP:
-            selected = (selected - 1) % len(items)
+        if key == -1 and live:
+            update = live()
+            if update:
+                # Stay on the same item if it is still there
+                current = items[view[selected]] if count else None
+                items, search = update
+                view = search(query) if search and query and query.strip() else range(len(items))
+                selected = next((i for i, v in enumerate(view) if items[v] == current), min(selected, len(view) - 1))
+                selected = max(0, selected)
+                screen_size = None
+        elif query is not None and (32 <= key < 127 or key in (curses.KEY_BACKSPACE, 127, 8)):
+            query = query[:-1] if key in (curses.KEY_BACKSPACE, 127, 8) else query + chr(key)
+            start = time.perf_counter()
+            view = search(query) if query.strip() else range(len(items))
+            search_ms = (time.perf_counter() - start) * 1000
+            selected = top = 0
+        elif key == 27 and query is not None:  # ESC leaves search
+            query = None
+            view = range(len(items))
+            selected = top = 0
+        elif search and key == ord('/'):
+            query = ""
+        elif count == 0:
+            if key == ord('q'):
+                return -1
+        elif key == curses.KEY_UP:
+            selected = (selected - 1) % count
         elif key == curses.KEY_DOWN:
-            selected = (selected + 1) % len(items)
+            selected = (selected + 1) % count
+        elif key == curses.KEY_PPAGE:
+            selected = max(0, selected - visible)
+        elif key == curses.KEY_NPAGE:
+            selected = min(count - 1, selected + visible)
+        elif key == curses.KEY_HOME:
+            selected = 0
+        elif key == curses.KEY_END:
+            selected = count - 1
+        elif key == curses.KEY_RESIZE:
+            screen_size = None
         elif key in (10, 13):  # Enter
-            return selected
+            return view[selected]
         elif key == ord('q'):
             return -1
         elif key == ord(' '):
-            return selected
+            return view[selected]
 
 def input_dialog(stdscr, prompt, default=""):
     """Get user input with dialog"""
@@ -651,6 +4057,12 @@ def show_message(stdscr, message, color=COLOR_WHITE, wait=True):
 def main_menu(stdscr):
     """Main menu screen"""
     init_colors()
+    start_profile_watcher()
+    
+    # Pick up a tunnel left running by an earlier run
+    session = load_session()
+    if session and resume_session(stdscr, session) == "detach":
+        return
     
     while True:
         # Check sing-box installation
@@ -669,7 +4081,8 @@ def main_menu(stdscr):
         selected = menu(stdscr, f"{APP} v{VERSION}", items)
         
         if selected == 0:  # Connect VPN
-            connect_screen(stdscr)
+            if connect_screen(stdscr) == "detach":
+                break
         elif selected == 1:  # Manage Profiles
             profiles_screen(stdscr)
         elif selected == 2:  # Settings
@@ -691,59 +4104,216 @@ def connect_screen(stdscr):
         show_message(stdscr, "No profiles found!\nCreate a profile first.", COLOR_RED)
         return
     
-    profile_names = [f"{p['name']} ({p['protocol']})" for p in profiles]
-    profile_names.append("← Back")
+    profiles, selected = live_profile_menu(stdscr, "Select Profile", ["← Back"])
     
-    selected = menu(stdscr, "Select Profile", profile_names)
-    
-    if selected == len(profile_names) - 1 or selected == -1:
+    if selected == len(profiles) or selected == -1:
         return
     
     selected_profile = profiles[selected]
+    trace = ConnectTrace("connect", selected_profile)
+    
+    # Faster address family to the server, for the config about to be built
+    if race_due(selected_profile, load_settings()):
+        with trace.span("race_family"):
+            race_profile_family(selected_profile)
     
     # Test connection first
     show_message(stdscr, "Testing connection...", COLOR_YELLOW, False)
-    test_ok, latency = test_connection(selected_profile)
+    with trace.span("test_connection"):
+        test_ok, latency = test_connection(selected_profile)
     
     if not test_ok:
         retry = show_yesno(stdscr, "Connection test failed!\nRetry with force mode?")
         if not retry:
+            trace.finish(False)
             return
     
-    # Build and save config
-    config = build_singbox_config(selected_profile)
-    with open(CONFIG, "w") as f:
-        json.dump(config, f, indent=2)
-    
-    # Stop existing sing-box
-    stop_singbox()
-    
-    # Start sing-box
-    show_message(stdscr, "Starting VPN connection...", COLOR_YELLOW, False)
-    
     # Update last used time
     selected_profile["last_used"] = time.time()
     selected_profile["usage_count"] = selected_profile.get("usage_count", 0) + 1
     save_profile(selected_profile)
     
-    # Start sing-box in background
-    process = sh(["sing-box", "run", "-c", CONFIG], background=True)
+    return run_session(stdscr, selected_profile, trace)
+
+def resume_session(stdscr, session):
+    """Reattach to a tunnel left running by a previous run"""
+    profile = next((p for p in load_profiles() if p["name"] == session["profile"]), None)
+    if not profile:
+        if show_yesno(stdscr, f"A tunnel for deleted profile {session['profile']} is running.\nDisconnect it?"):
+            stop_singbox()
+        return None
+    
+    log_message("INFO", f"Reattached to sing-box (pid {session['pid']}) for {profile['name']}")
+    singbox_output.attach(session["process"])
+    return run_session(stdscr, profile, attached=session)
+
+def run_session(stdscr, selected_profile, trace=None, attached=None):
+    """Keep a tunnel up for a profile through reconnects and failover"""
+    settings = load_settings()
+    failover = None
+    failed_profiles = set()
+    resource_restarts = []  # Leak restarts this session, for the hourly cap
     
-    if process:
-        time.sleep(2)  # Wait for connection
-        connection_screen(stdscr, selected_profile, process)
-    else:
-        show_message(stdscr, "Failed to start VPN!", COLOR_RED)
+    while True:
+        if attached:
+            process, session = attached["process"], attached
+            attached = None
+        else:
+            # Start sing-box in background
+            show_message(stdscr, "Starting VPN connection...", COLOR_YELLOW, False)
+            process = start_tunnel(selected_profile, trace)
+            session = None
+        
+        if not process:
+            # During failover move on to the next candidate
+            if failover and failover["candidates"]:
+                selected_profile = failover["candidates"].pop(0)
+                trace = ConnectTrace("failover", selected_profile)
+                continue
+            # Last words from sing-box, if any
+            output = "\n".join(line[:70] for line in singbox_output.tail(3))
+            show_message(stdscr, "Failed to start VPN!" + ("\n\n" + output if output else ""), COLOR_RED)
+            return
+        
+        if failover:
+            downtime = int((time.monotonic() - failover["breached_at"]) * 1000)
+            record_event("failover", reason=failover["reason"], downtime_ms=downtime,
+                         **{"from": failover["from"], "to": selected_profile["name"]})
+            failover = None
+        
+        health = HealthMonitor(settings)
+        health.start()
+        resources = ResourceMonitor(process.pid, selected_profile, settings, resource_restarts)
+        resources.start()
+        updates = profile_watcher.subscribe() if profile_watcher else None
+        refresh = RefreshPolicy(settings)
+        refresh.start()
+        try:
+            result = connection_screen(stdscr, selected_profile, process, health, session, updates, refresh,
+                                       resources)
+        finally:
+            refresh.stop()
+            resources.stop()
+            health.stop()
+            if updates:
+                profile_watcher.unsubscribe(updates)
+        
+        # Remember how this profile behaved for failover ranking
+        metrics = health.metrics()
+        if metrics["samples"]:
+            selected_profile["health"] = {
+                "latency_ms": metrics["latency_ms"],
+                "jitter_ms": metrics["jitter_ms"],
+                "failure_rate": metrics["failure_rate"],
+                "updated": time.time()
+            }
+            save_profile(selected_profile)
+        
+        if result == "reconnect":
+            # The profile may have been changed on disk meanwhile
+            selected_profile = next((p for p in load_profiles() if p["name"] == selected_profile["name"]),
+                                    selected_profile)
+            trace = ConnectTrace("reconnect", selected_profile)
+        elif result == "failover":
+            # Never bounce back to a profile that already failed this session
+            failed_profiles.add(selected_profile["name"])
+            candidates = [p for p in rank_profiles(load_profiles(), exclude=selected_profile["name"])
+                          if p["name"] not in failed_profiles]
+            if not candidates:
+                record_event("failover", reason=health.reason, **{"from": selected_profile["name"], "to": None})
+                stop_singbox()
+                show_message(stdscr, f"Connection lost ({health.reason})\nNo other profile to fail over to!", COLOR_RED)
+                return
+            failover = {
+                "from": selected_profile["name"],
+                "reason": health.reason,
+                "breached_at": health.breached_at,
+                "candidates": candidates[1:]
+            }
+            selected_profile = candidates[0]
+            trace = ConnectTrace("failover", selected_profile)
+        else:
+            return result
 
-def connection_screen(stdscr, profile, process):
-    """Active connection screen"""
-    monitor = TrafficMonitor()
+def connection_screen(stdscr, profile, process, health=None, session=None, updates=None, refresh=None,
+                      resources=None):
+    """Active connection screen; updates is a profile watcher queue"""
+    refresh = refresh or RefreshPolicy(load_settings())
+    monitor = TrafficMonitor(session)
+    if not session:
+        save_session(process.pid, profile, monitor)
     start_time = time.time()
+    frame_stats = FrameStats()
+    show_overlay = False
+    tracker = None  # Started the first time the connections view opens
+    status = ""
+    profile_changed = False  # On disk, so [R] rebuilds the config
     
     # Check for public IP
     public_ip = "Checking..."
     
+    def restart_in_place(trace):
+        """Restart sing-box within this session; False when a full reconnect is needed"""
+        nonlocal process
+        # Stale config or sing-box did not come back: the caller rebuilds from scratch
+        restarted = None if profile_changed else restart_tunnel(process, profile, trace)
+        if not restarted:
+            return False
+        # Same session: traffic history and the connections view carry on
+        process = restarted
+        save_session(process.pid, profile, monitor)
+        if health:
+            health.reset()
+        if resources:
+            resources.attach(process.pid)
+        log_message("INFO", f"Reconnected {profile['name']} in {trace.record['total_ms']:.0f} ms")
+        return True
+    
     while True:
+        frame_stats.wake()
+        refresh.wake()
+        frame_start = time.perf_counter()
+        
+        # Changes other tools made on disk
+        while updates:
+            try:
+                kind, name = updates.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "config":
+                # Our own write happened before this screen opened
+                if file_signature(CONFIG) and os.path.getmtime(CONFIG) > start_time:
+                    status = "config.json changed on disk, [R] restarts on it"
+            elif name == profile["name"]:
+                profile_changed = True
+                status = f"Profile {'deleted' if kind == 'deleted' else 'changed'} on disk, [R] reconnects"
+        
+        if refresh.paused():
+            if refresh.hung_up:
+                # This terminal is gone for good: detach like [X], so a UI started
+                # elsewhere reattaches without a second supervisor on the tunnel
+                log_message("INFO", f"Terminal hung up, detaching from {profile['name']}")
+                if tracker:
+                    tracker.stop()
+                return "detach"
+            # In the background, only health is looked after
+            if health and health.breached.is_set() and health.settings["auto_failover"]:
+                if tracker:
+                    tracker.stop()
+                return "failover"
+            if resources and resources.restart_due.is_set():
+                leak = resources.restart_reason
+                log_message("WARN", f"Restarting sing-box: {leak}")
+                record_event("resource_restart", profile=profile["name"], reason=leak)
+                trace = ConnectTrace("reconnect", profile)
+                if not restart_in_place(trace):
+                    if tracker:
+                        tracker.stop()
+                    return "reconnect"
+                status = f"Restarted sing-box in {trace.record['total_ms']:.0f} ms"
+            time.sleep(refresh.interval())
+            continue
+        
         height, width = stdscr.getmaxyx()
         stdscr.clear()
         
@@ -759,8 +4329,32 @@ def connection_screen(stdscr, profile, process):
         stdscr.addstr(info_y, 4, f"Protocol: {profile['protocol'].upper()}", curses.color_pair(COLOR_CYAN))
         stdscr.addstr(info_y + 1, 4, f"IP: {public_ip}", curses.color_pair(COLOR_CYAN))
         
+        if health:
+            h = health.metrics()
+            if h["samples"]:
+                latency = f"{h['latency_ms']:.0f} ms" if h["latency_ms"] is not None else "n/a"
+                health_text = (f"Health: {latency} ±{h['jitter_ms']:.0f} ms, "
+                               f"{h['failure_rate']:.0%} failed, next probe {h['interval']:g}s")
+            else:
+                health_text = "Health: probing..."
+            color = COLOR_GREEN if h["failure_rate"] == 0 else COLOR_YELLOW
+            if health.breached.is_set():
+                # Only seen with auto_failover off, otherwise the screen fails over
+                health_text = f"Health: UNHEALTHY, {health.reason} | {health_text[8:]}"
+                color = COLOR_RED
+            stdscr.addstr(info_y + 2, 4, health_text[:width - 8], curses.color_pair(color))
+        
+        sample = resources.latest() if resources else None
+        if sample and width > 90:
+            usage = f"sing-box: {sample['cpu']:.1f}% CPU, {format_bytes(sample['rss'])}, {sample['fds']} files"
+            stdscr.addstr(info_y + 3, width // 2, usage[:width // 2 - 4], curses.color_pair(COLOR_CYAN))
+            if resources.alert:
+                stdscr.addstr(info_y + 4, width // 2, resources.alert[:width // 2 - 4], curses.color_pair(COLOR_RED))
+        
         # Traffic stats
-        stats = monitor.get_stats()
+        with frame_stats.measure("sample_ms"):
+            stats = monitor.get_stats()
+        refresh.traffic(monitor.history[-1]["rx_speed"] + monitor.history[-1]["tx_speed"])
         elapsed_min = stats["elapsed"] // 60
         elapsed_sec = stats["elapsed"] % 60
         
@@ -795,36 +4389,191 @@ def connection_screen(stdscr, profile, process):
         
         # Footer with controls
         footer_y = height - 3
-        controls = "[D] Details  [S] Speed Test  [R] Reconnect  [Q] Disconnect"
+        interval = refresh.interval()
+        if status:
+            stdscr.addstr(footer_y - 1, (width - len(status)) // 2, status, curses.color_pair(COLOR_GREEN))
+        elif refresh.mode == "idle":
+            note = f"Idle, updating every {interval:g}s - any key for live view"
+            stdscr.addstr(footer_y - 1, (width - len(note)) // 2, note, curses.A_DIM)
+        controls = "[D] Details  [C] Connections  [S] Speed Test  [R] Reconnect  [O] Overlay  [X] Detach  [Q] Disconnect"
         stdscr.addstr(footer_y, (width - len(controls)) // 2, controls, curses.color_pair(COLOR_YELLOW))
         
+        if show_overlay:
+            draw_overlay(stdscr, frame_stats, refresh)
+        
         stdscr.refresh()
+        frame_stats.render_ms.append((time.perf_counter() - frame_start) * 1000)
         
-        # Non-blocking input
-        stdscr.nodelay(1)
+        # Wait for a key until the next update is due
+        stdscr.timeout(int(interval * 1000))
         try:
             key = stdscr.getch()
         except:
             key = -1
-        stdscr.nodelay(0)
+        stdscr.timeout(-1)
+        if key != -1:
+            refresh.key()
+        # leak_restart: sing-box is restarted the same way as with [R]
+        leak = resources.restart_reason if resources and resources.restart_due.is_set() else None
         
         if key == ord('q') or key == ord('Q'):
             break
         elif key == ord('d') or key == ord('D'):
-            show_connection_details(stdscr, profile, stats)
+            show_connection_details(stdscr, profile, stats, resources)
         elif key == ord('s') or key == ord('S'):
             run_speed_test(stdscr)
-        elif key == ord('r') or key == ord('R'):
-            show_message(stdscr, "Reconnecting...", COLOR_YELLOW, False)
-            time.sleep(1)
-            break
+        elif key == ord('r') or key == ord('R') or leak:
+            if leak:
+                log_message("WARN", f"Restarting sing-box: {leak}")
+                record_event("resource_restart", profile=profile["name"], reason=leak)
+            show_message(stdscr, f"sing-box {leak}\nRestarting..." if leak else "Reconnecting...", COLOR_YELLOW, False)
+            trace = ConnectTrace("reconnect", profile)
+            if not restart_in_place(trace):
+                if tracker:
+                    tracker.stop()
+                return "reconnect"
+            status = f"{'Restarted sing-box' if leak else 'Reconnected'} in {trace.record['total_ms']:.0f} ms"
+        elif key == ord('o') or key == ord('O'):
+            show_overlay = not show_overlay
+        elif key == ord('x') or key == ord('X'):
+            # Leave the tunnel up; the next start reattaches to it
+            if tracker:
+                tracker.stop()
+            return "detach"
+        elif key == ord('c') or key == ord('C'):
+            if not tracker:
+                endpoint = clash_api_endpoint()
+                if endpoint:
+                    tracker = ConnectionTracker(endpoint)
+                    tracker.start()
+            if tracker:
+                connections_screen(stdscr, tracker)
+            else:
+                show_message(stdscr, "Connections API is not enabled in the config!", COLOR_RED)
         
-        time.sleep(0.5)
+        if health and health.breached.is_set() and health.settings["auto_failover"]:
+            show_message(stdscr, f"Connection unhealthy ({health.reason})\nFailing over...", COLOR_RED, False)
+            if tracker:
+                tracker.stop()
+            return "failover"
     
     # Cleanup
+    if tracker:
+        tracker.stop()
     stop_singbox()
     show_message(stdscr, "Disconnected!", COLOR_GREEN)
 
+def show_connection_details(stdscr, profile, stats, resources=None):
+    """Profile, traffic and sing-box resource usage; refreshes until a key is pressed"""
+    host, port = profile_endpoint(profile)
+    
+    stdscr.timeout(1000)
+    try:
+        while True:
+            height, width = stdscr.getmaxyx()
+            stdscr.erase()
+            
+            title = f"🔎 Details | {profile['name']}"
+            stdscr.addstr(1, (width - len(title)) // 2, title, curses.color_pair(COLOR_CYAN) | curses.A_BOLD)
+            
+            draw_box(stdscr, 3, 2, 6, width - 4, "Connection")
+            stdscr.addstr(4, 4, f"Protocol: {profile['protocol'].upper()}", curses.color_pair(COLOR_CYAN))
+            stdscr.addstr(5, 4, f"Server: {host}:{port}"[:width - 8], curses.color_pair(COLOR_CYAN))
+            stdscr.addstr(6, 4, f"Download: {stats['rx_total_kb']:,} KB  Upload: {stats['tx_total_kb']:,} KB",
+                          curses.color_pair(COLOR_BLUE))
+            stdscr.addstr(7, 4, f"Uses: {profile.get('usage_count', 0)}", curses.color_pair(COLOR_WHITE))
+            
+            draw_box(stdscr, 10, 2, 13, width - 4, "sing-box Process")
+            sample = resources.latest() if resources else None
+            if not sample:
+                stdscr.addstr(11, 4, "Collecting first sample..." if resources else "Not monitored",
+                              curses.color_pair(COLOR_WHITE))
+            else:
+                history = resources.history()
+                settings = resources.settings
+                uptime = int(time.time() - resources.started)
+                stdscr.addstr(11, 4, f"PID: {sample['pid']}  Up: {uptime // 3600}h {uptime % 3600 // 60:02d}m  "
+                              f"Every: {settings['resource_interval']}s", curses.color_pair(COLOR_WHITE))
+                sockets = sample["sockets"] if sample["sockets"] is not None else "n/a"
+                stdscr.addstr(12, 4, f"CPU: {sample['cpu']:.1f}%  RSS: {format_bytes(sample['rss'])}  "
+                              f"Threads: {sample['threads']}  Files: {sample['fds']}  Sockets: {sockets}",
+                              curses.color_pair(COLOR_CYAN))
+                
+                # Newest samples on the right
+                spark_width = max(0, width - 20)
+                for row, (label, key) in enumerate((("CPU", "cpu"), ("RSS", "rss"), ("Files", "fds"),
+                                                    ("Sockets", "sockets"))):
+                    stdscr.addstr(14 + row, 4, f"{label:<8}", curses.A_BOLD)
+                    stdscr.addstr(14 + row, 13, sparkline([s[key] for s in history], spark_width),
+                                  curses.color_pair(COLOR_GREEN))
+                
+                trends = resources.trends()
+                if trends["rss"] is None:
+                    trend = f"Trend: needs {settings['leak_window_minutes']} min of samples"
+                else:
+                    trend = (f"Trend: RSS {'+' if trends['rss'] >= 0 else '-'}{format_bytes(abs(trends['rss']))}/h, "
+                             f"files {trends['fds'] or 0:+.0f}/h over {settings['leak_window_minutes']} min")
+                stdscr.addstr(19, 4, trend[:width - 8], curses.color_pair(COLOR_YELLOW))
+                restart = "off"
+                if settings["leak_restart"]:
+                    restart = "on" if resources.restart_allowed() else "on, hourly limit reached"
+                stdscr.addstr(20, 4, f"Restart on leak: {restart}", curses.color_pair(COLOR_WHITE))
+                if resources.alert:
+                    stdscr.addstr(21, 4, f"Alert: {resources.alert}"[:width - 8], curses.color_pair(COLOR_RED))
+            
+            footer = "History in ~/.ragevpn/resources.jsonl | Any key: Back"
+            stdscr.addstr(height - 2, (width - len(footer)) // 2, footer, curses.color_pair(COLOR_YELLOW))
+            stdscr.refresh()
+            
+            if stdscr.getch() != -1:
+                break
+    finally:
+        stdscr.timeout(-1)
+
+def connections_screen(stdscr, tracker):
+    """Live traffic per destination domain or routing rule"""
+    kind = "domain"
+    
+    stdscr.timeout(1000)
+    try:
+        while True:
+            height, width = stdscr.getmaxyx()
+            groups, active = tracker.view(kind)
+            
+            stdscr.erase()
+            poll = f"{tracker.poll_ms[-1]:.0f} ms" if tracker.poll_ms else "..."
+            header = f" Connections by {kind} | {active:,} open | {len(groups):,} {kind}s | poll {poll} "
+            stdscr.addstr(0, 0, header[:width - 1].ljust(width - 1), curses.color_pair(COLOR_CYAN) | curses.A_REVERSE)
+            
+            key_width = max(10, width - 48)
+            columns = f"{kind.capitalize():<{key_width}} {'Conns':>6} {'Down/s':>10} {'Up/s':>10} {'Total':>10}"
+            stdscr.addstr(2, 1, columns[:width - 2], curses.A_BOLD)
+            
+            if tracker.error:
+                stdscr.addstr(3, 1, f"API error: {tracker.error}"[:width - 2], curses.color_pair(COLOR_RED))
+            
+            # Only what fits is formatted, the list can be thousands long
+            for i, group in enumerate(groups[:max(0, height - 7)]):
+                key = group["key"]
+                if len(key) > key_width:
+                    key = "…" + key[-(key_width - 1):]
+                line = (f"{key:<{key_width}} {group['conns']:>6} {format_bytes(group['down_rate']):>10} "
+                        f"{format_bytes(group['up_rate']):>10} {format_bytes(group['up'] + group['down']):>10}")
+                color = COLOR_GREEN if group["down_rate"] + group["up_rate"] > 0 else COLOR_WHITE
+                stdscr.addstr(4 + i, 1, line[:width - 2], curses.color_pair(color))
+            
+            footer = "[G] Group by domain/rule  [Q] Back"
+            stdscr.addstr(height - 2, (width - len(footer)) // 2, footer, curses.color_pair(COLOR_YELLOW))
+            stdscr.refresh()
+            
+            key = stdscr.getch()
+            if key in [ord('q'), ord('Q'), 27]:
+                break
+            elif key in [ord('g'), ord('G')]:
+                kind = "rule" if kind == "domain" else "domain"
+    finally:
+        stdscr.timeout(-1)
+
 def profiles_screen(stdscr):
     """Profile management screen"""
     while True:
@@ -863,7 +4612,7 @@ def profiles_screen(stdscr):
         elif (profiles and selected == 5) or (not profiles and selected == 4):
             delete_profile_screen(stdscr, profiles)
         elif (profiles and selected == 6) or (not profiles and selected == 5):
-            test_profile_screen(stdscr, profiles)
+            test_profile_screen(stdscr)
         else:
             break
 
@@ -901,7 +4650,7 @@ def create_profile(stdscr):
         "name": name,
         "protocol": protocol if protocol != "custom url" else "auto",
         "link": link,
-        "created": time.ctime(),
+        "created": time.time(),
         "last_used": 0,
         "usage_count": 0
     }
@@ -920,6 +4669,28 @@ def create_profile(stdscr):
         mtu = input_dialog(stdscr, "MTU size:", "1500")
         if mtu and mtu.isdigit():
             profile["mtu"] = int(mtu)
+        
+        # Tun stack
+        stack_idx = menu(stdscr, "Tun Stack", [
+            "mixed (system TCP, gVisor UDP)",
+            "system (kernel stack)",
+            "gvisor (userspace stack)"
+        ])
+        if stack_idx != -1:
+            profile["stack"] = TUN_STACKS[stack_idx]
+        
+        # Multiplex
+        mux_idx = menu(stdscr, "Multiplex", ["Off"] + list(MULTIPLEX_PROTOCOLS))
+        if mux_idx > 0:
+            profile["multiplex"] = {
+                "protocol": MULTIPLEX_PROTOCOLS[mux_idx - 1],
+                "max_connections": 4,
+                "padding": show_yesno(stdscr, "Enable multiplex padding?\n(the server must allow it)")
+            }
+        
+        # TCP Fast Open
+        if show_yesno(stdscr, "Enable TCP Fast Open?"):
+            profile["tcp_fast_open"] = True
     
     # Save profile
     if save_profile(profile):
@@ -927,6 +4698,57 @@ def create_profile(stdscr):
     else:
         show_message(stdscr, "Failed to save profile!", COLOR_RED)
 
+def import_profile_file(stdscr):
+    """Bulk import profiles from files or directories"""
+    stdscr.clear()
+    
+    paths = input_dialog(stdscr, "Files or directories (comma separated):", os.path.expanduser("~/"))
+    paths = [p.strip() for p in paths.split(",") if p.strip()]
+    if not paths:
+        return
+    
+    show_message(stdscr, "Importing...", COLOR_YELLOW, False)
+    stdscr.refresh()
+    results = import_profiles(paths)
+    stdscr.clear()
+    if not results:
+        show_message(stdscr, "No importable files found!", COLOR_RED)
+        return
+    
+    lines = []
+    for result in results[:12]:
+        rate = (result["profiles"] + len(result["failures"])) / max(result["seconds"], 1e-6)
+        lines.append(f"{os.path.basename(result['path'])} ({result['format']}): "
+                     f"{result['profiles']} imported, {len(result['failures'])} failed, {rate:,.0f}/s")
+    if len(results) > 12:
+        lines.append(f"... and {len(results) - 12} more files")
+    saved = sum(r["profiles"] for r in results)
+    failed = sum(len(r["failures"]) for r in results)
+    lines.append("")
+    lines.append(f"Total: {saved} imported, {failed} failed (details in the log)")
+    show_message(stdscr, "\n".join(lines), COLOR_GREEN if saved else COLOR_RED)
+
+def test_profile_screen(stdscr):
+    """Verify one or all profiles end to end through a local proxy inbound"""
+    profiles, selected = live_profile_menu(stdscr, "Test Profile", ["🧪 All profiles", "← Back"])
+    if selected == -1 or selected == len(profiles) + 1:
+        return
+    targets = profiles if selected == len(profiles) else [profiles[selected]]
+    
+    show_message(stdscr, f"Testing {len(targets)} profile(s)...", COLOR_YELLOW, False)
+    stdscr.refresh()
+    results = list(verify_profiles(targets))
+    stdscr.clear()
+    
+    # Failures first, the screen only fits so many
+    results.sort(key=lambda r: (r["ok"], r["profile"]))
+    lines = [format_verify_result(r) for r in results[:15]]
+    if len(results) > 15:
+        lines.append(f"... and {len(results) - 15} more")
+    passed = sum(r["ok"] for r in results)
+    lines += ["", f"{passed}/{len(results)} passed"]
+    show_message(stdscr, "\n".join(lines), COLOR_GREEN if passed == len(results) else COLOR_RED)
+
 def settings_screen(stdscr):
     """Settings screen"""
     items = [
@@ -970,45 +4792,75 @@ def stats_screen(stdscr):
             "connections": 0
         }
     
-    stdscr.clear()
-    
-    # Title
-    title = "📊 Statistics"
-    stdscr.addstr(1, (width - len(title)) // 2, title, curses.color_pair(COLOR_CYAN) | curses.A_BOLD)
-    
-    # Stats box
-    draw_box(stdscr, 3, 10, 12, width - 20, "Usage Statistics")
-    
-    info_y = 5
-    stdscr.addstr(info_y, 12, f"Total Download: {stats['total_rx'] // (1024*1024):,} MB", curses.color_pair(COLOR_BLUE))
-    stdscr.addstr(info_y + 1, 12, f"Total Upload: {stats['total_tx'] // (1024*1024):,} MB", curses.color_pair(COLOR_MAGENTA))
-    
-    total_gb = (stats['total_rx'] + stats['total_tx']) / (1024**3)
-    stdscr.addstr(info_y + 2, 12, f"Total Traffic: {total_gb:.2f} GB", curses.color_pair(COLOR_GREEN))
-    
-    total_hours = stats['total_time'] // 3600
-    total_minutes = (stats['total_time'] % 3600) // 60
-    stdscr.addstr(info_y + 3, 12, f"Total Time: {total_hours}h {total_minutes}m", curses.color_pair(COLOR_YELLOW))
+    # Connect phase timings, filterable by profile
+    traces = load_traces()
+    trace_profiles = [None] + sorted({t.get("profile") for t in traces if t.get("profile")})
+    trace_filter = 0
+    kind_filter = 0  # Plain connects first, benchmarks and reconnects would skew them
     
-    stdscr.addstr(info_y + 4, 12, f"Connections: {stats['connections']}", curses.color_pair(COLOR_WHITE))
-    
-    # Profile usage
-    profiles = load_profiles()
-    if profiles:
-        draw_box(stdscr, 16, 10, len(profiles) + 3, width - 20, "Profile Usage")
+    while True:
+        stdscr.clear()
+        
+        # Title
+        title = "📊 Statistics"
+        stdscr.addstr(1, (width - len(title)) // 2, title, curses.color_pair(COLOR_CYAN) | curses.A_BOLD)
+        
+        # Stats box
+        draw_box(stdscr, 3, 10, 8, width - 20, "Usage Statistics")
+        
+        info_y = 4
+        stdscr.addstr(info_y, 12, f"Total Download: {stats['total_rx'] // (1024*1024):,} MB", curses.color_pair(COLOR_BLUE))
+        stdscr.addstr(info_y + 1, 12, f"Total Upload: {stats['total_tx'] // (1024*1024):,} MB", curses.color_pair(COLOR_MAGENTA))
+        
+        total_gb = (stats['total_rx'] + stats['total_tx']) / (1024**3)
+        stdscr.addstr(info_y + 2, 12, f"Total Traffic: {total_gb:.2f} GB", curses.color_pair(COLOR_GREEN))
+        
+        total_hours = stats['total_time'] // 3600
+        total_minutes = (stats['total_time'] % 3600) // 60
+        stdscr.addstr(info_y + 3, 12, f"Total Time: {total_hours}h {total_minutes}m", curses.color_pair(COLOR_YELLOW))
+        
+        stdscr.addstr(info_y + 4, 12, f"Connections: {stats['connections']}", curses.color_pair(COLOR_WHITE))
+        
+        # Connect phases
+        profile_filter = trace_profiles[trace_filter]
+        kind = TRACE_KINDS[kind_filter]
+        summary = summarize_traces(traces, profile_filter, kind)
+        phases_y = 12
+        phases_height = len(summary) + 4
+        draw_box(stdscr, phases_y, 10, phases_height, width - 20,
+                 f"Connect Phases ({kind}, {profile_filter or 'all profiles'})")
+        
+        stdscr.addstr(phases_y + 1, 12, f"{'Phase':<18}{'p50 ms':>10}{'p95 ms':>10}{'n':>6}", curses.A_BOLD)
+        if not summary:
+            stdscr.addstr(phases_y + 2, 12, f"No {kind} attempts recorded", curses.color_pair(COLOR_WHITE))
+        for i, (phase, row) in enumerate(summary.items()):
+            stdscr.addstr(phases_y + 2 + i, 12,
+                          f"{phase:<18}{row['p50']:>10.0f}{row['p95']:>10.0f}{row['count']:>6}",
+                          curses.color_pair(COLOR_WHITE))
+        
+        # Profile usage, as much as fits
+        profiles = load_profiles()
+        usage_y = phases_y + phases_height + 1
+        rows = min(len(profiles), 10, height - usage_y - 5)
+        if rows > 0:
+            draw_box(stdscr, usage_y, 10, rows + 3, width - 20, "Profile Usage")
+            
+            for i, profile in enumerate(profiles[:rows]):
+                usage = profile.get("usage_count", 0)
+                name = profile["name"][:20]
+                stdscr.addstr(usage_y + 2 + i, 12, f"{name}: {usage} connections", curses.color_pair(COLOR_WHITE))
+        
+        footer = "[F] Filter Profile  [K] Attempt Kind  [R] Reset Stats  [Q] Back"
+        stdscr.addstr(height - 2, (width - len(footer)) // 2, footer, curses.color_pair(COLOR_YELLOW))
+        stdscr.refresh()
         
-        for i, profile in enumerate(profiles[:10]):  # Show top 10
-            usage = profile.get("usage_count", 0)
-            name = profile["name"][:20]
-            stdscr.addstr(18 + i, 12, f"{name}: {usage} connections", curses.color_pair(COLOR_WHITE))
-    
-    stdscr.addstr(height - 2, (width - 20) // 2, "[R] Reset Stats  [Q] Back", curses.color_pair(COLOR_YELLOW))
-    stdscr.refresh()
-    
-    while True:
         key = stdscr.getch()
         if key == ord('q') or key == ord('Q'):
             break
+        elif key == ord('f') or key == ord('F'):
+            trace_filter = (trace_filter + 1) % len(trace_profiles)
+        elif key == ord('k') or key == ord('K'):
+            kind_filter = (kind_filter + 1) % len(TRACE_KINDS)
         elif key == ord('r') or key == ord('R'):
             if show_yesno(stdscr, "Reset all statistics?"):
                 with open(stats_file, "w") as f:
@@ -1029,6 +4881,7 @@ def tools_screen(stdscr):
         "🌐 DNS Lookup",
         "🔧 Config Editor",
         "🧹 Cleanup",
+        "📜 Logs",
         "← Back"
     ]
     
@@ -1044,9 +4897,328 @@ def tools_screen(stdscr):
         config_editor(stdscr)
     elif selected == 4:
         cleanup_tool(stdscr)
+    elif selected == 5:
+        logs_screen(stdscr)
     else:
         return
 
+def logs_screen(stdscr):
+    """Pick a log to view"""
+    logs = [("RAGEVPN log", LOG_FILE), ("sing-box log", SINGBOX_LOG)]
+    items = [name for name, _ in logs] + ["← Back"]
+    
+    selected = menu(stdscr, "Logs", items)
+    if 0 <= selected < len(logs):
+        title, path = logs[selected]
+        log_viewer(stdscr, path, title)
+
+# ========== LOG VIEWER ==========
+# Level filters, matched near the start of a line
+LOG_FILTERS = [
+    ("ALL", ()),
+    ("WARN+", (b"WARN", b"ERROR", b"FATAL", b"PANIC")),
+    ("ERROR+", (b"ERROR", b"FATAL", b"PANIC"))
+]
+
+class LogView:
+    """Line navigation over a log file through mmap
+    
+    Positions are byte offsets of line starts. Moving around only scans
+    the bytes between the old and new position, so opening or tailing a
+    multi-gigabyte log costs the same as a small one.
+    """
+    
+    SCAN_WINDOW = 4 * 1024 * 1024
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.size = 0
+        self.levels = ()
+        self._key = None
+        # Filtered lookups can scan far; appends never change what lies before a position
+        self._prev_cache = {}
+        self._next_cache = {}
+    
+    def refresh(self):
+        """Remap after the file grew or was rotated; True if it changed"""
+        try:
+            stat = os.stat(self.path)
+            key = (stat.st_ino, stat.st_size)
+        except OSError:
+            key = None
+        if key == self._key:
+            return False
+        
+        grew = key and self._key and key[0] == self._key[0] and key[1] > self._key[1]
+        if not grew:
+            self._prev_cache.clear()
+        self._next_cache.clear()
+        self.close()
+        self._key = key
+        if key and key[1]:
+            try:
+                self.file = open(self.path, "rb")
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.size = len(self.map)
+            except (OSError, ValueError):
+                self.close()
+        return True
+    
+    def close(self):
+        if self.map:
+            self.map.close()
+        if self.file:
+            self.file.close()
+        self.file = self.map = None
+        self.size = 0
+    
+    def line_start(self, pos):
+        """Start of the line containing pos"""
+        return self.map.rfind(b"\n", 0, pos) + 1
+    
+    def line(self, start, limit=1024):
+        """Text of the line at start, cut at limit bytes"""
+        end = self.map.find(b"\n", start, start + limit)
+        if end < 0:
+            end = min(self.size, start + limit)
+        return self.map[start:end].decode("utf-8", "replace").replace("\t", " ")
+    
+    def matches(self, start):
+        """Whether the line at start passes the level filter"""
+        if not self.levels:
+            return True
+        head = self.map[start:start + 80].split(b"\n", 1)[0]
+        return any(level in head for level in self.levels)
+    
+    def _find_level(self, start, backward):
+        """Offset of the closest level token before or after start, or -1"""
+        if backward:
+            hi = start
+            while hi > 0:
+                lo = max(0, hi - self.SCAN_WINDOW)
+                hit = max(self.map.rfind(level, lo, hi) for level in self.levels)
+                if hit >= 0 or lo == 0:
+                    return hit
+                hi = lo + 8  # Overlap so a token across the boundary is seen
+            return -1
+        
+        lo = start
+        while lo < self.size:
+            hi = min(self.size, lo + self.SCAN_WINDOW)
+            hits = [hit for hit in (self.map.find(level, lo, hi) for level in self.levels) if hit >= 0]
+            if hits:
+                return min(hits)
+            if hi == self.size:
+                break
+            lo = hi - 8
+        return -1
+    
+    def prev(self, start):
+        """Start of the previous line passing the filter, or None"""
+        if not self.levels:
+            return self.line_start(start - 1) if start > 0 else None
+        
+        cache_key = (self.levels, start)
+        if cache_key not in self._prev_cache:
+            found = None
+            pos = start
+            while pos > 0:
+                # Jump straight to the closest line mentioning a wanted level
+                hit = self._find_level(pos - 1, backward=True)
+                if hit < 0:
+                    break
+                pos = self.line_start(hit)
+                if self.matches(pos):
+                    found = pos
+                    break
+            if len(self._prev_cache) > 10000:
+                self._prev_cache.clear()
+            self._prev_cache[cache_key] = found
+        return self._prev_cache[cache_key]
+    
+    def next(self, start):
+        """Start of the next line passing the filter, or None"""
+        cache_key = (self.levels, start)
+        if self.levels and cache_key in self._next_cache:
+            return self._next_cache[cache_key]
+        
+        found = None
+        pos = start
+        while True:
+            end = self.map.find(b"\n", pos)
+            if end < 0 or end + 1 >= self.size:
+                break
+            pos = end + 1
+            if self.levels:
+                hit = self._find_level(pos, backward=False)
+                if hit < 0:
+                    break
+                pos = self.line_start(hit)
+            if self.matches(pos):
+                found = pos
+                break
+        
+        if self.levels:
+            if len(self._next_cache) > 10000:
+                self._next_cache.clear()
+            self._next_cache[cache_key] = found
+        return found
+    
+    def first(self):
+        if not self.size:
+            return None
+        return 0 if self.matches(0) else self.next(0)
+    
+    def search(self, query, start, backward=False):
+        """Line start of the next match of query after (or before) start"""
+        needle = query.encode()
+        pos = start
+        while True:
+            if backward:
+                hit = self.map.rfind(needle, 0, max(pos - 1, 0))
+            else:
+                end = self.map.find(b"\n", pos)
+                hit = -1 if end < 0 else self.map.find(needle, end + 1)
+            if hit < 0:
+                return None
+            pos = self.line_start(hit)
+            if self.matches(pos):
+                return pos
+
+def log_viewer(stdscr, path, title):
+    """Tail a log file with level filter and search"""
+    view = LogView(path)
+    top = None  # None follows the end of the file
+    filter_index = 0
+    query = ""
+    status = ""
+    
+    stdscr.timeout(1000)
+    try:
+        while True:
+            height, width = stdscr.getmaxyx()
+            rows = max(1, height - 4)
+            
+            if view.refresh() and top is not None and top >= view.size:
+                top = None
+            
+            # Lines on screen
+            lines = []
+            if view.size:
+                if top is None:
+                    start = view.size
+                    for _ in range(rows):
+                        previous = view.prev(start)
+                        if previous is None:
+                            break
+                        start = previous
+                    lines = [start] if start < view.size and view.matches(start) else []
+                else:
+                    lines = [top]
+                while lines and len(lines) < rows:
+                    following = view.next(lines[-1])
+                    if following is None:
+                        break
+                    lines.append(following)
+                if top is not None and len(lines) < rows:
+                    # Scrolled past the end, go back to following
+                    top = None
+                    continue
+            
+            stdscr.erase()
+            level_name = LOG_FILTERS[filter_index][0]
+            position = "END" if top is None else f"{top * 100 // max(view.size, 1)}%"
+            header = f" {title} | {view.size / 1048576:.1f} MB | Level: {level_name} | {position} "
+            stdscr.addstr(0, 0, header[:width - 1].ljust(width - 1), curses.color_pair(COLOR_CYAN) | curses.A_REVERSE)
+            
+            if not lines:
+                stdscr.addstr(2, 2, "Log is empty" if not view.size else "No lines at this level",
+                             curses.color_pair(COLOR_YELLOW))
+            
+            for i, start in enumerate(lines):
+                text = view.line(start)
+                head = text[:40]
+                if "ERROR" in head or "FATAL" in head or "PANIC" in head:
+                    color = COLOR_RED
+                elif "WARN" in head:
+                    color = COLOR_YELLOW
+                elif text.startswith("-----"):
+                    color = COLOR_CYAN
+                else:
+                    color = COLOR_WHITE
+                attr = curses.color_pair(color)
+                if query and query in text:
+                    attr |= curses.A_REVERSE
+                stdscr.addstr(1 + i, 0, text[:width - 1], attr)
+            
+            footer = "↑↓ PgUp/PgDn Home/End | L: Level | /: Search  n/N: Next/Prev | Q: Back"
+            if status:
+                stdscr.addstr(height - 2, 0, status[:width - 1], curses.color_pair(COLOR_YELLOW))
+            stdscr.addstr(height - 1, 0, footer[:width - 1], curses.color_pair(COLOR_BLUE))
+            stdscr.refresh()
+            
+            key = stdscr.getch()
+            if key == -1:
+                continue
+            status = ""
+            current = lines[0] if lines else None
+            
+            if key in [ord('q'), ord('Q'), 27]:
+                break
+            elif current is None:
+                if key in [ord('l'), ord('L')]:
+                    filter_index = (filter_index + 1) % len(LOG_FILTERS)
+                    view.levels = LOG_FILTERS[filter_index][1]
+                continue
+            elif key == curses.KEY_UP:
+                previous = view.prev(current)
+                if previous is not None:
+                    top = previous
+            elif key == curses.KEY_DOWN:
+                if top is not None:
+                    following = view.next(current)
+                    if following is not None:
+                        top = following
+            elif key == curses.KEY_PPAGE:
+                for _ in range(rows - 1):
+                    previous = view.prev(current)
+                    if previous is None:
+                        break
+                    current = previous
+                top = current
+            elif key == curses.KEY_NPAGE:
+                if top is not None:
+                    top = lines[-1]
+            elif key == curses.KEY_HOME:
+                top = view.first()
+            elif key == curses.KEY_END:
+                top = None
+            elif key in [ord('l'), ord('L')]:
+                filter_index = (filter_index + 1) % len(LOG_FILTERS)
+                view.levels = LOG_FILTERS[filter_index][1]
+                # Keep roughly the same place in the file
+                if top is not None:
+                    top = current if view.matches(current) else (view.next(current) or view.prev(current))
+            elif key in [ord('/'), ord('n'), ord('N')]:
+                if key == ord('/'):
+                    query = input_dialog(stdscr, "Search (case-sensitive):", query)
+                    if not query:
+                        continue
+                elif not query:
+                    continue
+                # While following, search back from the newest lines
+                backward = key == ord('N') or (key == ord('/') and top is None)
+                found = view.search(query, current if not backward or top is not None else view.size, backward)
+                if found is None:
+                    status = f"'{query}' not found"
+                else:
+                    top = found
+    finally:
+        stdscr.timeout(-1)
+        view.close()
+
 def about_screen(stdscr):
     """About screen"""
     height, width = stdscr.getmaxyx()
@@ -1232,11 +5404,1071 @@ def run_speed_test(stdscr):
     except:
         show_message(stdscr, "Speed test failed!", COLOR_RED)
 
+# ========== TUNNEL BENCHMARK ==========
+BENCH_MTUS = (1280, 1380, 1420, 1460, 1500)
+
+def serve_bulk(port, host="0.0.0.0"):
+    """Bulk source stand-in: a client sends a byte count, gets that many bytes back"""
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                count = int(self.request.recv(32).split(b"\n", 1)[0])
+            except ValueError:
+                return
+            block = b"\0" * 65536
+            while count > 0:
+                sent = self.request.send(block[:min(count, len(block))])
+                count -= sent
+    
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure_bulk(host, port, count, timeout=30):
+    """Download count bytes from a bulk source, in MB/s (None on failure)"""
+    buf = bytearray(65536)
+    received = 0
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            start = time.perf_counter()
+            sock.sendall(f"{count}\n".encode())
+            while received < count:
+                n = sock.recv_into(buf)
+                if not n:
+                    break
+                received += n
+            elapsed = time.perf_counter() - start
+    except OSError:
+        return None
+    if received < count:
+        return None
+    return count / elapsed / 1024 / 1024
+
+def benchmark_tunnel(profile, mtus=BENCH_MTUS, stacks=TUN_STACKS, rounds=3):
+    """Bring the tunnel up for every MTU x stack pair and time a bulk download
+    
+    The bulk source is settings bench_host:bench_port, or a local stand-in
+    when bench_host is empty. Traffic to the stand-in stays on loopback and
+    never enters the tun, so then only startup is tested and the speeds are
+    noise. Yields (mtu, stack, MB/s or None).
+    """
+    settings = load_settings()
+    host, port = settings["bench_host"], settings["bench_port"]
+    server = None
+    if not host:
+        server = serve_bulk(0)
+        host, port = "127.0.0.1", server.server_address[1]
+    
+    try:
+        for mtu in mtus:
+            for stack in stacks:
+                trace = ConnectTrace("bench", profile)
+                config = apply_tun_params(build_singbox_config(profile), mtu, stack)
+                with open(CONFIG, "w") as f:
+                    json.dump(config, f, indent=2)
+                stop_singbox()
+                process = launch_singbox(trace, settings)
+                if not process:
+                    yield mtu, stack, None
+                    continue
+                
+                speeds = [measure_bulk(host, port, settings["bench_bytes"]) for _ in range(rounds)]
+                speeds = [s for s in speeds if s is not None]
+                stop_process(process)
+                yield mtu, stack, percentile(speeds, 50) if speeds else None
+    finally:
+        stop_singbox()
+        if server:
+            server.shutdown()
+
+def url_first_byte(url, timeout=10):
+    """ms from resolving an http:// URL's host to the first response byte"""
+    parsed = urlparse(url)
+    start = time.perf_counter()
+    try:
+        family, kind, proto, _, address = socket.getaddrinfo(parsed.hostname, parsed.port or 80,
+                                                             type=socket.SOCK_STREAM)[0]
+        with socket.socket(family, kind, proto) as sock:
+            sock.settimeout(timeout)
+            sock.connect(address)
+            sock.sendall(f"GET {parsed.path or '/'} HTTP/1.1\r\nHost: {parsed.hostname}\r\n"
+                         "Connection: close\r\n\r\n".encode())
+            if sock.recv(1):
+                return (time.perf_counter() - start) * 1000
+    except OSError:
+        pass
+    return None
+
+BENCH_DIR = os.path.join(CACHE, "bench")
+
+def benchmark_cache(profile, rounds=5):
+    """First-request latency after each reconnect, without and with the cache file
+    
+    The request goes to settings cache_probe_url by name, so it includes
+    the DNS lookup that a warm fakeip / rdrc cache answers. One untimed
+    connect per mode fills the cache first. Runs on its own config and a
+    throwaway cache in CACHE/bench, so the profile's real cache is left
+    alone; it brings up the tun, so it refuses to run while connected.
+    Yields (mode, [ms or None]).
+    """
+    if load_session():
+        raise RuntimeError("a tunnel is running, disconnect it first")
+    settings = load_settings()
+    url = settings["cache_probe_url"]
+    slug = re.sub(r"[^\w.-]+", "_", profile["name"])[:40]
+    config_path = os.path.join(BENCH_DIR, f"{slug}.json")
+    cache_path = os.path.join(BENCH_DIR, f"{slug}.db")
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    try:
+        for mode in ("off", "on"):
+            config = build_singbox_config(profile)
+            config.get("experimental", {}).pop("cache_file", None)
+            if mode == "on":
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+                apply_cache_file(config, profile, {**settings, "cache_file": True}, cache_path)
+            with open(config_path, "w") as f:
+                json.dump(config, f, indent=2)
+            
+            samples = []
+            process = launch_singbox(ConnectTrace("bench", profile), settings, config_path)
+            try:
+                if process:
+                    url_first_byte(url)
+                    for _ in range(rounds):
+                        stop_process(process)
+                        process = launch_singbox(ConnectTrace("bench", profile), settings, config_path)
+                        if not process:
+                            break
+                        samples.append(url_first_byte(url))
+            finally:
+                if process:
+                    stop_process(process)
+            yield mode, samples
+    finally:
+        for leftover in (config_path, cache_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+SETUP_VARIANTS = [
+    ("plain", None, False),
+    ("tcp_fast_open", None, True),
+    ("smux", {"protocol": "smux"}, False),
+    ("yamux", {"protocol": "yamux"}, False),
+    ("h2mux", {"protocol": "h2mux"}, False),
+    ("h2mux+padding", {"protocol": "h2mux", "padding": True}, False)
+]
+
+def serve_reply(port=0, host="127.0.0.1"):
+    """Target stand-in: answers any request with an empty HTTP 200"""
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            if self.request.recv(4096):
+                self.request.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    
+    server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+    # The default backlog of 5 drops SYNs under connect races and benchmarks
+    server.request_queue_size = socket.SOMAXCONN
+    server.server_bind()
+    server.server_activate()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def proxy_config(outbound, port):
+    """Minimal client config: a local mixed (HTTP/SOCKS) inbound to one outbound"""
+    return {
+        "log": {"level": "warn", "timestamp": True, "disable_color": True},
+        "inbounds": [{"type": "mixed", "listen": "127.0.0.1", "listen_port": port}],
+        "outbounds": [{**outbound, "tag": "proxy"}, {"type": "direct", "tag": "direct"}]
+    }
+
+def wait_for_port(port, process, timeout=5):
+    """Wait until something accepts on 127.0.0.1:port or the process exits"""
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def proxy_first_byte(proxy_port, host, port, timeout=5):
+    """ms from connecting to a local HTTP proxy until host:port answers through it"""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection(("127.0.0.1", proxy_port), timeout=timeout) as sock:
+            sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+            reply = b""
+            while b"\r\n\r\n" not in reply:
+                chunk = sock.recv(1024)
+                if not chunk:
+                    return None
+                reply += chunk
+            if b" 200" not in reply.split(b"\r\n", 1)[0]:
+                return None
+            sock.sendall(f"HEAD / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            if sock.recv(1):
+                return (time.perf_counter() - start) * 1000
+    except OSError:
+        pass
+    return None
+
+def run_config(config, name):
+    """Write a throwaway config under CACHE/bench and start sing-box on it"""
+    path = os.path.join(CACHE, "bench", f"{name}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+    return sh(["sing-box", "run", "-c", path], background=True)
+
+def benchmark_setup(profile=None, connections=20):
+    """Connection setup latency for each multiplex / TFO variant
+    
+    With a profile, connections go through its server to the probe
+    target. Without one, a local sing-box shadowsocks server and a local
+    HTTP responder stand in for both. Yields (variant, result dict).
+    """
+    settings = load_settings()
+    servers = []
+    if profile:
+        base = profile.outbound if isinstance(profile, Profile) else parse_link(profile["protocol"], profile["link"])
+        host, port = settings["probe_host"], settings["probe_port"]
+    else:
+        target = serve_reply()
+        servers.append(target)
+        host, port = target.server_address
+        standin_port = free_port()
+        password = secrets.token_hex(8)
+        base = {"type": "shadowsocks", "server": "127.0.0.1", "server_port": standin_port,
+                "method": "aes-128-gcm", "password": password}
+    
+    try:
+        for name, multiplex, tcp_fast_open in SETUP_VARIANTS:
+            processes = []
+            try:
+                if not profile:
+                    # The stand-in rejects unpadded streams once padding is on, so match it
+                    standin = run_config({
+                        "log": {"level": "warn", "disable_color": True},
+                        "inbounds": [{
+                            "type": "shadowsocks", "listen": "127.0.0.1", "listen_port": standin_port,
+                            "tcp_fast_open": True, "method": "aes-128-gcm", "password": password,
+                            "multiplex": {"enabled": True, "padding": bool(multiplex and multiplex.get("padding"))}
+                        }],
+                        "outbounds": [{"type": "direct"}]
+                    }, "standin")
+                    if not standin or not wait_for_port(standin_port, standin):
+                        processes.append(standin)
+                        yield name, None
+                        continue
+                    processes.append(standin)
+                
+                proxy_port = free_port()
+                outbound = apply_dial_options(dict(base), multiplex, tcp_fast_open)
+                client = run_config(proxy_config(outbound, proxy_port), "client")
+                if client:
+                    processes.append(client)
+                if not client or not wait_for_port(proxy_port, client):
+                    yield name, None
+                    continue
+                
+                timings = [proxy_first_byte(proxy_port, host, port) for _ in range(connections)]
+                ok = [t for t in timings[1:] if t is not None]
+                yield name, {
+                    "cold_ms": timings[0],
+                    "p50_ms": percentile(ok, 50) if ok else None,
+                    "p95_ms": percentile(ok, 95) if ok else None,
+                    "failed": timings.count(None)
+                }
+            finally:
+                for process in processes:
+                    if process:
+                        stop_process(process)
+    finally:
+        for server in servers:
+            server.shutdown()
+
+# ========== FLEET RENDER ==========
+# Configs for many hosts from one template. FLEET_DIR/base.json holds what
+# all hosts share, FLEET_DIR/hosts/<host>.json what differs per host; the
+# host value wins, bypass lists add up. Keys:
+#   profiles      profile names behind the "proxy" selector, first is the default (base only)
+#   dns_servers   DNS server list
+#   dns_strategy  prefer_ipv4 / prefer_ipv6 / ipv4_only / ipv6_only (default prefer_ipv4)
+#   ipv6          true adds IPv6 to the tun and fakeip ranges (default false)
+#   mtu, stack    tun parameters
+#   tun           fields merged into the tun inbound (interface_name, auto_route, ...)
+#   inbounds      extra inbounds, e.g. a mixed proxy for the LAN
+#   bypass        entries in rule-list syntax, routed direct
+#   merge         anything else, deep-merged into the config last (null deletes a key)
+# Nothing else comes from this machine: no settings.json, family races,
+# caches or rule lists. Output goes to FLEET_DIR/out/<host>.json and is
+# only rewritten, and checked with sing-box, when its content hash changes.
+FLEET_DIR = os.path.join(BASE, "fleet")
+FLEET_STATE = ".render-state.json"
+FLEET_RESERVED_TAGS = ("proxy", "direct", "block")
+
+def deep_merge(target, patch):
+    """target with patch merged in: dicts recursively, anything else replaced, None deletes"""
+    merged = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def remote_geo_rules(cfg):
+    """geoip/geosite rules as remote rule-sets each host downloads, like apply_geo_data without the local cache"""
+    route = cfg["route"]
+    rules = []
+    for rule in route["rules"]:
+        if "geoip" not in rule and "geosite" not in rule:
+            rules.append(rule)
+            continue
+        rest = {k: v for k, v in rule.items() if k not in ("geoip", "geosite")}
+        tags = []
+        for kind in ("geoip", "geosite"):
+            for code in rule.get(kind) or []:
+                if kind == "geoip" and code == "private":
+                    rules.append({**rest, "ip_is_private": True})
+                    continue
+                tag = f"{kind}-{code}"
+                tags.append(tag)
+                if not any(r["tag"] == tag for r in route.get("rule_set", [])):
+                    route.setdefault("rule_set", []).append(
+                        {"type": "remote", "tag": tag, "format": "binary", "url": GEO_URLS[kind].format(code=code)})
+        if tags:
+            rules.append({**rest, "rule_set": tags})
+    route["rules"] = rules
+    return cfg
+
+def fleet_base_config(profiles):
+    """Config shared by all hosts: fixed defaults, every profile behind a "proxy" selector"""
+    proxies = []
+    for profile in profiles:
+        outbound = profile.outbound if isinstance(profile, Profile) else profile.get("outbound")
+        if not outbound:
+            log_message("WARN", f"Fleet: skipping {profile['name']}, link could not be parsed")
+            continue
+        tag = profile["name"] if profile["name"] not in FLEET_RESERVED_TAGS else f"{profile['name']} (profile)"
+        proxies.append(apply_dial_options({**outbound, "tag": tag}, profile.get("multiplex"),
+                                          profile.get("tcp_fast_open")))
+    if not proxies:
+        raise ValueError("none of the profiles can be rendered")
+    
+    selector = {"type": "selector", "tag": "proxy", "outbounds": [p["tag"] for p in proxies],
+                "default": proxies[0]["tag"]}
+    cfg = remote_geo_rules(singbox_template(selector))
+    cfg["outbounds"][1:1] = proxies
+    return cfg
+
+def bypass_rules(entries):
+    """Direct route rules from entries in rule-list syntax"""
+    parsed = {"cidr": [], "domain": [], "suffix": []}
+    for line in entries:
+        entry = parse_rule_line(line)
+        if entry:
+            parsed[entry[0]].append(entry[1])
+    suffixes, domains = collapse_domains(parsed["suffix"], parsed["domain"])
+    rules = []
+    if domains or suffixes:
+        rule = {"outbound": "direct"}
+        if domains:
+            rule["domain"] = domains
+        if suffixes:
+            rule["domain_suffix"] = suffixes
+        rules.append(rule)
+    if parsed["cidr"]:
+        rules.append({"ip_cidr": collapse_cidrs(parsed["cidr"]), "outbound": "direct"})
+    return rules
+
+def render_host(base_cfg, base_spec, host_spec):
+    """One host's config from the shared config and the base and host settings"""
+    spec = {**base_spec, **host_spec}
+    cfg = json.loads(json.dumps(base_cfg))  # Deep copy, the base is shared
+    
+    if "dns_servers" in spec:
+        cfg["dns"]["servers"] = list(spec["dns_servers"])
+    if "dns_strategy" in spec:
+        if spec["dns_strategy"] not in DNS_STRATEGIES:
+            raise ValueError(f"unknown dns_strategy {spec['dns_strategy']!r}")
+        cfg["dns"]["strategy"] = spec["dns_strategy"]
+    
+    tun = next((inbound for inbound in cfg["inbounds"] if inbound["type"] == "tun"), None)
+    if spec.get("ipv6"):
+        cfg["dns"]["fakeip"]["inet6_range"] = FAKEIP_INET6
+        if tun:
+            tun["inet6_address"] = TUN_INET6
+    if tun:
+        apply_tun_params(cfg, spec.get("mtu", tun["mtu"]), spec.get("stack", tun["stack"]))
+        tun.update(spec.get("tun", {}))
+    cfg["inbounds"] += spec.get("inbounds", [])
+    
+    # Right after the DNS rule, like the bypass list
+    cfg["route"]["rules"][1:1] = bypass_rules(base_spec.get("bypass", []) + host_spec.get("bypass", []))
+    
+    return deep_merge(cfg, deep_merge(base_spec.get("merge", {}), host_spec.get("merge", {})))
+
+_fleet_base = None  # (base config, base spec) in render worker processes
+
+def _init_fleet_worker(base_cfg, base_spec):
+    global _fleet_base
+    _fleet_base = (base_cfg, base_spec)
+
+def _render_fleet_host(job):
+    """Render, compare and, if changed, check and write one host (runs in a worker)"""
+    host, spec_path, output, old_hash, check = job
+    result = {"host": host, "status": "failed", "error": None, "sha256": old_hash}
+    try:
+        with open(spec_path, "r") as f:
+            host_spec = json.load(f)
+        text = json.dumps(render_host(*_fleet_base, host_spec), indent=2, ensure_ascii=False) + "\n"
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    if old_hash is None and os.path.exists(output):
+        old_hash = file_sha256(output)  # No state yet, compare with what is there
+    if digest == old_hash and os.path.exists(output):
+        return {**result, "status": "unchanged", "sha256": digest}
+    
+    tmp = f"{output}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    if check:
+        checked = sh(["sing-box", "check", "-c", tmp])
+        if not checked or checked.returncode != 0:
+            os.remove(tmp)
+            lines = (checked.stderr + checked.stdout).strip().splitlines() if checked else []
+            result["error"] = lines[-1][:200] if lines else "sing-box check did not run"
+            return result
+    os.replace(tmp, output)
+    return {**result, "status": "written", "sha256": digest}
+
+def render_fleet(fleet_dir=FLEET_DIR, workers=None, check=True):
+    """Render every host under fleet_dir in a process pool; yields one result per host
+    
+    Results are {host, status, error, sha256} with status written,
+    unchanged, failed or removed (output of a host file that is gone).
+    """
+    with open(os.path.join(fleet_dir, "base.json"), "r") as f:
+        base_spec = json.load(f)
+    profiles = load_profiles()
+    if "profiles" in base_spec:
+        by_name = {p["name"]: p for p in profiles}
+        missing = [name for name in base_spec["profiles"] if name not in by_name]
+        if missing:
+            raise ValueError(f"unknown profiles: {', '.join(missing)}")
+        profiles = [by_name[name] for name in base_spec["profiles"]]
+    if not profiles:
+        raise ValueError("no profiles to render")
+    base_cfg = fleet_base_config(profiles)
+    
+    hosts_dir = os.path.join(fleet_dir, "hosts")
+    out_dir = os.path.join(fleet_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    state_path = os.path.join(out_dir, FLEET_STATE)
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    
+    hosts = sorted(f[:-5] for f in os.listdir(hosts_dir) if f.endswith(".json"))
+    jobs = [(host, os.path.join(hosts_dir, f"{host}.json"), os.path.join(out_dir, f"{host}.json"),
+             state.get(host), check) for host in hosts]
+    workers = workers or os.cpu_count() or 1
+    new_state = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_fleet_worker,
+                                 initargs=(base_cfg, base_spec)) as pool:
+            for result in pool.map(_render_fleet_host, jobs, chunksize=max(1, len(jobs) // (workers * 4))):
+                if result["sha256"]:
+                    new_state[result["host"]] = result["sha256"]
+                yield result
+        
+        for host in sorted(set(state) - set(hosts)):
+            output = os.path.join(out_dir, f"{host}.json")
+            if os.path.exists(output):
+                os.remove(output)
+            yield {"host": host, "status": "removed", "error": None, "sha256": None}
+    finally:
+        tmp = state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(new_state, f, indent=2)
+        os.replace(tmp, state_path)
+
+# ========== FLEET VALIDATION ==========
+# Many profiles at once, each tunnel in its own network namespace with its
+# own tun interface, config file and sing-box child. Namespaces reach the
+# servers over a veth pair NATed through the host. Needs root and iproute2.
+VALIDATE_DIR = os.path.join(CACHE, "validate")
+VALIDATE_REPORT = os.path.join(BASE, "validation.json")
+NETNS_SUBNET = "10.201.0.0/16"  # 10.201.<slot>.0/30 per namespace
+NETNS_MAX = 250
+CLONE_NEWNET = 0x40000000
+
+def setns(fd):
+    """Move the calling thread into the network namespace behind fd"""
+    if hasattr(os, "setns"):
+        os.setns(fd, CLONE_NEWNET)
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+@contextmanager
+def in_netns(name):
+    """Run the block's sockets inside a named namespace (this thread only)"""
+    original = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+    target = os.open(f"/run/netns/{name}", os.O_RDONLY)
+    try:
+        setns(target)
+        yield
+    finally:
+        setns(original)
+        os.close(target)
+        os.close(original)
+
+def run_ip(*args):
+    """Run an iproute2 command, raising RuntimeError on failure"""
+    result = sh(["ip", *args])
+    if not result or result.returncode != 0:
+        raise RuntimeError(f"ip {' '.join(args)}: {result.stderr.strip() if result else 'not available'}")
+    return result.stdout
+
+class NetnsSlot:
+    """One namespace with a veth uplink, reused for profile after profile"""
+    
+    def __init__(self, index):
+        self.index = index
+        self.name = f"ragevpn-v{index}"
+        self.host_if = f"rvh{index}"
+        self.ns_if = f"rvn{index}"
+        self.tun = f"rvt{index}"
+        self.gateway = f"10.201.{index}.1"
+        self.address = f"10.201.{index}.2"
+        self.config = os.path.join(VALIDATE_DIR, f"{self.name}.json")
+        self.log = os.path.join(VALIDATE_DIR, f"{self.name}.log")
+    
+    def create(self):
+        """Namespace, veth pair, addresses and default route"""
+        self.destroy()
+        run_ip("netns", "add", self.name)
+        run_ip("link", "add", self.host_if, "type", "veth", "peer", "name", self.ns_if)
+        run_ip("link", "set", self.ns_if, "netns", self.name)
+        run_ip("addr", "add", f"{self.gateway}/30", "dev", self.host_if)
+        run_ip("link", "set", self.host_if, "up")
+        run_ip("-n", self.name, "addr", "add", f"{self.address}/30", "dev", self.ns_if)
+        run_ip("-n", self.name, "link", "set", self.ns_if, "up")
+        run_ip("-n", self.name, "link", "set", "lo", "up")
+        run_ip("-n", self.name, "route", "add", "default", "via", self.gateway)
+    
+    def destroy(self):
+        """Remove the namespace (and with it the veth pair)"""
+        sh(["ip", "netns", "del", self.name])
+        sh(["ip", "link", "del", self.host_if])
+    
+    def tun_up(self):
+        """Whether sing-box's tun interface exists and is up in the namespace"""
+        result = sh(["ip", "-n", self.name, "-o", "link", "show", "dev", self.tun])
+        if not result or result.returncode != 0 or "<" not in result.stdout:
+            return False
+        return "UP" in result.stdout.split("<", 1)[1].split(">", 1)[0].split(",")
+
+@contextmanager
+def netns_uplink():
+    """IP forwarding and NAT for the namespaces while the block runs"""
+    forward_path = "/proc/sys/net/ipv4/ip_forward"
+    with open(forward_path) as f:
+        forwarding = f.read().strip()
+    rule = ["POSTROUTING", "-s", NETNS_SUBNET, "-j", "MASQUERADE"]
+    added = False
+    try:
+        with open(forward_path, "w") as f:
+            f.write("1")
+        check = sh(["iptables", "-t", "nat", "-C", *rule])
+        if check and check.returncode != 0:
+            result = sh(["iptables", "-t", "nat", "-A", *rule])
+            added = bool(result and result.returncode == 0)
+        if not check:
+            log_message("WARN", "iptables not found, namespaces only reach the host")
+        yield
+    finally:
+        if added:
+            sh(["iptables", "-t", "nat", "-D", *rule])
+        with open(forward_path, "w") as f:
+            f.write(forwarding)
+
+def validate_in_slot(slot, profile, config, settings):
+    """Bring profile up in a namespace on its built config and run the checks through it"""
+    result = {"profile": profile["name"], "protocol": profile["protocol"], "ok": False, "error": None,
+              "up_ms": None, "first_byte_ms": None, "mbps": None}
+    # Neither is needed here and both would clash between instances
+    config.get("experimental", {}).pop("cache_file", None)
+    config.get("experimental", {}).pop("clash_api", None)
+    for inbound in config["inbounds"]:
+        if inbound["type"] == "tun":
+            inbound["interface_name"] = slot.tun
+    with open(slot.config, "w") as f:
+        json.dump(config, f, indent=2)
+    
+    start = time.perf_counter()
+    with open(slot.log, "wb") as log:
+        process = sh(["ip", "netns", "exec", slot.name, "sing-box", "run", "-c", slot.config],
+                     background=True, output=log)
+    if not process:
+        result["error"] = "sing-box did not start"
+        return result
+    
+    try:
+        deadline = time.time() + settings["tun_timeout"]
+        while not slot.tun_up():
+            if process.poll() is not None or time.time() > deadline:
+                with open(slot.log, "rb") as f:
+                    lines = f.read().decode("utf-8", "replace").strip().splitlines()
+                result["error"] = lines[-1][:120] if lines else (
+                    f"exited with code {process.returncode}" if process.poll() is not None else "tun timeout")
+                return result
+            time.sleep(0.05)
+        result["up_ms"] = (time.perf_counter() - start) * 1000
+        
+        with in_netns(slot.name):
+            result["first_byte_ms"] = probe_first_byte(settings["probe_host"], settings["probe_port"])
+            if result["first_byte_ms"] is not None and settings["bench_host"]:
+                result["mbps"] = measure_bulk(settings["bench_host"], settings["bench_port"],
+                                              settings["validate_bytes"])
+        result["ok"] = result["first_byte_ms"] is not None
+        if not result["ok"]:
+            result["error"] = f"no reply from {settings['probe_host']}:{settings['probe_port']}"
+    finally:
+        stop_process(process)
+    return result
+
+def validate_fleet(profiles, concurrency=8):
+    """Validate profiles in parallel namespaces; yields one result dict per profile
+    
+    Results come in completion order. Namespaces are created once per slot
+    and removed at the end, also on errors.
+    """
+    settings = load_settings()
+    os.makedirs(VALIDATE_DIR, exist_ok=True)
+    slots = queue.Queue()
+    created = []
+    build_lock = threading.Lock()  # Building also compiles rule-sets and prunes caches
+    
+    def work(profile):
+        slot = slots.get()
+        try:
+            with build_lock:
+                config = build_singbox_config(profile)
+            return validate_in_slot(slot, profile, config, settings)
+        except Exception as e:
+            return {"profile": profile["name"], "protocol": profile["protocol"], "ok": False,
+                    "error": str(e), "up_ms": None, "first_byte_ms": None, "mbps": None}
+        finally:
+            slots.put(slot)
+    
+    with netns_uplink():
+        try:
+            for index in range(max(1, min(concurrency, len(profiles), NETNS_MAX))):
+                slot = NetnsSlot(index)
+                slot.create()
+                created.append(slot)
+                slots.put(slot)
+            
+            with ThreadPoolExecutor(max_workers=len(created)) as pool:
+                for future in as_completed([pool.submit(work, p) for p in profiles]):
+                    yield future.result()
+        finally:
+            for slot in created:
+                slot.destroy()
+
+def write_validation_report(results, seconds):
+    """Aggregate results into VALIDATE_REPORT and return the summary"""
+    ok = [r for r in results if r["ok"]]
+    errors = collections.Counter(r["error"] for r in results if not r["ok"])
+    summary = {
+        "time": time.time(),
+        "seconds": round(seconds, 1),
+        "profiles": len(results),
+        "passed": len(ok),
+        "failed": len(results) - len(ok),
+        "up_ms_p50": percentile([r["up_ms"] for r in ok], 50),
+        "first_byte_ms_p50": percentile([r["first_byte_ms"] for r in ok], 50),
+        "mbps_p50": percentile([r["mbps"] for r in ok if r["mbps"] is not None], 50),
+        "top_errors": errors.most_common(5)
+    }
+    with open(VALIDATE_REPORT, "w") as f:
+        json.dump({"summary": summary, "results": sorted(results, key=lambda r: r["profile"])}, f, indent=2)
+    return summary
+
+# ========== PROFILE VERIFY ==========
+# End-to-end checks without root: each profile's real outbound behind a
+# mixed inbound on an ephemeral localhost port, many sing-box instances at
+# once, a small HTTP fetch through each.
+VERIFY_DIR = os.path.join(CACHE, "verify")
+
+def verify_config(profile, port):
+    """The profile's config with a local mixed inbound instead of tun, everything proxied"""
+    cfg = build_singbox_config(profile)
+    cfg["inbounds"] = [{"type": "mixed", "listen": "127.0.0.1", "listen_port": port}]
+    cfg["dns"].pop("fakeip", None)
+    cfg["route"] = {"final": "proxy"}
+    cfg.pop("experimental", None)
+    return cfg
+
+def proxy_fetch(proxy_port, url, timeout=10):
+    """GET url through a local HTTP proxy
+    
+    Returns {handshake_ms, first_byte_ms, status}: handshake is until the
+    proxy confirms the tunnel, first byte is until the target answers. An
+    outbound that dials lazily shows its server handshake in first_byte_ms.
+    Raises OSError or ValueError on failure.
+    """
+    parsed = urlparse(url)
+    host, port = parsed.hostname, parsed.port or 80
+    start = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", proxy_port), timeout=timeout) as sock:
+        sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+        reply = b""
+        while b"\r\n\r\n" not in reply:
+            chunk = sock.recv(1024)
+            if not chunk:
+                raise ValueError("proxy closed the connection")
+            reply += chunk
+        status = reply.split(b"\r\n", 1)[0]
+        if b" 200" not in status:
+            raise ValueError(f"proxy refused: {status.decode(errors='replace')}")
+        handshake = (time.perf_counter() - start) * 1000
+        
+        sock.sendall(f"GET {parsed.path or '/'} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        response = sock.recv(1024)
+        if not response:
+            raise ValueError("no response through the tunnel")
+        first_byte = (time.perf_counter() - start) * 1000
+        while b"\r\n" not in response:
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            response += chunk
+    status_line = response.split(b"\r\n", 1)[0].split()
+    if len(status_line) < 2 or not status_line[0].startswith(b"HTTP/"):
+        raise ValueError("not an HTTP response")
+    return {"handshake_ms": handshake, "first_byte_ms": first_byte, "status": int(status_line[1])}
+
+def verify_profile(profile, config_builder=verify_config, settings=None):
+    """Start sing-box for one profile on a free port and fetch verify_url through it"""
+    settings = settings or load_settings()
+    result = {"profile": profile["name"], "protocol": profile["protocol"], "ok": False, "error": None,
+              "startup_ms": None, "handshake_ms": None, "first_byte_ms": None, "status": None}
+    slug = re.sub(r"[^\w.-]+", "_", profile["name"])[:40] + "-" + uuid.uuid4().hex[:6]
+    path = os.path.join(VERIFY_DIR, f"{slug}.json")
+    log_path = os.path.join(VERIFY_DIR, f"{slug}.log")
+    
+    # Another instance can grab the free port first, so retry once on a new one
+    for _ in range(2):
+        port = free_port()
+        with open(path, "w") as f:
+            json.dump(config_builder(profile, port), f, indent=2)
+        start = time.perf_counter()
+        with open(log_path, "wb") as log:
+            process = sh(["sing-box", "run", "-c", path], background=True, output=log)
+        if not process:
+            result["error"] = "sing-box did not start"
+            break
+        try:
+            if not wait_for_port(port, process, settings["tun_timeout"]):
+                with open(log_path, "rb") as f:
+                    lines = f.read().decode("utf-8", "replace").strip().splitlines()
+                result["error"] = lines[-1][:120] if lines else "inbound did not open"
+                if "address already in use" in result["error"]:
+                    continue
+                break
+            result["startup_ms"] = (time.perf_counter() - start) * 1000
+            try:
+                result.update(proxy_fetch(port, settings["verify_url"]))
+                result["ok"] = result["status"] < 500
+                result["error"] = None if result["ok"] else f"HTTP {result['status']}"
+            except (OSError, ValueError) as e:
+                result["error"] = str(e) or type(e).__name__
+            break
+        finally:
+            stop_process(process)
+    
+    for leftover in (path, log_path):
+        if os.path.exists(leftover) and (result["ok"] or leftover == path):
+            os.remove(leftover)
+    return result
+
+def verify_profiles(profiles, concurrency=8):
+    """Verify profiles with up to concurrency sing-box instances; yields results as they finish
+    
+    Logs of failed profiles stay in CACHE/verify.
+    """
+    settings = load_settings()
+    os.makedirs(VERIFY_DIR, exist_ok=True)
+    build_lock = threading.Lock()  # Building also compiles rule-sets and prunes caches
+    
+    def builder(profile, port):
+        with build_lock:
+            return verify_config(profile, port)
+    
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(verify_profile, p, builder, settings) for p in profiles]
+        for future in as_completed(futures):
+            yield future.result()
+
+def format_verify_result(result):
+    """One line per profile for the console and the test screen"""
+    if not result["ok"]:
+        return f"FAIL {result['profile']}: {result['error']}"
+    return (f"OK   {result['profile']}: start {result['startup_ms']:.0f} ms, "
+            f"handshake {result['handshake_ms']:.0f} ms, first byte {result['first_byte_ms']:.0f} ms")
+
+# ========== PROFILING ==========
+def run_profiled(func, use_tracemalloc=False):
+    """Run func under cProfile (and tracemalloc), dumping stats on exit"""
+    import cProfile
+    import pstats
+    import tracemalloc
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    prefix = os.path.join(PROFILE_DIR, f"ragevpn-{stamp}")
+    
+    if use_tracemalloc:
+        tracemalloc.start(25)
+        first_snapshot = tracemalloc.take_snapshot()
+    
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{prefix}.pstats")
+        with open(f"{prefix}.txt", "w") as f:
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+        print(f"[*] Profile written to {prefix}.pstats")
+        
+        if use_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(f"{prefix}-memory.txt", "w") as f:
+                f.write("Top allocations:\n")
+                for stat in snapshot.statistics("lineno")[:25]:
+                    f.write(f"{stat}\n")
+                f.write("\nGrowth since start:\n")
+                for stat in snapshot.compare_to(first_snapshot, "lineno")[:25]:
+                    f.write(f"{stat}\n")
+            print(f"[*] Memory snapshot written to {prefix}-memory.txt")
+
 # ========== MAIN ENTRY ==========
 def main():
     """Main entry point"""
+    global SINGBOX_VERSION
+    
+    parser = argparse.ArgumentParser(description=f"{APP} v{VERSION}")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile and dump stats to ~/.ragevpn/profile on exit")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="with --profile, also record tracemalloc snapshots")
+    parser.add_argument("--compile-rules", action="store_true",
+                        help="recompile bypass/proxy rule lists from scratch and exit")
+    parser.add_argument("--geo-seed", nargs="+", metavar="FILE",
+                        help="pre-seed the geo cache from local rule-set files (geoip-cn.srs, ...) and exit")
+    parser.add_argument("--geo-update", action="store_true",
+                        help="refresh all cached geoip/geosite rule-sets now and exit")
+    parser.add_argument("--bench-search", type=int, metavar="N",
+                        help="benchmark profile search over N synthetic profiles and exit")
+    parser.add_argument("--bench-memory", type=int, metavar="N",
+                        help="compare memory of N profiles as dicts and as Profile objects, then exit")
+    parser.add_argument("--bench-connections", type=int, metavar="N",
+                        help="benchmark the connections view against a mock API with N connections and exit")
+    parser.add_argument("--bench-tunnel", metavar="PROFILE",
+                        help="sweep tun MTU and stack for a profile, store the fastest pair and exit")
+    parser.add_argument("--bench-cache", metavar="PROFILE",
+                        help="compare first-request latency after reconnects without and with "
+                             "the sing-box cache file and exit")
+    parser.add_argument("--bench-setup", nargs="?", const="", metavar="PROFILE",
+                        help="time connection setup for each multiplex / TCP Fast Open variant "
+                             "(through PROFILE, or a local stand-in) and exit")
+    parser.add_argument("--bench-connect", type=int, metavar="N",
+                        help="run N connect/disconnect cycles through the UI against a stand-in "
+                             "sing-box in a throwaway HOME and exit")
+    parser.add_argument("--validate-netns", nargs="*", metavar="PROFILE",
+                        help="validate the given profiles (default: all) in parallel network "
+                             "namespaces, write ~/.ragevpn/validation.json and exit (root)")
+    parser.add_argument("--verify", nargs="*", metavar="PROFILE",
+                        help="fetch verify_url through the given profiles (default: all) via local "
+                             "proxy inbounds, no root needed, and exit")
+    parser.add_argument("--race-family", nargs="*", metavar="PROFILE",
+                        help="race IPv4 against IPv6 connects to the given profiles' servers (default: all), "
+                             "store the faster family and exit")
+    parser.add_argument("--resolve", nargs="*", metavar="PROFILE",
+                        help="pre-resolve the given profiles' server names (default: all) into the "
+                             "resolver cache now and exit")
+    parser.add_argument("--bench-resolve", type=int, metavar="N",
+                        help="benchmark resolving N names against a local stub DNS and exit")
+    parser.add_argument("--render-fleet", nargs="?", const=FLEET_DIR, metavar="DIR",
+                        help="render per-host configs from DIR/base.json and DIR/hosts/*.json into DIR/out "
+                             "(default ~/.ragevpn/fleet), check changed ones with sing-box and exit")
+    parser.add_argument("--concurrency", type=int, default=8, metavar="N",
+                        help="tunnels / sing-box instances / races at once for --validate-netns, --verify "
+                             "and --race-family (default 8)")
+    parser.add_argument("--serve-bulk", type=int, metavar="PORT",
+                        help="run the bulk source used by --bench-tunnel on PORT")
+    parser.add_argument("--import", dest="import_paths", nargs="+", metavar="PATH",
+                        help="import profiles from Clash YAML, sing-box JSON or link list files "
+                             "(or directories of them) and exit")
+    args = parser.parse_args()
+    
+    if args.serve_bulk:
+        server = serve_bulk(args.serve_bulk)
+        print(f"[*] Bulk source listening on port {args.serve_bulk}, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+    
+    if args.import_paths:
+        start = time.perf_counter()
+        results = import_profiles(args.import_paths)
+        if not results:
+            print("[-] No importable files found")
+            sys.exit(1)
+        for result in results:
+            entries = result["profiles"] + len(result["failures"])
+            seconds = max(result["seconds"], 1e-6)
+            print(f"[+] {result['path']} ({result['format']}): {result['profiles']} imported, "
+                  f"{len(result['failures'])} failed, {entries / seconds:,.0f} entries/s, "
+                  f"{result['bytes'] / seconds / 1024 / 1024:.1f} MB/s")
+        print(f"[*] Imported {sum(r['profiles'] for r in results)} profiles from {len(results)} files "
+              f"in {time.perf_counter() - start:.2f}s")
+        return
+    
+    if args.bench_connect:
+        from bench.harness import benchmark_connect  # Test harness in bench/ next to this file
+        cycles = []
+        for result in benchmark_connect(args.bench_connect):
+            if "phases" in result:
+                phases = result["phases"]
+                break
+            cycles.append(result)
+            print(f"\r[*] Cycle {len(cycles)}/{args.bench_connect}", end="", flush=True)
+        ok = [c for c in cycles if c["ok"]]
+        print(f"\r[*] {len(ok)}/{len(cycles)} cycles connected, {len(cycles) - len(ok)} simulated crashes")
+        for label, values in (("connect", [c["connect_ms"] for c in ok]),
+                              ("disconnect", [c["disconnect_ms"] for c in ok]),
+                              ("UI CPU/cycle", [c["ui_cpu_ms"] for c in cycles]),
+                              ("child CPU/cycle", [c["children_cpu_ms"] for c in cycles])):
+            print(f"[*] {label:<16} p50 {percentile(values, 50):8.1f} ms  p95 {percentile(values, 95):8.1f} ms"
+                  f"  max {max(values, default=0):8.1f} ms")
+        idle = [c["idle_cpu"] for c in ok]
+        print(f"[*] Connected idle  {percentile(idle, 50):.1%} CPU (p50), {max(idle, default=0):.1%} max")
+        print(f"[*] UI RSS          {cycles[0]['ui_rss'] / 1024 / 1024:.1f} MB -> {cycles[-1]['ui_rss'] / 1024 / 1024:.1f} MB")
+        for phase, stats in phases.items():
+            print(f"[*]   {phase:<16} p50 {stats['p50']:8.1f} ms  p95 {stats['p95']:8.1f} ms  ({stats['count']})")
+        return
+    
+    if args.bench_connections:
+        result = benchmark_connections(args.bench_connections)
+        print(f"[*] {result['connections']:,} connections, {result['domains']:,} domains")
+        print(f"[*] Poll + aggregate: p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms")
+        print(f"[*] UI snapshot: {result['view_ms']:.3f} ms")
+        return
+    
+    if args.bench_memory:
+        result = benchmark_profile_memory(args.bench_memory)
+        for label, size in result.items():
+            print(f"[*] {label:<8} {size / 1024 / 1024:8.1f} MB  {size / args.bench_memory:6.0f} B/profile")
+        print(f"[*] Profile uses {result['Profile'] / result['dict']:.0%} of the dict footprint")
+        return
+    
+    if args.bench_search:
+        result = benchmark_search(args.bench_search)
+        print(f"[*] Indexed {result['profiles']:,} profiles in {result['build_s']:.2f}s")
+        print(f"[*] {result['keystrokes']} keystrokes: p50 {result['p50_ms']:.2f} ms, "
+              f"p95 {result['p95_ms']:.2f} ms, max {result['max_ms']:.2f} ms")
+        print(f"[*] Incremental update: {result['update_ms']:.2f} ms per profile")
+        return
+    
+    if args.geo_seed:
+        for name, result in seed_geo_data(args.geo_seed):
+            if isinstance(result, dict):
+                print(f"[+] {name}: {result['format']} {result['version']} -> {result['path']}")
+            else:
+                print(f"[-] {name}: {result}")
+        return
+    
+    if args.geo_update:
+        for name, status in update_geo_data(force=True).items():
+            print(f"[{'+' if status in ('updated', 'current') else '-'}] {name}: {status}")
+        return
+    
+    if args.race_family is not None:
+        profiles = load_profiles()
+        if args.race_family:
+            wanted = set(args.race_family)
+            profiles = [p for p in profiles if p["name"] in wanted]
+        if not profiles:
+            print("[-] No profiles to race")
+            sys.exit(1)
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            futures = {pool.submit(race_profile_family, p): p for p in profiles}
+            for future in as_completed(futures):
+                profile, result = futures[future], future.result()
+                save_profile(profile)
+                print(f"[{'+' if result['family'] else '-'}] {profile['name']}: {format_family_race(result)}")
+        return
+    
+    if args.resolve is not None:
+        profiles = load_profiles()
+        if args.resolve:
+            wanted = set(args.resolve)
+            profiles = [p for p in profiles if p["name"] in wanted]
+        endpoints = server_endpoints(profiles)
+        if not endpoints:
+            print("[-] No server hostnames to resolve")
+            sys.exit(1)
+        start = time.perf_counter()
+        for host, entry in sorted(resolve_servers(endpoints).items()):
+            if entry["fastest"]:
+                print(f"[+] {host}: {entry['fastest']} ({entry['times'][entry['fastest']]:.1f} ms) "
+                      f"of {', '.join(entry['addresses'])}, ttl {entry['ttl']}s via {entry['server']}")
+            else:
+                print(f"[-] {host}: {entry.get('error') or 'no address connected'}")
+        print(f"[*] Resolved {len(endpoints)} names in {time.perf_counter() - start:.2f}s")
+        return
+    
+    if args.bench_resolve:
+        for label, result in benchmark_resolve(args.bench_resolve).items():
+            print(f"[*] {label:<10} {result['seconds']:6.2f}s  {result['per_second']:8.1f} names/s  "
+                  f"{result['pinned']}/{args.bench_resolve} pinned, ttl {result['ttl']}s")
+        return
+    
+    if args.compile_rules:
+        start = time.time()
+        compiled = compile_rule_sets(force=True)
+        for list_name, path in compiled.items():
+            print(f"[+] {list_name}: {path}")
+        print(f"[*] Compiled {len(compiled)} rule-sets in {time.time() - start:.2f}s")
+        return
+    
     # Check dependencies
     singbox_installed, version = check_singbox()
+    SINGBOX_VERSION = version
     
     if not singbox_installed:
         print("[-] sing-box is not installed!")
@@ -1244,18 +6476,170 @@ def main():
         print("[*] Download from: https://sing-box.sagernet.org/")
         sys.exit(1)
     
+    if args.bench_setup is not None:
+        profile = None
+        if args.bench_setup:
+            profile = next((p for p in load_profiles() if p["name"] == args.bench_setup), None)
+            if not profile:
+                print(f"[-] No profile named {args.bench_setup}")
+                sys.exit(1)
+        print(f"[*] {'variant':<14} {'cold':>8} {'p50':>8} {'p95':>8}  failed")
+        for name, result in benchmark_setup(profile):
+            if not result:
+                print(f"[-] {name:<14} sing-box did not start")
+                continue
+            cells = [f"{result[k]:6.1f}ms" if result[k] is not None else "     n/a" for k in ("cold_ms", "p50_ms", "p95_ms")]
+            print(f"[*] {name:<14} {' '.join(cells)}  {result['failed']}")
+        return
+    
+    if args.validate_netns is not None:
+        if os.geteuid() != 0:
+            print("[-] --validate-netns needs root (network namespaces and tun)")
+            sys.exit(1)
+        profiles = load_profiles()
+        if args.validate_netns:
+            wanted = set(args.validate_netns)
+            profiles = [p for p in profiles if p["name"] in wanted]
+        if not profiles:
+            print("[-] No profiles to validate")
+            sys.exit(1)
+        start = time.perf_counter()
+        results = []
+        for result in validate_fleet(profiles, args.concurrency):
+            results.append(result)
+            if result["ok"]:
+                speed = f"{result['mbps']:6.1f} MB/s" if result["mbps"] is not None else "      n/a"
+                print(f"[+] {result['profile']:<30} up {result['up_ms']:6.0f} ms  "
+                      f"first byte {result['first_byte_ms']:5d} ms  {speed}")
+            else:
+                print(f"[-] {result['profile']:<30} {result['error']}")
+        summary = write_validation_report(results, time.perf_counter() - start)
+        print(f"[*] {summary['passed']}/{summary['profiles']} passed in {summary['seconds']}s "
+              f"(up p50 {summary['up_ms_p50']:.0f} ms, first byte p50 {summary['first_byte_ms_p50']} ms)")
+        for error, count in summary["top_errors"]:
+            print(f"[*]   {count:4d} x {error}")
+        print(f"[*] Report written to {VALIDATE_REPORT}")
+        return
+    
+    if args.verify is not None:
+        profiles = load_profiles()
+        if args.verify:
+            wanted = set(args.verify)
+            profiles = [p for p in profiles if p["name"] in wanted]
+        if not profiles:
+            print("[-] No profiles to verify")
+            sys.exit(1)
+        start = time.perf_counter()
+        passed = 0
+        for result in verify_profiles(profiles, args.concurrency):
+            passed += result["ok"]
+            print(f"[{'+' if result['ok'] else '-'}] {format_verify_result(result)}")
+        print(f"[*] {passed}/{len(profiles)} passed in {time.perf_counter() - start:.1f}s")
+        if passed < len(profiles):
+            print(f"[*] sing-box logs of failed profiles are in {VERIFY_DIR}")
+        return
+    
+    if args.render_fleet:
+        start = time.perf_counter()
+        counts = collections.Counter()
+        try:
+            for result in render_fleet(args.render_fleet):
+                counts[result["status"]] += 1
+                if result["status"] == "failed":
+                    print(f"[-] {result['host']}: {result['error']}")
+                elif result["status"] == "removed":
+                    print(f"[*] {result['host']}: host file gone, output removed")
+        except (OSError, ValueError) as e:
+            print(f"[-] {e}")
+            sys.exit(1)
+        print(f"[*] {sum(counts.values())} hosts in {time.perf_counter() - start:.2f}s: {counts['written']} written, "
+              f"{counts['unchanged']} unchanged, {counts['failed']} failed, {counts['removed']} removed")
+        if counts["failed"]:
+            sys.exit(1)
+        return
+    
+    if args.bench_cache:
+        profile = next((p for p in load_profiles() if p["name"] == args.bench_cache), None)
+        if not profile:
+            print(f"[-] No profile named {args.bench_cache}")
+            sys.exit(1)
+        try:
+            for mode, samples in benchmark_cache(profile):
+                ok = [ms for ms in samples if ms is not None]
+                if not ok:
+                    print(f"[-] cache {mode:<3}  no successful requests")
+                    continue
+                print(f"[*] cache {mode:<3}  first request p50 {percentile(ok, 50):7.1f} ms  "
+                      f"p95 {percentile(ok, 95):7.1f} ms  ({len(ok)}/{len(samples)} ok)")
+        except RuntimeError as e:
+            print(f"[-] {e}")
+            sys.exit(1)
+        return
+    
+    if args.bench_tunnel:
+        profile = next((p for p in load_profiles() if p["name"] == args.bench_tunnel), None)
+        if not profile:
+            print(f"[-] No profile named {args.bench_tunnel}")
+            sys.exit(1)
+        # Local traffic is routed over lo, whatever the tun settings
+        local = not load_settings()["bench_host"]
+        if local:
+            print("[!] bench_host is not set: speeds come from a local stand-in that bypasses the tun")
+        results = []
+        for mtu, stack, speed in benchmark_tunnel(profile):
+            results.append((speed or 0, mtu, stack))
+            print(f"[*] mtu {mtu:<5} {stack:<7} " + (f"{speed:8.1f} MB/s" if speed else "  failed"))
+        speed, mtu, stack = max(results)
+        if not speed:
+            print("[-] No combination worked")
+            sys.exit(1)
+        if local:
+            print("[*] All combinations start; set bench_host to a host reached through the tunnel to pick one")
+            return
+        profile["mtu"] = mtu
+        profile["stack"] = stack
+        save_profile(profile)
+        print(f"[+] Best: mtu {mtu}, stack {stack} ({speed:.1f} MB/s), saved to {profile['name']}")
+        return
+    
     print(f"[*] Starting {APP} v{VERSION}")
     print(f"[*] sing-box version: {version}")
     print("[*] Initializing...")
     
+    # Pre-resolve server names while the UI runs; pinning uses what is cached
+    if load_settings()["pin_server_address"]:
+        start_resolve()
+    
+    # Refresh stale geo data while the UI runs; connects use what is cached
+    start_geo_update()
+    
     # Run curses application
     try:
-        curses.wrapper(main_menu)
+        if args.profile:
+            run_profiled(lambda: curses.wrapper(main_menu), args.tracemalloc)
+        else:
+            curses.wrapper(main_menu)
     except KeyboardInterrupt:
         print("\n[*] Shutting down...")
+    except curses.error:
+        # After a hang-up curses cannot restore a terminal that is gone
+        try:
+            os.tcgetpgrp(sys.stdin.fileno())
+        except OSError:
+            pass
+        else:
+            raise
     finally:
-        stop_singbox()
-        print("[*] Goodbye!")
+        # A recorded session is left up on detach or a crash; the next start reattaches
+        session = load_session()
+        if not session:
+            stop_singbox()
+        try:
+            if session:
+                print(f"[*] Tunnel left running ({session['profile']}), start {APP} again to reattach")
+            print("[*] Goodbye!")
+        except OSError:
+            pass  # The terminal hung up; there is nobody to tell
 
 if __name__ == "__main__":
     main()
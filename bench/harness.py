@@ -0,0 +1,291 @@
+"""
+Offline end-to-end harness behind RAGEVPN.py --bench-connect: a stand-in
+sing-box on PATH, an isolated HOME and the real UI driven through a
+pseudo-terminal.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import random
+import socket
+import socketserver
+import subprocess
+import threading
+import tempfile
+import shutil
+import select
+import struct
+import fcntl
+import termios
+import pty
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from RAGEVPN import TUN_INTERFACE, serve_reply, summarize_traces
+
+CLIENT = os.path.join(ROOT, "RAGEVPN.py")
+FAKE_PROXY_INBOUNDS = ("mixed", "socks", "http")
+
+def relay(source, target):
+    """Copy one direction of a proxied connection until EOF"""
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            target.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+def serve_fake_proxy(port, host="127.0.0.1"):
+    """SOCKS5 and HTTP CONNECT proxy on one port, connecting directly"""
+    class Handler(socketserver.BaseRequestHandler):
+        def read(self, count):
+            data = b""
+            while len(data) < count:
+                chunk = self.request.recv(count - len(data))
+                if not chunk:
+                    raise ConnectionError("client closed")
+                data += chunk
+            return data
+        
+        def handle(self):
+            try:
+                first = self.read(1)
+                if first == b"\x05":
+                    self.read(self.read(1)[0])  # Offered auth methods
+                    self.request.sendall(b"\x05\x00")
+                    _, _, _, kind = self.read(4)
+                    if kind == 1:
+                        target = socket.inet_ntoa(self.read(4))
+                    elif kind == 4:
+                        target = socket.inet_ntop(socket.AF_INET6, self.read(16))
+                    else:
+                        target = self.read(self.read(1)[0]).decode()
+                    port = int.from_bytes(self.read(2), "big")
+                    upstream = socket.create_connection((target, port), timeout=10)
+                    self.request.sendall(b"\x05\x00\x00\x01" + bytes(6))
+                else:
+                    request = first
+                    while b"\r\n\r\n" not in request:
+                        request += self.read(1)
+                    method, target = request.split()[:2]
+                    if method != b"CONNECT":
+                        self.request.sendall(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n")
+                        return
+                    target, port = target.decode().rsplit(":", 1)
+                    upstream = socket.create_connection((target.strip("[]"), int(port)), timeout=10)
+                    self.request.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            except (OSError, ValueError, IndexError):
+                return
+            
+            with upstream:
+                upstream.settimeout(None)
+                threading.Thread(target=relay, args=(upstream, self.request), daemon=True).start()
+                relay(self.request, upstream)
+    
+    server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def open_fake_tun(name):
+    """A tun interface that lives as long as this process, or None without root"""
+    try:
+        fd = os.open("/dev/net/tun", os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        # TUNSETIFF with IFF_TUN | IFF_NO_PI
+        fcntl.ioctl(fd, 0x400454ca, struct.pack("16sH", name.encode(), 0x0001 | 0x1000))
+    except OSError:
+        os.close(fd)
+        return None
+    subprocess.run(["ip", "link", "set", name, "up"], capture_output=True)
+    return fd
+
+def fake_singbox(args, delay=0.3, crash_rate=0.0, version="1.9.0"):
+    """Stand-in sing-box: version, check and run
+    
+    run waits about delay seconds, exits like a failed start with
+    crash_rate probability, serves mixed/socks/http inbounds, brings up
+    tun interfaces when run as root and then logs the line sing-box prints
+    once it is up. Returns the exit code.
+    """
+    command = args[0] if args else ""
+    if command == "version":
+        print(f"sing-box version {version}\n\nEnvironment: offline stand-in")
+        return 0
+    
+    path = args[args.index("-c") + 1] if "-c" in args[:-1] else "config.json"
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"FATAL[0000] decode config at {path}: {e}", flush=True)
+        return 1
+    if command == "check":
+        return 0
+    if command != "run":
+        print(f"Error: unknown command \"{command}\"", flush=True)
+        return 1
+    
+    start = time.time()
+    time.sleep(delay * random.uniform(0.8, 1.2))
+    if random.random() < crash_rate:
+        print("FATAL[0000] start service: simulated crash", flush=True)
+        return 1
+    tuns = []
+    for inbound in config.get("inbounds", []):
+        if inbound.get("type") in FAKE_PROXY_INBOUNDS and inbound.get("listen_port"):
+            serve_fake_proxy(inbound["listen_port"], inbound.get("listen") or "127.0.0.1")
+        elif inbound.get("type") == "tun":
+            tuns.append(open_fake_tun(inbound.get("interface_name", TUN_INTERFACE)))
+    print(f"INFO[0000] sing-box started ({time.time() - start:.2f}s)", flush=True)
+    
+    while True:
+        time.sleep(3600)
+
+def write_fake_singbox(bin_dir, **options):
+    """Put an executable sing-box running fake_singbox(**options) into bin_dir"""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "sing-box")
+    # A script, so the process is named sing-box like the real one
+    with open(path, "w") as f:
+        f.write(f"#!{sys.executable}\n"
+                "import sys\n"
+                f"sys.path.insert(0, {ROOT!r})\n"
+                "from bench.harness import fake_singbox\n"
+                f"sys.exit(fake_singbox(sys.argv[1:], **{options!r}))\n")
+    os.chmod(path, 0o755)
+    return path
+
+class TerminalDriver:
+    """Run a curses program in a pseudo-terminal, send keys, wait for text"""
+    
+    def __init__(self, argv, env, rows=40, cols=120):
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.execvpe(argv[0], argv, env)
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+        self.output = b""
+        self.process = psutil.Process(self.pid)
+    
+    def send(self, keys):
+        """Write keys and forget the output seen so far"""
+        self.output = b""
+        os.write(self.fd, keys.encode())
+    
+    def wait_for(self, markers, timeout=15):
+        """First of markers (bytes) to appear in the output, or None"""
+        deadline = time.monotonic() + timeout
+        while True:
+            for marker in markers:
+                if marker in self.output:
+                    return marker
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if ready:
+                try:
+                    self.output += os.read(self.fd, 65536)
+                except OSError:
+                    return None  # The program exited
+    
+    def close(self):
+        """Kill the program and reap it"""
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        os.close(self.fd)
+
+def benchmark_connect(cycles=100, delay=0.3, crash_rate=0.02, hold=1.0):
+    """Connect, hold and disconnect through the real UI against a fake sing-box
+    
+    Runs in a throwaway HOME with a local reachability target, so it needs
+    no root, tun device or servers. Yields one dict per cycle and finally
+    the phase summary from the run's connect traces as {"phases": ...}.
+    """
+    home = tempfile.mkdtemp(prefix="ragevpn-bench-")
+    target = serve_reply(0)
+    port = target.server_address[1]
+    base = os.path.join(home, ".ragevpn")
+    os.makedirs(os.path.join(base, "profiles"))
+    with open(os.path.join(base, "settings.json"), "w") as f:
+        json.dump({"probe_host": "127.0.0.1", "probe_port": port, "test_url": f"http://127.0.0.1:{port}/",
+                   "ready_signal": "log", "auto_failover": False}, f)
+    with open(os.path.join(base, "profiles", "bench.json"), "w") as f:
+        json.dump({"name": "bench", "protocol": "trojan", "link": f"trojan://bench@127.0.0.1:{port}?sni=localhost#bench",
+                   "created": time.time(), "last_used": 0, "usage_count": 0}, f)
+    bin_dir = os.path.join(home, "bin")
+    write_fake_singbox(bin_dir, delay=delay, crash_rate=crash_rate)
+    
+    env = dict(os.environ, HOME=home, TERM="xterm", PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""))
+    ui = TerminalDriver([sys.executable, CLIENT], env)
+    try:
+        for cycle in range(cycles):
+            if not ui.wait_for([b"Connect VPN"]):
+                raise RuntimeError("main menu did not appear")
+            ui.send("\r")
+            if not ui.wait_for([b"Select Profile"]):
+                raise RuntimeError("profile menu did not appear")
+            
+            cpu = ui.process.cpu_times()
+            start = time.perf_counter()
+            ui.send("\r")
+            outcome = ui.wait_for([b"CONNECTED", b"Failed"], timeout=30)
+            result = {"cycle": cycle, "ok": outcome == b"CONNECTED",
+                      "connect_ms": (time.perf_counter() - start) * 1000, "disconnect_ms": None, "idle_cpu": None}
+            if outcome is None:
+                raise RuntimeError("connect did not finish")
+            
+            if result["ok"]:
+                # Jittered, so the disconnect lands at varying points of the UI loop
+                held = hold * random.uniform(1, 1.5)
+                idle = ui.process.cpu_times()
+                time.sleep(held)
+                used = ui.process.cpu_times()
+                result["idle_cpu"] = max(0, used.user + used.system - idle.user - idle.system) / held
+                start = time.perf_counter()
+                ui.send("q")
+                if not ui.wait_for([b"Disconnected!"]):
+                    raise RuntimeError("disconnect did not finish")
+                result["disconnect_ms"] = (time.perf_counter() - start) * 1000
+            ui.send("\r")
+            
+            done = ui.process.cpu_times()
+            result["ui_cpu_ms"] = (done.user + done.system - cpu.user - cpu.system) * 1000
+            result["children_cpu_ms"] = (done.children_user + done.children_system
+                                        - cpu.children_user - cpu.children_system) * 1000
+            result["ui_rss"] = ui.process.memory_info().rss
+            yield result
+    finally:
+        ui.close()
+        target.shutdown()
+        # A sing-box left up by a failed cycle runs in its own session
+        for process in psutil.process_iter(["cmdline"]):
+            if any(home in arg for arg in process.info["cmdline"] or ()):
+                process.kill()
+        records = []
+        try:
+            with open(os.path.join(base, "trace.jsonl")) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(home, ignore_errors=True)
+    yield {"phases": summarize_traces(records, kind="connect")}